@@ -1,3 +0,0 @@
-#!/bin/bash
-source /env
-/usr/local/bin/gcalvault sync
\ No newline at end of file
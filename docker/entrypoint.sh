@@ -11,19 +11,7 @@ if [ ! -f "/root/.gcalvault/.user" ]; then
     exit 1
 fi
 
-echo "Creating cronjob..."
+export EXECAT="${EXECAT:-0 3 * * *}"
 
-export > /env
-
-EXECAT="${EXECAT:-0 3 * * *}"
-echo "$EXECAT /bin/bash /cron.sh" >> /var/spool/cron/crontabs/root
-
-echo "Syncing now..."
-/usr/local/bin/gcalvault sync
-
-echo "Starting cron..."
-if [ "${DEBUG:-false}" == "true" ]; then
-  crond -f -l 2 -L /dev/stdout
-else
-  crond -f
-fi
\ No newline at end of file
+echo "Starting daemon..."
+exec /usr/local/bin/gcalvault daemon
@@ -45,6 +45,9 @@ setup(
         "release": [
             "twine",
         ],
+        "brotli": [
+            "brotli",
+        ],
     },
     classifiers=[
         "Development Status :: 5 - Production/Stable",
@@ -0,0 +1,84 @@
+from datetime import timedelta
+
+MONTH_NAMES = ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"]
+WEEKDAY_NAMES = ["sun", "mon", "tue", "wed", "thu", "fri", "sat"]
+
+# Longest a valid expression can go without matching (e.g. "0 0 29 2 *" across leap years)
+MAX_SEARCH_SPAN = timedelta(days=366 * 8)
+
+
+class CronSchedule():
+    """
+    Standard 5-field cron expression (minute, hour, day of month, month,
+    day of week), supporting lists, ranges, steps and month/weekday names.
+    As in cron, when both day of month and day of week are restricted, a
+    day matching either one matches.
+    """
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression '{expression}' must have 5 fields")
+        self.expression = expression
+        self._minutes = self._parse_field(fields[0], 0, 59)
+        self._hours = self._parse_field(fields[1], 0, 23)
+        self._days = self._parse_field(fields[2], 1, 31)
+        self._months = self._parse_field(fields[3], 1, 12, MONTH_NAMES, 1)
+        self._weekdays = {weekday % 7 for weekday in self._parse_field(fields[4], 0, 7, WEEKDAY_NAMES, 0)}
+        self._days_restricted = not fields[2].startswith("*")
+        self._weekdays_restricted = not fields[4].startswith("*")
+
+    def next_run(self, after):
+        """
+        Returns the first time strictly after the given time matching the schedule
+        :param after: datetime
+        :return: datetime
+        """
+        time = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = time + MAX_SEARCH_SPAN
+        while time < limit:
+            if time.month not in self._months:
+                time = (time.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(time):
+                time = time.replace(hour=0, minute=0) + timedelta(days=1)
+            elif time.hour not in self._hours:
+                time = time.replace(minute=0) + timedelta(hours=1)
+            elif time.minute not in self._minutes:
+                time += timedelta(minutes=1)
+            else:
+                return time
+        raise ValueError(f"Cron expression '{self.expression}' never matches")
+
+    def _day_matches(self, time):
+        day_matches = time.day in self._days
+        weekday_matches = (time.weekday() + 1) % 7 in self._weekdays
+        if self._days_restricted and self._weekdays_restricted:
+            return day_matches or weekday_matches
+        return day_matches and weekday_matches
+
+    @classmethod
+    def _parse_field(cls, field, minimum, maximum, names=None, names_offset=0):
+        values = set()
+        for item in field.split(","):
+            (range_part, _, step_part) = item.partition("/")
+            step = cls._parse_value(step_part, 1, maximum) if step_part else 1
+            if range_part == "*":
+                (start, end) = (minimum, maximum)
+            elif "-" in range_part:
+                (start, end) = [cls._parse_value(value, minimum, maximum, names, names_offset)
+                                for value in range_part.split("-", 1)]
+            else:
+                start = cls._parse_value(range_part, minimum, maximum, names, names_offset)
+                end = maximum if step_part else start
+            if start > end:
+                raise ValueError(f"Invalid range '{item}' in cron expression")
+            values.update(range(start, end + 1, step))
+        return values
+
+    @staticmethod
+    def _parse_value(value, minimum, maximum, names=None, names_offset=0):
+        if names and value.lower() in names:
+            return names.index(value.lower()) + names_offset
+        if not value.isdigit() or not minimum <= int(value) <= maximum:
+            raise ValueError(f"Invalid value '{value}' in cron expression")
+        return int(value)
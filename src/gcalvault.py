@@ -1,17 +1,33 @@
 import os
 import glob
+import hashlib
 import re
-from datetime import datetime
+import secrets
+import shutil
+import signal
+import sys
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
+from datetime import datetime, timedelta
 
-import requests
 import urllib.parse
 import pathlib
 from getopt import gnu_getopt, GetoptError
-from googleapiclient.discovery import build
 
+# Google's client libraries, requests and GitPython are imported by the code using
+# them rather than here, so --help, --version and noop start without loading them
+from . import ical
+from .cron import CronSchedule
 from .google_oauth2 import GoogleOAuth2
 from .git_vault_repo import GitVaultRepo
-from .etag_manager import ETagManager
+from .metrics import Metrics
+from .rate_limit import Backoff, RateLimitedHttp, RateLimiter
+from .state_store import StateStore, STATE_DB_FILE_NAME
+from .temp_file import temp_file
 
 # Note: OAuth2 auth code flow for "installed applications" assumes the client secret
 # cannot actually be kept secret (must be embedded in application/source code).
@@ -27,7 +43,69 @@ OAUTH_SCOPES = [
 
 GOOGLE_CALDAV_URI_FORMAT = "https://apidata.googleusercontent.com/caldav/v2/{cal_id}/events"
 
-COMMANDS = ['sync', 'noop']
+COMMANDS = ['sync', 'noop', 'daemon']
+
+DEFAULT_JOBS = 4
+DEFAULT_ACCOUNT_JOBS = 4
+DEFAULT_TIMEOUT = 60
+# Calls per second made to Google's endpoints, across all calendars and accounts
+DEFAULT_QPS = 10
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DEFAULT_SCHEDULE = "0 3 * * *"
+
+# Vault repository maintenance runs every this many commits, or once it has more than this
+# many loose objects (mirroring git's own gc.auto threshold)
+DEFAULT_MAINTENANCE_COMMITS = 100
+DEFAULT_MAINTENANCE_LOOSE_OBJECTS = 6700
+
+# Users synced by --all-users, one email address per line, and the state store of each
+USERS_FILE_NAME = ".users"
+ACCOUNT_STATE_DB_FILE_NAME_FORMAT = ".{user}.state.db"
+
+# Options each account synced by --all-users takes over from the command line and environment
+ACCOUNT_OPTIONS = [
+    'export_only', 'clean', 'push_repo', 'no_cache', 'incremental', 'conditional', 'normalize', 'adaptive', 'layout',
+    'maintenance_commits', 'maintenance_loose_objects', 'jobs', 'timeout', 'qps', 'webhook_url',
+    'conf_dir', 'client_id', 'client_secret', 'userfile_path', 'client_id_file', 'client_secret_file',
+]
+
+# Vault layouts: one .ics file per calendar, or one directory per calendar with one .ics file per event
+LAYOUTS = ['calendar', 'event']
+DEFAULT_LAYOUT = 'calendar'
+# Name of the temp file a calendar is downloaded to before being split into event files
+EVENTS_DOWNLOAD_FILE_NAME = ".calendar.download"
+# Longest event file name used as is, leaving room for temp file affixes within the usual 255 byte limit
+EVENT_FILE_NAME_MAX_LENGTH = 200
+
+# How long the daemon reuses a calendar list before listing the user's calendars again
+CALENDAR_LIST_MAX_AGE = timedelta(hours=1)
+# Upper bound on a single sleep while waiting for the next sync, so clock changes are noticed
+DAEMON_MAX_SLEEP = 60
+
+# With --adaptive, each calendar is checked ADAPTIVE_INTERVAL_FACTOR times the typical interval
+# between its changes (or the time since its last change, if longer) after its last check, but
+# no sooner than ADAPTIVE_MIN_INTERVAL and no later than ADAPTIVE_MAX_INTERVAL
+ADAPTIVE_MIN_INTERVAL = timedelta(minutes=5)
+ADAPTIVE_MAX_INTERVAL = timedelta(days=1)
+ADAPTIVE_INTERVAL_FACTOR = 0.5
+# Weight of the latest interval between changes in the moving average kept per calendar
+CHANGE_INTERVAL_WEIGHT = 0.3
+
+# Port the daemon's webhook receiver listens on for Calendar API push notifications by default
+DEFAULT_WEBHOOK_PORT = 8080
+# Lifetime asked for watch channels, which are renewed (by opening a new one) this margin before
+# they expire; channels whose renewal failed are retried after CHANNEL_RENEWAL_RETRY_DELAY
+CHANNEL_TTL = timedelta(days=7)
+CHANNEL_RENEWAL_MARGIN = timedelta(hours=1)
+CHANNEL_RENEWAL_RETRY_DELAY = timedelta(minutes=5)
+
+# Calendar API limit on the number of calls in a single batch request
+BATCH_MAX_SIZE = 50
+# Largest page of calendarList.list, and the only fields of it used
+CALENDAR_LIST_MAX_PAGE_SIZE = 250
+CALENDAR_LIST_FIELDS = "etag,nextPageToken,items(id,summary,accessRole)"
+EVENTS_MAX_PAGE_SIZE = 2500
+EVENT_CHANGES_FIELDS = "items(id,iCalUID,status,recurringEventId),nextPageToken,nextSyncToken"
 
 dirname = os.path.dirname(__file__)
 usage_file_path = os.path.join(dirname, "USAGE.txt")
@@ -44,7 +122,24 @@ class Gcalvault:
         self.clean = False
         self.push_repo = False
         self.no_cache = False
+        self.incremental = False
+        self.conditional = False
+        self.normalize = False
+        self.adaptive = False
+        self.layout = DEFAULT_LAYOUT
+        self.maintenance_commits = DEFAULT_MAINTENANCE_COMMITS
+        self.maintenance_loose_objects = DEFAULT_MAINTENANCE_LOOSE_OBJECTS
         self.ignore_roles = []
+        self.all_users = False
+        self.jobs = DEFAULT_JOBS
+        self.account_jobs = DEFAULT_ACCOUNT_JOBS
+        self.timeout = DEFAULT_TIMEOUT
+        self.qps = DEFAULT_QPS
+        self.schedule = DEFAULT_SCHEDULE
+        self.metrics_file = None
+        self.prometheus_file = None
+        self.webhook_url = None
+        self.webhook_port = DEFAULT_WEBHOOK_PORT
         self.calendars = []
         self.conf_dir = os.path.expanduser("~/.gcalvault")
         self.output_dir = os.getcwd()
@@ -55,28 +150,63 @@ class Gcalvault:
         self.client_secret_file = os.path.join(self.conf_dir, '.client-secret')
 
         self._repo = None
+        self._credentials = None
+        self._calendars_listed_at = None
+        self._synced_calendars = []
+        self._notified_cal_ids = None
+        self._receiver = None
+        self._state = None
+        self._state_file_name = STATE_DB_FILE_NAME
+        self._accounts = {}
+        self._metrics = Metrics()
         self._google_oauth2 = google_oauth2 if google_oauth2 is not None else GoogleOAuth2()
         self._google_apis = google_apis if google_apis is not None else GoogleApis()
+        self._clock = datetime.now
+        self._sleep = time.sleep
 
     def run(self, cli_args):
         self._fetch_env()
         if not self._parse_options(cli_args):
             return
-        getattr(self, self.command)()
+        self._metrics = Metrics(self.metrics_file, self.prometheus_file)
+        if not self.all_users:
+            self._metrics = self._metrics.bind(user=self.user)
+        try:
+            getattr(self, self.command)()
+        finally:
+            self._close_repos()
+            self._close_state()
+            self._metrics.close()
 
     def noop(self):
         self._ensure_dirs()
         pass
 
     def sync(self):
+        if self.all_users:
+            self._sync_accounts()
+            return
+        with self._metrics.phase("sync"):
+            self._sync()
+
+    def _sync(self):
         self._ensure_dirs()
-        credentials = self._get_oauth2_credentials()
+        # The session may be shared with other accounts, so its pool is only ever grown
+        self._google_apis.pool_size = max(self._google_apis.pool_size, self.jobs)
+        self._google_apis.timeout = self.timeout
+        self._google_apis.rate_limiter.qps = self.qps
+        if self._credentials is None or not self._credentials.valid:
+            self._credentials = self._get_oauth2_credentials()
+        credentials = self._credentials
 
-        if not self.export_only:
-            self._repo = GitVaultRepo("gcalvault", self.output_dir, [".ics"])
+        if not self.export_only and self._repo is None:
+            self._repo = GitVaultRepo("gcalvault", self.output_dir, [".ics"], subdirs=self.layout == 'event',
+                                      metrics=self._metrics)
 
-        if self.no_cache and os.path.exists(os.path.join(self.conf_dir, ".etags")): # TODO: Do properly :(
-            os.remove(os.path.join(self.conf_dir, ".etags"))
+        if self._state is None:
+            self._state = StateStore(self.conf_dir, self._state_file_name)
+        if self.no_cache:
+            self._state.clear()
 
         calendars = self._get_calendars_singular(credentials)
 
@@ -91,16 +221,71 @@ class Gcalvault:
             if include not in cal_ids:
                 raise GcalvaultError(f"Specified calendar '{include}' was not found")
 
-        if self.clean:
-            self._clean_output_dir(calendars)
+        try:
+            if self.clean:
+                self._clean_output_dir(calendars)
+
+            self._synced_calendars = calendars
+            if self._notified_cal_ids is not None:
+                notified_cal_ids = self._notified_cal_ids.get(self.user, set())
+                calendars = [cal for cal in calendars if cal.id in notified_cal_ids]
+            elif self.adaptive:
+                calendars = self._due_calendars(calendars)
+            etags = self._request_etags(credentials, [cal.id for cal in calendars])
+            for calendar in calendars:
+                calendar.etag = etags.get(calendar.id)
 
-        self._dl_and_save_calendars(calendars, credentials)
+            self._dl_and_save_calendars(calendars, credentials)
+        except BaseException:
+            if self._repo:
+                # Calendars saved so far are up to date in the state store, keep them for the next commit
+                self._repo.stage()
+            raise
+        if self._receiver is not None:
+            self._watch_calendars(self._synced_calendars, credentials)
 
         if self._repo:
             self._repo.commit(f"gcalvault sync on {datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')} UTC")
+            self._maintain_repo()
             if self.push_repo:
                 self._repo.push()
 
+    def daemon(self):
+        """
+        Stays resident and syncs on the cron schedule in self.schedule (and once
+        at startup), keeping credentials, API clients, HTTP connections, the vault
+        repository and caches warm between syncs. Tokens are refreshed in the
+        background ahead of their expiry, so syncs don't wait on it. A failed sync is reported and
+        retried at the next scheduled time. With self.adaptive, it also wakes up whenever a calendar
+        is due to be checked, and each sync only checks the calendars due. With self.webhook_url,
+        it watches the synced calendars for changes through Calendar API push notifications, and
+        syncs just the calendars Google notifies changes of as they come in.
+        :return: none
+        """
+        schedule = CronSchedule(self.schedule)
+        previous_sigterm_handler = signal.signal(signal.SIGTERM, self._handle_sigterm)
+        self._google_oauth2.start_refreshing()
+        try:
+            if self.webhook_url:
+                from .webhook import WebhookReceiver
+                self._receiver = WebhookReceiver(self.webhook_port)
+                print(f"Listening for calendar change notifications on port {self._receiver.port}")
+            self._sync_reporting_errors()
+            while True:
+                next_run = self._next_run(schedule)
+                print(f"Next sync scheduled at {next_run.strftime('%Y-%m-%d %H:%M')}")
+                notified = self._sleep_until(next_run)
+                if notified:
+                    self._sync_notified(notified)
+                else:
+                    self._sync_reporting_errors()
+        finally:
+            signal.signal(signal.SIGTERM, previous_sigterm_handler)
+            if self._receiver is not None:
+                self._receiver.close()
+            self._google_oauth2.close()
+            self._google_apis.close()
+
     @staticmethod
     def usage():
         return pathlib.Path(usage_file_path).read_text().strip()
@@ -110,16 +295,40 @@ class Gcalvault:
         return pathlib.Path(version_file_path).read_text().strip()
 
     def _fetch_env(self):
-        print(os.environ)
         self.export_only = (os.getenv("EXPORT_ONLY") or "false").lower() == "true"
-        self.ignore_roles.append((os.getenv("IGNORE_ROLES") or "").split(","))
-        self.conf_dir = os.getenv("CONF_DIR") or self.conf_dir
-        self.output_dir = os.getenv("OUTPUT_DIR") or self.output_dir
+        self.ignore_roles.extend(role.strip().lower() for role in (os.getenv("IGNORE_ROLES") or "").split(",")
+                                 if role.strip())
+        self.conf_dir = self._parse_dir(os.getenv("CONF_DIR")) if os.getenv("CONF_DIR") else self.conf_dir
+        self.output_dir = self._parse_dir(os.getenv("OUTPUT_DIR")) if os.getenv("OUTPUT_DIR") else self.output_dir
         self.client_id = os.getenv("CLIENT_ID") or self.client_id
         self.client_secret = os.getenv("CLIENT_SECRET") or self.client_secret
         self.command = os.getenv("TASK_COMMAND") or self.command
         self.push_repo = (os.getenv("PUSH_REPO") or "false").lower() == "true"
         self.no_cache = (os.getenv("NO_CACHE") or "false").lower() == "true"
+        self.incremental = (os.getenv("INCREMENTAL") or "false").lower() == "true"
+        self.conditional = (os.getenv("CONDITIONAL") or "false").lower() == "true"
+        self.normalize = (os.getenv("NORMALIZE") or "false").lower() == "true"
+        self.adaptive = (os.getenv("ADAPTIVE") or "false").lower() == "true"
+        self.layout = self._parse_layout(os.getenv("LAYOUT")) if os.getenv("LAYOUT") else self.layout
+        self.maintenance_commits = self._parse_maintenance_threshold(os.getenv("MAINTENANCE_COMMITS")) \
+            if os.getenv("MAINTENANCE_COMMITS") else self.maintenance_commits
+        self.maintenance_loose_objects = self._parse_maintenance_threshold(os.getenv("MAINTENANCE_LOOSE_OBJECTS")) \
+            if os.getenv("MAINTENANCE_LOOSE_OBJECTS") else self.maintenance_loose_objects
+        self.all_users = (os.getenv("ALL_USERS") or "false").lower() == "true"
+        self.jobs = self._parse_jobs(os.getenv("JOBS")) if os.getenv("JOBS") else self.jobs
+        self.account_jobs = self._parse_jobs(os.getenv("ACCOUNT_JOBS")) if os.getenv("ACCOUNT_JOBS") \
+            else self.account_jobs
+        self.timeout = self._parse_timeout(os.getenv("TIMEOUT")) if os.getenv("TIMEOUT") else self.timeout
+        self.qps = self._parse_qps(os.getenv("QPS")) if os.getenv("QPS") else self.qps
+        self.schedule = self._parse_schedule(os.getenv("EXECAT")) if os.getenv("EXECAT") else self.schedule
+        self.metrics_file = self._parse_dir(os.getenv("METRICS_FILE")) if os.getenv("METRICS_FILE") \
+            else self.metrics_file
+        self.prometheus_file = self._parse_dir(os.getenv("PROMETHEUS_FILE")) if os.getenv("PROMETHEUS_FILE") \
+            else self.prometheus_file
+        self.webhook_url = self._parse_webhook_url(os.getenv("WEBHOOK_URL")) if os.getenv("WEBHOOK_URL") \
+            else self.webhook_url
+        self.webhook_port = self._parse_port(os.getenv("WEBHOOK_PORT")) if os.getenv("WEBHOOK_PORT") \
+            else self.webhook_port
 
     def _parse_options(self, cli_args):
         show_help = show_version = authenticate = False
@@ -127,11 +336,14 @@ class Gcalvault:
         try:
             (opts, pos_args) = gnu_getopt(
                 cli_args,
-                'aefi:c:o:h',
-                ['export-only', 'clean', 'ignore-role=',
+                'aefi:c:o:j:h',
+                ['export-only', 'clean', 'ignore-role=', 'jobs=', 'account-jobs=', 'all-users', 'timeout=', 'qps=', 'schedule=', 'layout=',
+                 'maintenance-commits=', 'maintenance-loose-objects=', 'metrics-file=', 'prometheus-file=',
+                 'webhook-url=', 'webhook-port=',
                  'conf-dir=', 'output-dir=', 'vault-dir=',
                  'client-id=', 'client-secret=',
-                 'help', 'version', 'auth', 'push', 'no-cache',]
+                 'help', 'version', 'auth', 'push', 'no-cache', 'incremental', 'conditional',
+                 'normalize', 'adaptive',]
             )
         except GetoptError as e:
             raise GcalvaultError(e) from e
@@ -145,15 +357,49 @@ class Gcalvault:
                 self.push_repo = True
             elif opt in ['--no-cache']:
                 self.no_cache = True
+            elif opt in ['--incremental']:
+                self.incremental = True
+            elif opt in ['--conditional']:
+                self.conditional = True
+            elif opt in ['--normalize']:
+                self.normalize = True
+            elif opt in ['--adaptive']:
+                self.adaptive = True
             elif opt in ['-i', '--ignore-role']:
                 self.ignore_roles.append(val.lower())
+            elif opt in ['-j', '--jobs']:
+                self.jobs = self._parse_jobs(val)
+            elif opt in ['--account-jobs']:
+                self.account_jobs = self._parse_jobs(val)
+            elif opt in ['--all-users']:
+                self.all_users = True
+            elif opt in ['--timeout']:
+                self.timeout = self._parse_timeout(val)
+            elif opt in ['--qps']:
+                self.qps = self._parse_qps(val)
+            elif opt in ['--schedule']:
+                self.schedule = self._parse_schedule(val)
+            elif opt in ['--layout']:
+                self.layout = self._parse_layout(val)
+            elif opt in ['--maintenance-commits']:
+                self.maintenance_commits = self._parse_maintenance_threshold(val)
+            elif opt in ['--maintenance-loose-objects']:
+                self.maintenance_loose_objects = self._parse_maintenance_threshold(val)
+            elif opt in ['--metrics-file']:
+                self.metrics_file = self._parse_dir(val)
+            elif opt in ['--prometheus-file']:
+                self.prometheus_file = self._parse_dir(val)
+            elif opt in ['--webhook-url']:
+                self.webhook_url = self._parse_webhook_url(val)
+            elif opt in ['--webhook-port']:
+                self.webhook_port = self._parse_port(val)
             elif opt in ['-c', '--conf-dir']:
-                self.conf_dir = val
+                self.conf_dir = self._parse_dir(val)
                 self.userfile_path = os.path.join(self.conf_dir, '.user')
                 self.client_id_file = os.path.join(self.conf_dir, '.client-id')
                 self.client_secret_file = os.path.join(self.conf_dir, '.client-secret')
             elif opt in ['-o', '--output-dir', '--vault-dir']:
-                self.output_dir = val
+                self.output_dir = self._parse_dir(val)
             elif opt in ['--client-id']:
                 self.client_id = val
             elif opt in ['--client-secret']:
@@ -190,11 +436,159 @@ class Gcalvault:
             raise GcalvaultError("<command> argument is required")
         if self.command not in COMMANDS:
             raise GcalvaultError("Invalid <command> argument")
-        if self.user is None:
+        if self.all_users:
+            if len(pos_args) >= 2:
+                raise GcalvaultError("<user> and <cal-ids> arguments can't be combined with --all-users")
+        elif self.user is None:
             raise GcalvaultError("<user> argument is required")
 
         return True
 
+    @staticmethod
+    def _parse_jobs(val):
+        try:
+            jobs = int(val)
+        except ValueError as e:
+            raise GcalvaultError(f"Invalid jobs value '{val}'") from e
+        if jobs < 1:
+            raise GcalvaultError(f"Invalid jobs value '{val}', must be at least 1")
+        return jobs
+
+    @staticmethod
+    def _parse_timeout(val):
+        try:
+            timeout = float(val)
+        except ValueError as e:
+            raise GcalvaultError(f"Invalid timeout value '{val}'") from e
+        if timeout <= 0:
+            raise GcalvaultError(f"Invalid timeout value '{val}', must be greater than 0")
+        return timeout
+
+    @staticmethod
+    def _parse_qps(val):
+        try:
+            qps = float(val)
+        except ValueError as e:
+            raise GcalvaultError(f"Invalid qps value '{val}'") from e
+        if qps < 0:
+            raise GcalvaultError(f"Invalid qps value '{val}', must be at least 0")
+        return qps
+
+    @staticmethod
+    def _parse_schedule(val):
+        try:
+            CronSchedule(val)
+        except ValueError as e:
+            raise GcalvaultError(f"Invalid schedule: {e}") from e
+        return val
+
+    @staticmethod
+    def _parse_layout(val):
+        if val.lower() not in LAYOUTS:
+            raise GcalvaultError(f"Invalid layout '{val}', must be one of {', '.join(LAYOUTS)}")
+        return val.lower()
+
+    @staticmethod
+    def _parse_dir(val):
+        # GitPython changes the process' working directory while adding files to an index,
+        # so relative paths would be resolved against the wrong directory by other threads
+        return os.path.abspath(val)
+
+    @staticmethod
+    def _parse_maintenance_threshold(val):
+        try:
+            threshold = int(val)
+        except ValueError as e:
+            raise GcalvaultError(f"Invalid maintenance threshold '{val}'") from e
+        if threshold < 0:
+            raise GcalvaultError(f"Invalid maintenance threshold '{val}', must be 0 (never) or more")
+        return threshold
+
+    @staticmethod
+    def _parse_webhook_url(val):
+        # Google only delivers notifications over HTTPS
+        if not val.lower().startswith("https://"):
+            raise GcalvaultError(f"Invalid webhook URL '{val}', must be an https:// URL")
+        return val
+
+    @staticmethod
+    def _parse_port(val):
+        try:
+            port = int(val)
+        except ValueError as e:
+            raise GcalvaultError(f"Invalid port '{val}'") from e
+        if not 1 <= port <= 65535:
+            raise GcalvaultError(f"Invalid port '{val}', must be between 1 and 65535")
+        return port
+
+    def _close_state(self):
+        if self._state is not None:
+            self._state.close()
+            self._state = None
+        for account in self._accounts.values():
+            account._close_state()
+
+    def _sync_reporting_errors(self):
+        try:
+            self.sync()
+        except Exception as e:
+            traceback.print_exc()
+            print(f"gcalvault: Sync failed: {e}", file=sys.stderr)
+        finally:
+            self._metrics.write_prometheus()
+
+    def _next_run(self, schedule):
+        """
+        :param schedule: CronSchedule
+        :return: datetime of the daemon's next sync: the next scheduled one, or earlier when
+                 a calendar is due to be checked (with self.adaptive) or a watch channel renewed
+        """
+        next_run = schedule.next_run(self._clock())
+        next_check = self._next_check_time() if self.adaptive else None
+        if next_check is not None:
+            # Calendars still due after a sync (e.g. failed downloads) are retried after a pause
+            next_run = min(next_run, max(next_check, self._clock() + ADAPTIVE_MIN_INTERVAL))
+        next_renewal = self._next_time('_channel_renewal') if self._receiver is not None else None
+        if next_renewal is not None:
+            next_run = min(next_run, max(next_renewal, self._clock() + CHANNEL_RENEWAL_RETRY_DELAY))
+        return next_run
+
+    def _sleep_until(self, wake_time):
+        """
+        Sleeps until the given time, or until Google notifies changes of watched calendars
+        :param wake_time: datetime
+        :return: set<(str, str)> of the user and ID of each calendar notified, empty if none were
+        """
+        while True:
+            remaining = (wake_time - self._clock()).total_seconds()
+            if remaining <= 0:
+                return set()
+            if self._receiver is None:
+                self._sleep(min(remaining, DAEMON_MAX_SLEEP))
+                continue
+            notified = self._receiver.wait(min(remaining, DAEMON_MAX_SLEEP))
+            if notified:
+                return notified
+
+    def _sync_notified(self, notified):
+        """
+        Syncs just the calendars Google notified changes of (of any user, with --all-users)
+        :param notified: set<(str, str)> of the user and ID of each calendar notified
+        :return: none
+        """
+        self._notified_cal_ids = {}
+        for (user, cal_id) in notified:
+            self._notified_cal_ids.setdefault(user, set()).add(cal_id)
+        print(f"Syncing {len(notified)} calendar(s) with changes notified by Google")
+        try:
+            self._sync_reporting_errors()
+        finally:
+            self._notified_cal_ids = None
+
+    @staticmethod
+    def _handle_sigterm(signum, frame):
+        raise SystemExit(0)
+
     def _authenticate(self):
         """
         Prompt user for email and authenticate with Google,
@@ -206,6 +600,7 @@ class Gcalvault:
         if os.path.exists(token_file_path):
             print(f"Removing existing configuration {self.user}.token.json...")
             os.remove(token_file_path)
+        self._google_oauth2.forget_credentials(token_file_path)
         self.user = None
         while self.user is None:
             self.user = input("Enter your google account email: ")
@@ -231,6 +626,91 @@ class Gcalvault:
         for directory in [self.conf_dir, self.output_dir]:
             pathlib.Path(directory).mkdir(parents=True, exist_ok=True)
 
+    def _sync_accounts(self):
+        """
+        Syncs each of the users listed in the config dir's users file, running up
+        to self.account_jobs accounts at a time (each downloading up to self.jobs
+        calendars at a time), with all of them sharing the same HTTP connection
+        pools. Every account is saved to a vault of its own, in a subdirectory of
+        the output dir named after the user, and keeps its own sync state.
+        Accounts are kept between syncs, so the daemon reuses their state.
+        :return: none
+        """
+        self._ensure_dirs()
+        users = self._read_users()
+        # Set before any account opens the shared session, which is sized from it
+        self._google_apis.pool_size = self.jobs * min(self.account_jobs, len(users))
+        if self._notified_cal_ids is not None:
+            users = [user for user in users if user in self._notified_cal_ids]
+        for user in users:
+            self._account(user)._notified_cal_ids = self._notified_cal_ids
+        failed_users = []
+        with ThreadPoolExecutor(max_workers=self.account_jobs) as executor:
+            futures = {executor.submit(self._account(user).sync): user for user in users}
+            for future in as_completed(futures):
+                user = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"gcalvault: Sync failed for user '{user}': {e}", file=sys.stderr)
+                    failed_users.append(user)
+        if failed_users:
+            raise GcalvaultError(f"Sync failed for {len(failed_users)} of {len(users)} user(s): "
+                                 f"{', '.join(sorted(failed_users))}")
+
+    def _read_users(self):
+        users_file_path = os.path.join(self.conf_dir, USERS_FILE_NAME)
+        if not os.path.exists(users_file_path):
+            raise GcalvaultError(f"--all-users requires a list of users in '{users_file_path}'")
+        with open(users_file_path) as file:
+            users = [line.strip().lower() for line in file if line.strip() and not line.strip().startswith("#")]
+        if not users:
+            raise GcalvaultError(f"No users listed in '{users_file_path}'")
+        return list(dict.fromkeys(users))
+
+    def _account(self, user):
+        account = self._accounts.get(user)
+        if account is None:
+            account = Gcalvault(google_oauth2=self._google_oauth2, google_apis=self._google_apis)
+            for option in ACCOUNT_OPTIONS:
+                setattr(account, option, getattr(self, option))
+            account.ignore_roles = list(self.ignore_roles)
+            account.command = 'sync'
+            account.user = user
+            account.output_dir = os.path.join(self.output_dir, user)
+            account._state_file_name = ACCOUNT_STATE_DB_FILE_NAME_FORMAT.format(user=user)
+            account._metrics = self._metrics.bind(user=user)
+            account._receiver = self._receiver
+            # Due times of all accounts are compared against this instance's clock
+            account._clock = self._clock
+            self._accounts[user] = account
+        return account
+
+    def _close_repos(self):
+        # Waits for pushes still running in the background
+        if self._repo:
+            self._repo.close()
+        for account in self._accounts.values():
+            account._close_repos()
+
+    def _maintain_repo(self):
+        """
+        Runs maintenance on the vault repository when its policy says it's due,
+        recording the run (and how long it took) in the state store
+        :return: none
+        """
+        last_run = self._state.last_maintenance_run()
+        reason = self._repo.maintenance_reason(
+            last_run['head'] if last_run else None, self.maintenance_commits, self.maintenance_loose_objects)
+        if reason is None:
+            return
+        (started, started_monotonic) = (time.time(), time.monotonic())
+        with self._metrics.phase("git_maintenance", reason=reason):
+            head = self._repo.maintain()
+        duration = time.monotonic() - started_monotonic
+        self._state.record_maintenance_run(head, reason, started, duration)
+        print(f"Maintained gcalvault repository in {duration:.1f}s ({reason})")
+
     def _get_oauth2_credentials(self):
         token_file_path = os.path.join(self.conf_dir, f"{self.user}.token.json")
 
@@ -250,6 +730,7 @@ class Gcalvault:
             if self.user != profile_email:
                 if os.path.exists(token_file_path):
                     os.remove(token_file_path)
+                self._google_oauth2.forget_credentials(token_file_path)
                 raise GcalvaultError(
                     f"Authenticated user - {profile_email} - was different than <user> argument specified")
             with open(self.userfile_path, 'w') as f:
@@ -259,61 +740,424 @@ class Gcalvault:
         return credentials
 
     def _get_calendars(self, credentials):
+        """
+        Lists the user's calendars, conditional on the etag of the calendar list
+        cached in the state store, so an unchanged list costs a single request
+        answered with 304 Not Modified
+        :param credentials: Google API credentials
+        :return: list<Calendar>
+        """
         calendars = []
-        calendar_list = self._google_apis.request_cal_list(credentials)
+        with self._metrics.phase("list_calendars") as phase:
+            cached_list = self._state.last_calendar_list()
+            calendar_list = self._google_apis.request_cal_list(
+                credentials, cached_list['etag'] if cached_list else None)
+            if calendar_list is None:
+                calendar_list = cached_list
+                phase['status'] = "not_modified"
+            else:
+                self._state.record_calendar_list(calendar_list.get('etag'), calendar_list['items'])
+            phase['calendars'] = len(calendar_list['items'])
         for item in calendar_list['items']:
-            cal_details = self._google_apis.request_cal_details(credentials, item['id'])
             calendars.append(
-                Calendar(item['id'], item['summary'], cal_details['etag'], item['accessRole']))
+                Calendar(item['id'], item['summary'], None, item['accessRole']))
         return calendars
 
     def _get_calendars_singular(self, credentials):
         """
-        Updates the etag in the stored calendar list
+        Returns the stored calendar list, listing the user's calendars again
+        if it's missing or older than CALENDAR_LIST_MAX_AGE. Etags are left
+        to be requested for the calendars actually checked
         :param credentials: Google API credentials
         :return: list<Calendar>
         """
-        if len(self.calendars) == 0 or self.no_cache:
+        if len(self.calendars) == 0 or self.no_cache or \
+                self._clock() - self._calendars_listed_at > CALENDAR_LIST_MAX_AGE:
             self.calendars = self._get_calendars(credentials)
-            return self.calendars
-        for calendar in self.calendars:
-            cal_details = self._google_apis.request_cal_details(credentials, calendar.id)
-            calendar.etag = cal_details['etag']
+            self._calendars_listed_at = self._clock()
         return self.calendars
 
+    def _request_etags(self, credentials, cal_ids):
+        if self.incremental or self.conditional or not cal_ids:
+            # Changes are detected through sync tokens or conditional downloads instead
+            return {}
+        with self._metrics.phase("details", calendars=len(cal_ids)):
+            cal_details = self._google_apis.request_cal_details_batch(credentials, cal_ids)
+        return {cal_id: details['etag'] for (cal_id, details) in cal_details.items()}
+
     def _clean_output_dir(self, calendars):
-        cal_file_names = [cal.file_name for cal in calendars]
-        file_names_on_disk = [os.path.basename(file).lower() for file in
-                              glob.glob(os.path.join(self.output_dir, "*.ics"))]
-        for file_name_on_disk in file_names_on_disk:
-            if file_name_on_disk not in cal_file_names:
-                os.remove(os.path.join(self.output_dir, file_name_on_disk))
+        cal_names = [os.path.basename(self._calendar_path(cal)) for cal in calendars]
+        # Calendars are either .ics files or (in the event layout) directories of them
+        names_on_disk = [os.path.basename(file).lower() for file in
+                         glob.glob(os.path.join(self.output_dir, "*.ics"))]
+        names_on_disk += sorted({os.path.basename(os.path.dirname(file)).lower() for file in
+                                 glob.glob(os.path.join(self.output_dir, "*", "*.ics"))})
+        for name_on_disk in names_on_disk:
+            if name_on_disk not in cal_names:
+                path_on_disk = os.path.join(self.output_dir, name_on_disk)
+                if os.path.isdir(path_on_disk):
+                    shutil.rmtree(path_on_disk)
+                else:
+                    os.remove(path_on_disk)
                 if self._repo:
-                    self._repo.remove_file(file_name_on_disk)
-                print(f"Removed file '{file_name_on_disk}'")
+                    self._repo.remove_file(name_on_disk)
+                print(f"Removed file '{name_on_disk}'")
 
     def _dl_and_save_calendars(self, calendars, credentials):
-        etags = ETagManager(self.conf_dir)
-        for calendar in calendars:
-            self._dl_and_save_calendar(calendar, credentials, etags)
+        """
+        Downloads changed calendars in parallel (bounded by self.jobs), while
+        state bookkeeping and git staging stay on the calling thread
+        :param calendars: list<Calendar>
+        :param credentials: Google API credentials
+        :return: none
+        """
+        try:
+            changes = self._request_changes(calendars, credentials) if self.incremental else {}
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                futures = {}
+                for calendar in calendars:
+                    if self.incremental:
+                        if self._apply_changes(calendar, changes.get(calendar.id)):
+                            continue
+                    elif not self.conditional and self._is_up_to_date(calendar):
+                        print(f"Calendar '{calendar.name}' is up to date")
+                        self._record_check(calendar, changed=False)
+                        continue
+                    print(f"Downloading calendar '{calendar.name}'")
+                    future = executor.submit(self._download_calendar, calendar, credentials)
+                    futures[future] = calendar
+
+                # State is only updated for calendars whose download succeeded
+                error = None
+                for future in as_completed(futures):
+                    calendar = futures[future]
+                    try:
+                        (download, previous_hash, duration, event_changes, new_sync_token) = future.result()
+                    except Exception as e:
+                        print(f"Failed to download calendar '{calendar.name}'")
+                        error = error or e
+                        continue
+                    self._state.commit(calendar.id)
+                    self._state.update(calendar.id, last_fetched=time.time(), last_duration=duration)
+                    if new_sync_token:
+                        self._state.update(calendar.id, sync_token=new_sync_token)
+                    if download is None:
+                        print(f"Calendar '{calendar.name}' is up to date")
+                        self._record_check(calendar, changed=False)
+                        continue
+                    (size, validators, content_hash) = download
+                    self._state.update(
+                        calendar.id, byte_size=size, content_hash=content_hash,
+                        caldav_etag=validators.get('etag'), caldav_last_modified=validators.get('last_modified'))
+                    self._record_check(calendar, changed=content_hash != previous_hash)
+                    if content_hash == previous_hash:
+                        print(f"Calendar '{calendar.name}' is unchanged")
+                        continue
+                    self._saved_calendar(calendar, event_changes)
+                if error:
+                    raise error
+        finally:
+            self._state.flush()
+
+    def _download_calendar(self, calendar, credentials):
+        """
+        Downloads a calendar's .ics file, conditional on the validators from
+        its previous download if the file is still there, and leaving the file
+        untouched if its content hasn't changed. In the event layout, the
+        download is then split into the calendar's event files. With
+        self.incremental, a new sync token is taken first, in the same worker,
+        since listing a calendar's events for one pages through all of them.
+        :param calendar: Calendar
+        :param credentials: Google API credentials
+        :return: (object, str, float, tuple, str) of save_cal_as_ical's result, the hash of the
+                 calendar's previous content, the download's duration in seconds, the result
+                 of _save_event_files (None unless event files were saved), and the calendar's
+                 new sync token (None unless self.incremental)
+        """
+        new_sync_token = None
+        if self.incremental:
+            # Token is taken before the download, so changes made during it are picked up next time
+            new_sync_token = self._google_apis.request_cal_sync_token(credentials, calendar.id)
+        cal_path = self._calendar_path(calendar)
+        state = self._state.get(calendar.id)
+        (validators, content_hash) = (None, None)
+        if os.path.exists(cal_path):
+            validators = {'etag': state['caldav_etag'], 'last_modified': state['caldav_last_modified']}
+            content_hash = state['content_hash']
+        download_path = cal_path
+        if self.layout == 'event':
+            os.makedirs(cal_path, exist_ok=True)
+            download_path = os.path.join(cal_path, EVENTS_DOWNLOAD_FILE_NAME)
+        started = time.monotonic()
+        with self._metrics.phase("download", calendar=calendar.id) as phase:
+            download = self._google_apis.save_cal_as_ical(
+                calendar.id, credentials, download_path, validators, content_hash, self.normalize)
+            if download is None:
+                phase['status'] = "not_modified"
+            else:
+                phase['bytes'] = download[0]
+                phase['changed'] = download[2] != content_hash
+        duration = time.monotonic() - started
+        event_changes = None
+        if download_path != cal_path and os.path.exists(download_path):
+            with self._metrics.phase("write", calendar=calendar.id) as phase:
+                event_changes = self._save_event_files(calendar, download_path)
+                (phase['written'], phase['removed']) = (len(event_changes[0]), len(event_changes[1]))
+        return (download, content_hash, duration, event_changes, new_sync_token)
+
+    def _save_event_files(self, calendar, download_path):
+        """
+        Splits a downloaded calendar into its directory of event files, only
+        writing the files whose content changed and removing those of events
+        no longer in the calendar
+        :param calendar: Calendar
+        :param download_path: Path of the downloaded .ics file, which is removed
+        :return: (list<str>, list<str>) of the written and removed files, relative to the output dir
+        """
+        cal_path = self._calendar_path(calendar)
+        stale_file_names = {file_name for file_name in os.listdir(cal_path) if file_name.endswith(".ics")}
+        written_file_names = []
+        try:
+            with open(download_path, 'r', encoding='utf-8', newline='') as file:
+                for (uid, lines) in ical.split_events(file):
+                    file_name = self._event_file_name(uid)
+                    stale_file_names.discard(file_name)
+                    event_file_path = os.path.join(cal_path, file_name)
+                    content = "".join(lines).encode('utf-8')
+                    if os.path.exists(event_file_path) and pathlib.Path(event_file_path).read_bytes() == content:
+                        continue
+                    pathlib.Path(event_file_path).write_bytes(content)
+                    written_file_names.append(file_name)
+        finally:
+            os.remove(download_path)
+        for file_name in stale_file_names:
+            os.remove(os.path.join(cal_path, file_name))
+        return ([os.path.join(calendar.dir_name, file_name) for file_name in written_file_names],
+                [os.path.join(calendar.dir_name, file_name) for file_name in sorted(stale_file_names)])
+
+    @staticmethod
+    def _event_file_name(uid):
+        file_name = urllib.parse.quote(uid, safe="@.-_") or "_"
+        if len(file_name) > EVENT_FILE_NAME_MAX_LENGTH:
+            file_name = hashlib.sha256(uid.encode('utf-8')).hexdigest()
+        return f"{file_name}.ics"
+
+    def _calendar_path(self, calendar):
+        name = calendar.dir_name if self.layout == 'event' else calendar.file_name
+        return os.path.join(self.output_dir, name)
 
-    def _dl_and_save_calendar(self, calendar, credentials, etags):
-        cal_file_path = os.path.join(self.output_dir, calendar.file_name)
+    def _request_changes(self, calendars, credentials):
+        cal_sync_tokens = {}
+        for calendar in calendars:
+            sync_token = self._state.get(calendar.id)['sync_token']
+            if sync_token and os.path.exists(self._calendar_path(calendar)):
+                cal_sync_tokens[calendar.id] = sync_token
+        with self._metrics.phase("changes", calendars=len(cal_sync_tokens)):
+            return self._google_apis.request_cal_changes_batch(credentials, cal_sync_tokens)
 
-        etag_changed = etags.test_for_change_and_save(calendar.id, calendar.etag)
-        if os.path.exists(cal_file_path) and not etag_changed:
+    def _apply_changes(self, calendar, changes):
+        """
+        Brings a calendar's .ics file up to date from the events changed since
+        its last sync, if possible without downloading it again: when nothing
+        changed, or when whole events were only deleted (which are then removed
+        from the file in place, or in the event layout have their files removed)
+        :param calendar: Calendar
+        :param changes: (list<dict>, str) of changed events and next sync token, or
+                        None if there's no valid sync token for the calendar
+        :return: True if the calendar is up to date, False if it must be downloaded
+        """
+        if changes is None:
+            return False
+        (events, next_sync_token) = changes
+        if events:
+            uids = self._deleted_event_uids(events)
+            if uids is None:
+                return False
+            with self._metrics.phase("write", calendar=calendar.id, removed=len(uids)) as phase:
+                if not self._remove_events(calendar, uids):
+                    phase['status'] = "skipped"
+                    return False
+            print(f"Removed {len(uids)} deleted event(s) from calendar '{calendar.name}'")
+            # Files no longer match the downloaded content they were hashed from
+            self._state.update(calendar.id, content_hash=None)
+        else:
             print(f"Calendar '{calendar.name}' is up to date")
-            return
+        self._state.update(calendar.id, sync_token=next_sync_token)
+        self._record_check(calendar, changed=bool(events))
+        return True
+
+    def _remove_events(self, calendar, uids):
+        if self.layout == 'calendar':
+            if not ical.remove_events(self._calendar_path(calendar), uids):
+                return False
+            if self._repo:
+                self._repo.add_file(calendar.file_name)
+            return True
+        event_file_names = [os.path.join(calendar.dir_name, self._event_file_name(uid)) for uid in uids]
+        if not all(os.path.exists(os.path.join(self.output_dir, file_name)) for file_name in event_file_names):
+            return False
+        for file_name in event_file_names:
+            os.remove(os.path.join(self.output_dir, file_name))
+            if self._repo:
+                self._repo.remove_file(file_name)
+        return True
+
+    @staticmethod
+    def _deleted_event_uids(events):
+        uids = set()
+        for event in events:
+            # Anything other than a whole event being deleted needs the event's new content
+            if event.get('status') != "cancelled" or event.get('recurringEventId'):
+                return None
+            uids.add(event.get('iCalUID') or f"{event['id']}@google.com")
+        return uids
+
+    def _record_check(self, calendar, changed):
+        """
+        Adds a successful check of a calendar to its change history: when it
+        changed, the time since its previous change goes into the moving
+        average of the intervals between its changes. A calendar's first check
+        starts its history, as if it changed then.
+        :param calendar: Calendar
+        :param changed: True if the calendar's content changed since its last check
+        :return: none
+        """
+        now = self._clock().timestamp()
+        values = {'last_checked': now}
+        state = self._state.get(calendar.id)
+        if changed and state['last_changed'] is not None:
+            interval = now - state['last_changed']
+            values['change_interval'] = interval if state['change_interval'] is None else \
+                CHANGE_INTERVAL_WEIGHT * interval + (1 - CHANGE_INTERVAL_WEIGHT) * state['change_interval']
+        if changed or state['last_changed'] is None:
+            values['last_changed'] = now
+        self._state.update(calendar.id, **values)
+
+    def _next_check(self, calendar):
+        """
+        Picks when a calendar is next due to be checked from its change history
+        (see ADAPTIVE_INTERVAL_FACTOR), so calendars edited often are checked
+        often and dormant ones ever more rarely. Calendars never checked, or
+        whose files are missing, are due right away.
+        :param calendar: Calendar
+        :return: float, time the calendar is due (seconds since the epoch)
+        """
+        state = self._state.get(calendar.id)
+        if state['last_checked'] is None or not os.path.exists(self._calendar_path(calendar)):
+            return 0.0
+        interval = max(state['change_interval'] or 0.0, state['last_checked'] - state['last_changed'])
+        interval = min(max(interval * ADAPTIVE_INTERVAL_FACTOR, ADAPTIVE_MIN_INTERVAL.total_seconds()),
+                       ADAPTIVE_MAX_INTERVAL.total_seconds())
+        return state['last_checked'] + interval
 
-        print(f"Downloading calendar '{calendar.name}'")
-        ical = self._google_apis.request_cal_as_ical(calendar.id, credentials)
+    def _due_calendars(self, calendars):
+        now = self._clock().timestamp()
+        due_calendars = [calendar for calendar in calendars if self._next_check(calendar) <= now]
+        if len(due_calendars) < len(calendars):
+            print(f"Skipping {len(calendars) - len(due_calendars)} calendar(s) not yet due to be checked")
+        return due_calendars
 
-        with open(cal_file_path, 'w') as file:
-            file.write(ical)
-        print(f"Saved calendar '{calendar.id}'")
+    def _next_check_time(self):
+        """
+        :return: datetime at which the next of the synced calendars (of any user, with
+                 --all-users) is due to be checked, or None if none were synced yet
+        """
+        return self._next_time('_next_check')
+
+    def _next_time(self, calendar_time_name):
+        """
+        :param calendar_time_name: Name of the method taking a Calendar and returning a time (seconds
+                                   since the epoch) or None, looked up on each account with --all-users
+                                   so that it reads that account's state
+        :return: datetime of the earliest of those times across the synced calendars (of any
+                 user, with --all-users), or None if there are none
+        """
+        if self.all_users:
+            times = [account._next_time(calendar_time_name) for account in self._accounts.values()]
+        else:
+            calendar_time = getattr(self, calendar_time_name)
+            times = [calendar_time(calendar) for calendar in self._synced_calendars]
+            times = [datetime.fromtimestamp(time) for time in times if time is not None]
+        times = [time for time in times if time is not None]
+        return min(times) if times else None
+
+    def _watch_calendars(self, calendars, credentials):
+        """
+        Makes sure the webhook receiver is notified of changes to each of the
+        calendars: channels opened before (e.g. by a previous run) are
+        registered with it, and new channels are opened for calendars without
+        one or whose channel is about to expire, replacing it. Failures to open
+        a channel are reported, leaving the calendar to the schedule.
+        :param calendars: list<Calendar>
+        :param credentials: Google API credentials
+        :return: none
+        """
+        now = self._clock().timestamp()
+        opened = 0
+        with self._metrics.phase("watch", calendars=len(calendars)) as phase:
+            for calendar in calendars:
+                state = self._state.get(calendar.id)
+                if state['channel_id'] and \
+                        state['channel_expiration'] - CHANNEL_RENEWAL_MARGIN.total_seconds() > now:
+                    self._receiver.register(state['channel_id'], state['channel_token'], (self.user, calendar.id))
+                    continue
+                (channel_id, token) = (str(uuid.uuid4()), secrets.token_urlsafe(32))
+                # Registered up front, since Google confirms a new channel with a notification right away
+                self._receiver.register(channel_id, token, (self.user, calendar.id))
+                try:
+                    channel = self._google_apis.watch_calendar(
+                        credentials, calendar.id, channel_id, self.webhook_url, token, CHANNEL_TTL)
+                except Exception as e:
+                    self._receiver.unregister(channel_id)
+                    print(f"Failed to watch calendar '{calendar.name}': {e}", file=sys.stderr)
+                    phase['status'] = "error"
+                    continue
+                if state['channel_id']:
+                    self._stop_channel(state, credentials)
+                self._state.update(
+                    calendar.id, channel_id=channel_id, channel_resource_id=channel['resourceId'],
+                    channel_token=token, channel_expiration=int(channel['expiration']) / 1000)
+                opened += 1
+            phase['opened'] = opened
+        self._state.flush()
+        if opened:
+            print(f"Watching {opened} calendar(s) for changes")
+
+    def _stop_channel(self, state, credentials):
+        self._receiver.unregister(state['channel_id'])
+        try:
+            self._google_apis.stop_channel(credentials, state['channel_id'], state['channel_resource_id'])
+        except Exception as e:
+            # Left to expire on its own, its notifications now being refused
+            print(f"Failed to stop watch channel '{state['channel_id']}': {e}", file=sys.stderr)
 
+    def _channel_renewal(self, calendar):
+        state = self._state.get(calendar.id)
+        if not state['channel_id']:
+            return None
+        return state['channel_expiration'] - CHANNEL_RENEWAL_MARGIN.total_seconds()
+
+    def _is_up_to_date(self, calendar):
+        etag_changed = self._state.get(calendar.id)['etag'] != calendar.etag
+        if etag_changed:
+            self._state.stage(calendar.id, etag=calendar.etag)
+        return os.path.exists(self._calendar_path(calendar)) and not etag_changed
+
+    def _saved_calendar(self, calendar, event_changes=None):
+        if event_changes is None:
+            print(f"Saved calendar '{calendar.id}'")
+            if self._repo:
+                self._repo.add_file(calendar.file_name)
+            return
+
+        (written_file_names, removed_file_names) = event_changes
+        print(f"Saved calendar '{calendar.id}' ({len(written_file_names)} event(s) written, "
+              f"{len(removed_file_names)} removed)")
         if self._repo:
-            self._repo.add_file(calendar.file_name)
+            for file_name in written_file_names:
+                self._repo.add_file(file_name)
+            for file_name in removed_file_names:
+                self._repo.remove_file(file_name)
 
 
 class GcalvaultError(RuntimeError):
@@ -328,29 +1172,331 @@ class Calendar:
         self.etag = etag
         self.access_role = access_role
 
-        self.file_name = f"{self.id.strip().lower()}.ics"
+        self.dir_name = self.id.strip().lower()
+        self.file_name = f"{self.dir_name}.ics"
 
 
 class GoogleApis:
 
-    @staticmethod
-    def request_cal_details(credentials, cal_id):
-        with build('calendar', 'v3', credentials=credentials) as service:
-            return service.events().list(calendarId=cal_id, maxResults=1).execute()
-            #return service.calendars().get(calendarId=cal_id).execute()
-    @staticmethod
-    def request_cal_list(credentials):
-        with build('calendar', 'v3', credentials=credentials) as service:
-            return service.calendarList().list().execute()
+    def __init__(self, pool_size=DEFAULT_JOBS, timeout=DEFAULT_TIMEOUT, qps=DEFAULT_QPS):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.caldav_uri_format = GOOGLE_CALDAV_URI_FORMAT
+        # Shared by all calls (and accounts), so together they stay within the rate
+        self.rate_limiter = RateLimiter(qps)
+        self.backoff = Backoff()
+        self._services = {}
+        self._services_lock = threading.Lock()
+        self._session = None
+        self._session_lock = threading.Lock()
 
-    def request_cal_as_ical(self, cal_id, credentials):
-        url = GOOGLE_CALDAV_URI_FORMAT.format(cal_id=urllib.parse.quote(cal_id))
-        return self._request_with_token(url, credentials).text
+    def request_cal_details(self, credentials, cal_id):
+        service = self._calendar_service(credentials)
+        return service.events().list(calendarId=cal_id, maxResults=1).execute()
+        #return service.calendars().get(calendarId=cal_id).execute()
 
-    @staticmethod
-    def _request_with_token(url, credentials, raise_for_status=True):
-        headers = {'Authorization': f"Bearer {credentials.token}"}
-        response = requests.get(url, headers=headers)
+    def request_cal_details_batch(self, credentials, cal_ids):
+        """
+        Requests details for many calendars, grouped into batch requests of up
+        to BATCH_MAX_SIZE calls each. Calls failing within a batch are retried
+        individually.
+        :param credentials: Google API credentials
+        :param cal_ids: list<str>
+        :return: dict<str, dict> of calendar ID to details
+        """
+        service = self._calendar_service(credentials)
+        (cal_details, errors) = self._execute_batched(service, {
+            cal_id: service.events().list(calendarId=cal_id, maxResults=1) for cal_id in cal_ids})
+        for cal_id in errors:
+            cal_details[cal_id] = self.request_cal_details(credentials, cal_id)
+        return cal_details
+
+    def request_cal_changes(self, credentials, cal_id, sync_token):
+        """
+        Lists the events of a calendar changed (including deleted) since a sync token
+        :param credentials: Google API credentials
+        :param cal_id: Calendar ID
+        :param sync_token: nextSyncToken of a previous listing
+        :return: (list<dict>, str) of changed events and the next sync token,
+                 or None if the sync token has expired
+        """
+        service = self._calendar_service(credentials)
+        request = service.events().list(
+            calendarId=cal_id, syncToken=sync_token, maxResults=EVENTS_MAX_PAGE_SIZE, fields=EVENT_CHANGES_FIELDS)
+        return self._list_changes(service, request)
+
+    def request_cal_changes_batch(self, credentials, sync_tokens):
+        """
+        Like request_cal_changes, for many calendars, with the first page of
+        each listing grouped into batch requests
+        :param credentials: Google API credentials
+        :param sync_tokens: dict<str, str> of calendar ID to sync token
+        :return: dict<str, (list<dict>, str)> of calendar ID to changed events and next
+                 sync token, or to None where the sync token has expired
+        """
+        service = self._calendar_service(credentials)
+        requests_by_cal_id = {
+            cal_id: service.events().list(
+                calendarId=cal_id, syncToken=sync_token, maxResults=EVENTS_MAX_PAGE_SIZE, fields=EVENT_CHANGES_FIELDS)
+            for (cal_id, sync_token) in sync_tokens.items()}
+        (responses, errors) = self._execute_batched(service, requests_by_cal_id)
+        changes = {}
+        for (cal_id, response) in responses.items():
+            changes[cal_id] = self._list_changes(service, requests_by_cal_id[cal_id], response)
+        from googleapiclient.errors import HttpError
+        for (cal_id, error) in errors.items():
+            expired = isinstance(error, HttpError) and error.resp.status == 410
+            changes[cal_id] = None if expired else self.request_cal_changes(credentials, cal_id, sync_tokens[cal_id])
+        return changes
+
+    def request_cal_sync_token(self, credentials, cal_id):
+        """
+        Requests a sync token for the current state of a calendar, paging through
+        its events without retrieving them
+        :param credentials: Google API credentials
+        :param cal_id: Calendar ID
+        :return: str
+        """
+        service = self._calendar_service(credentials)
+        request = service.events().list(
+            calendarId=cal_id, maxResults=EVENTS_MAX_PAGE_SIZE, fields="nextPageToken,nextSyncToken")
+        (_, sync_token) = self._list_all_pages(service, request, request.execute())
+        return sync_token
+
+    def watch_calendar(self, credentials, cal_id, channel_id, address, token, ttl):
+        """
+        Opens a channel on which Google notifies changes of a calendar's events
+        :param credentials: Google API credentials
+        :param cal_id: Calendar ID
+        :param channel_id: ID of the channel, unique across channels
+        :param address: HTTPS URL notifications are posted to
+        :param token: Token notifications carry, to tell them from forged ones
+        :param ttl: timedelta, lifetime asked for the channel (Google may cap it)
+        :return: dict of the channel, with its 'resourceId' and 'expiration' (milliseconds since the epoch)
+        """
+        service = self._calendar_service(credentials)
+        return service.events().watch(calendarId=cal_id, body={
+            'id': channel_id,
+            'type': "web_hook",
+            'address': address,
+            'token': token,
+            'params': {'ttl': str(int(ttl.total_seconds()))},
+        }).execute()
+
+    def stop_channel(self, credentials, channel_id, resource_id):
+        service = self._calendar_service(credentials)
+        service.channels().stop(body={'id': channel_id, 'resourceId': resource_id}).execute()
+
+    def request_cal_list(self, credentials, etag=None):
+        """
+        Lists the user's calendars, following every page of the listing and
+        only retrieving the fields used (see CALENDAR_LIST_FIELDS)
+        :param credentials: Google API credentials
+        :param etag: Etag of a previous listing, to only list calendars if the list changed since
+        :return: dict with the listing's 'etag' (that of its first page) and the 'items' of all its
+                 pages, or None if the list wasn't modified since etag
+        """
+        from googleapiclient.errors import HttpError
+        calendar_list = self._calendar_service(credentials).calendarList()
+        request = calendar_list.list(maxResults=CALENDAR_LIST_MAX_PAGE_SIZE, fields=CALENDAR_LIST_FIELDS)
+        if etag:
+            request.headers['If-None-Match'] = etag
+        try:
+            response = request.execute()
+        except HttpError as e:
+            if e.resp.status == 304:
+                return None
+            raise
+        items = []
+        for page in self._pages(calendar_list, request, response):
+            items.extend(page.get('items', []))
+        return {'etag': response.get('etag'), 'items': items}
+
+    def save_cal_as_ical(self, cal_id, credentials, file_path, validators=None, content_hash=None, normalize=False):
+        """
+        Streams a calendar's iCal export into a temp file next to file_path and
+        then atomically moves it over file_path, so memory use stays constant
+        regardless of calendar size and a failed download never leaves a
+        partially written file behind. The content is hashed as it streams, and
+        if it matches content_hash the temp file is discarded instead, leaving
+        file_path (and its mtime) untouched. When normalizing, the download is
+        rewritten through ical.normalize() into a second temp file, and it's
+        the normalized content that is hashed and saved
+        :param cal_id: Calendar ID
+        :param credentials: Google API credentials
+        :param file_path: Path of the .ics file to write
+        :param validators: dict<str, str> of 'etag' and/or 'last_modified' returned by a
+                           previous download, to only download the calendar if it changed since
+        :param content_hash: SHA-256 hex digest of file_path's current content, if known
+        :param normalize: True to save the calendar in normalized form
+        :return: (int, dict<str, str>, str) of bytes downloaded, the response's validators and
+                 the content's hash, or None if the calendar wasn't modified (file_path is left untouched)
+        """
+        url = self.caldav_uri_format.format(cal_id=urllib.parse.quote(cal_id))
+        headers = {}
+        if validators and validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators and validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+        size = 0
+        digest = hashlib.sha256()
+        with self._request_with_token(url, credentials, stream=True, headers=headers) as response:
+            if response.status_code == 304:
+                return None
+            new_validators = {}
+            if response.headers.get('ETag'):
+                new_validators['etag'] = response.headers['ETag']
+            if response.headers.get('Last-Modified'):
+                new_validators['last_modified'] = response.headers['Last-Modified']
+            with ExitStack() as temp_files:
+                temp_file_path = temp_files.enter_context(temp_file(file_path))
+                with open(temp_file_path, 'xb') as file:
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        file.write(chunk)
+                        digest.update(chunk)
+                        size += len(chunk)
+                if normalize:
+                    raw_file_path = temp_file_path
+                    temp_file_path = temp_files.enter_context(temp_file(file_path))
+                    digest = hashlib.sha256()
+                    with open(raw_file_path, 'r', encoding='utf-8', newline='') as raw_file, \
+                            open(temp_file_path, 'xb') as file:
+                        for line in ical.normalize(raw_file):
+                            data = line.encode('utf-8')
+                            file.write(data)
+                            digest.update(data)
+                if digest.hexdigest() != content_hash:
+                    os.replace(temp_file_path, file_path)
+        return (size, new_validators, digest.hexdigest())
+
+    def close(self):
+        with self._services_lock:
+            for service in self._services.values():
+                service.close()
+            self._services = {}
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def _request_with_token(self, url, credentials, raise_for_status=True, stream=False, headers=None):
+        import requests
+        headers = dict(headers or {}, Authorization=f"Bearer {credentials.token}")
+        attempt = 1
+        while True:
+            self.rate_limiter.acquire()
+            response = self._http_session().get(url, headers=headers, timeout=self.timeout, stream=stream)
+            delay = self.backoff.delay(
+                attempt, response.status_code, response.headers.get('Retry-After'), lambda: response.content)
+            if delay is None:
+                break
+            response.close()
+            self.backoff.wait(delay, f"CalDAV request got {response.status_code}")
+            attempt += 1
         if raise_for_status:
-            response.raise_for_status()
+            try:
+                response.raise_for_status()
+            except requests.HTTPError:
+                response.close()
+                raise
         return response
+
+    def _http_session(self):
+        """
+        Returns the HTTP session shared by all CalDAV requests, so connections
+        are kept alive and pooled (one per parallel download) across calendars.
+        Advertises every content encoding urllib3 can decode here, which includes
+        brotli when the optional brotli package is installed.
+        :return: requests.Session
+        """
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util import make_headers
+        with self._session_lock:
+            if self._session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                session.headers['Accept-Encoding'] = make_headers(accept_encoding=True)['accept-encoding']
+                self._session = session
+            return self._session
+
+    def _calendar_service(self, credentials):
+        """
+        Returns the Calendar API client for the given credentials, building it
+        (from the discovery document bundled with googleapiclient, so without a
+        network round trip) on first use and reusing it and its HTTP connection after.
+        Its calls go through the shared rate limiter and are retried on rate limiting
+        :param credentials: Google API credentials
+        :return: googleapiclient Resource
+        """
+        from googleapiclient.discovery import build
+        with self._services_lock:
+            service = self._services.get(credentials)
+            if service is None:
+                http = RateLimitedHttp(self._authorized_http(credentials), self.rate_limiter, self.backoff)
+                service = build('calendar', 'v3', http=http,
+                                static_discovery=True, cache_discovery=False)
+                self._services[credentials] = service
+            return service
+
+    def _authorized_http(self, credentials):
+        import httplib2
+        from google_auth_httplib2 import AuthorizedHttp
+        return AuthorizedHttp(credentials, http=httplib2.Http(timeout=self.timeout))
+
+    @staticmethod
+    def _execute_batched(service, requests_by_id):
+        responses = {}
+        errors = {}
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                responses[request_id] = response
+            else:
+                errors[request_id] = exception
+
+        request_ids = list(requests_by_id)
+        for i in range(0, len(request_ids), BATCH_MAX_SIZE):
+            batch = service.new_batch_http_request(callback=callback)
+            for request_id in request_ids[i:i + BATCH_MAX_SIZE]:
+                batch.add(requests_by_id[request_id], request_id=request_id)
+            batch.execute()
+        return (responses, errors)
+
+    @classmethod
+    def _list_changes(cls, service, request, response=None):
+        from googleapiclient.errors import HttpError
+        try:
+            response = request.execute() if response is None else response
+            return cls._list_all_pages(service, request, response)
+        except HttpError as e:
+            if e.resp.status == 410:  # Sync token expired
+                return None
+            raise
+
+    @classmethod
+    def _list_all_pages(cls, service, request, response):
+        items = []
+        for page in cls._pages(service.events(), request, response):
+            items.extend(page.get('items', []))
+        return (items, page['nextSyncToken'])
+
+    @staticmethod
+    def _pages(collection, request, response):
+        """
+        Yields the response for the first page of a listing, then requests and
+        yields each page following it
+        :param collection: googleapiclient Resource the listing was requested from
+        :param request: Request for the first page
+        :param response: dict, the response to it
+        """
+        yield response
+        while response.get('nextPageToken'):
+            request = collection.list_next(request, response)
+            # Only the first page is conditional; the rest are fetched because it changed
+            request.headers = {name: value for (name, value) in request.headers.items()
+                               if name.lower() != 'if-none-match'}
+            response = request.execute()
+            yield response
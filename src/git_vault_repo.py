@@ -1,22 +1,62 @@
 import os
-from git import Repo, exc
+import shutil
+import sys
+import threading
+import time
+
+from .metrics import Metrics
+
+GITIGNORE_SUBDIRS_LINE = '!*/'
+# Marks the index as holding files staged without a commit, kept in the .git dir
+PENDING_STAGE_FILE_NAME = 'GCALVAULT_PENDING_STAGE'
+
+# Delta search window and chain depth used when packing objects during maintenance; vaults hold
+# many revisions of similar text files, which delta far better with wider windows than git's default
+MAINTENANCE_PACK_WINDOW = 250
+MAINTENANCE_PACK_DEPTH = 50
+
+# Attempts made to push to a remote, waiting PUSH_RETRY_DELAY seconds after the first failure,
+# doubling the wait after each further one
+PUSH_ATTEMPTS = 5
+PUSH_RETRY_DELAY = 2
+SSH_KEY_PATH = "/ssh-key"
+
+# GitPython changes the process' working directory while adding files to an index, so indexes
+# of several repositories (e.g. one per account) mustn't be written at the same time
+_index_lock = threading.Lock()
 
 
 class GitVaultRepo():
+    """
+    Git repository holding the version history of a vault. Files added and
+    removed are collected in memory and only applied to the index, in a single
+    write, when staging or committing. Pushes happen in the background (see
+    push()), so close() must be called to wait for them to finish. Staging,
+    commits and pushes are recorded as phases in the given metrics.
+    """
 
-    def __init__(self, name, dir_path, extensions):
+    def __init__(self, name, dir_path, extensions, subdirs=False, metrics=None):
+        from git import Repo, exc
         self._name = name
+        self._metrics = metrics if metrics is not None else Metrics()
         self._extensions = extensions
+        self._subdirs = subdirs
         self._repo = None
+        self._added_files = set()
+        self._removed_files = set()
+        self._pushers = {}
         try:
             self._repo = Repo(dir_path)
+            if subdirs:
+                self._ensure_gitignore_subdirs()
         except exc.InvalidGitRepositoryError:
             self._repo = Repo.init(dir_path)
             self._add_gitignore()
             print(f"Created {self._name} repository")
 
     def add_file(self, file_name):
-        self._repo.index.add(file_name)
+        self._removed_files.discard(file_name)
+        self._added_files.add(file_name)
 
     def add_all_files(self):
         for ext in self._extensions:
@@ -24,34 +64,236 @@ class GitVaultRepo():
             self._repo.index.add(f'*{ext}')
 
     def remove_file(self, file_name):
-        self._repo.index.remove([file_name], working_tree=True)
+        path = os.path.join(self._repo.working_dir, file_name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+        self._added_files.discard(file_name)
+        self._removed_files.add(file_name)
+
+    def stage(self):
+        """
+        Applies the files added and removed so far to the index without
+        committing, so that they are picked up by a later commit even if this
+        instance is discarded
+        :return: none
+        """
+        with _index_lock:
+            with self._metrics.phase("git_add") as phase:
+                phase['changes'] = self._stage_files()
+            if phase['changes']:
+                open(self._pending_stage_path(), 'w').close()
 
     def commit(self, message):
-        changes = self._repo.index.diff(self._repo.head.commit)
+        with _index_lock:
+            with self._metrics.phase("git_add") as phase:
+                changes = phase['changes'] = self._stage_files()
+                pending_stage = os.path.exists(self._pending_stage_path())
+                if not changes and pending_stage:
+                    # Files staged by an earlier, interrupted sync
+                    changes = phase['changes'] = len(self._repo.index.diff(self._repo.head.commit))
+            if (changes):
+                with self._metrics.phase("git_commit"):
+                    self._repo.index.commit(message)
+            if pending_stage:
+                os.remove(self._pending_stage_path())
         if (changes):
-            self._repo.index.commit(message)
-            print(f"Committed {len(changes)} revision(s) to {self._name} repository")
+            print(f"Committed {changes} revision(s) to {self._name} repository")
         else:
             print(f"No revisions to commit to {self._name} repository")
 
-    def push(self):
-        print("Pushing repository...")
-        if os.path.exists("/ssh-key"):
-            ssh_cmd = 'ssh -o StrictHostKeyChecking=no -i /ssh-key'
-            with self._repo.git.custom_environment(GIT_SSH_COMMAND=ssh_cmd):
-                for remote in self._repo.remotes:
-                    remote.push()
-            return
+    def _pending_stage_path(self):
+        return os.path.join(self._repo.git_dir, PENDING_STAGE_FILE_NAME)
+
+    def _stage_files(self):
+        """
+        Applies the files added and removed since the last commit to the index,
+        writing it once
+        :return: int, number of those files which differ from HEAD
+        """
+        if not self._added_files and not self._removed_files:
+            return 0
+        index = self._repo.index
+        head_tree = self._repo.head.commit.tree
+        changes = 0
+        for file_name in self._removed_files:
+            path = file_name.replace(os.sep, "/")
+            for key in [key for key in index.entries if key[0] == path or key[0].startswith(f"{path}/")]:
+                del index.entries[key]
+            changes += self._tree_entry(head_tree, path) is not None
+        if self._added_files:
+            for entry in index.add(sorted(self._added_files), write=False):
+                head_entry = self._tree_entry(head_tree, entry.path)
+                changes += head_entry is None or head_entry.binsha != entry.binsha
+        index.write()
+        self._added_files = set()
+        self._removed_files = set()
+        return changes
+
+    def _commit_count(self, since_head):
+        from git import exc
+        if since_head:
+            try:
+                return int(self._repo.git.rev_list('--count', f'{since_head}..HEAD'))
+            except exc.GitCommandError:
+                pass  # history no longer contains it
+        return int(self._repo.git.rev_list('--count', 'HEAD'))
+
+    def _loose_object_count(self):
+        stats = dict(line.split(": ", 1) for line in self._repo.git.count_objects('-v').splitlines())
+        return int(stats['count'])
+
+    @staticmethod
+    def _tree_entry(tree, path):
+        try:
+            return tree[path]
+        except KeyError:
+            return None
+
+    def maintenance_reason(self, last_head, commits, loose_objects):
+        """
+        Decides whether the repository is due for maintenance
+        :param last_head: SHA of HEAD as of the last maintenance, or None if never maintained
+        :param commits: Maintain every this many commits (0 to never maintain on commit count)
+        :param loose_objects: Maintain once there are more than this many loose objects (0 to never)
+        :return: str describing why maintenance is due, or None if it isn't
+        """
+        if commits:
+            commit_count = self._commit_count(last_head)
+            if commit_count >= commits:
+                return f"{commit_count} commits since last maintenance"
+        if loose_objects:
+            loose_object_count = self._loose_object_count()
+            if loose_object_count > loose_objects:
+                return f"{loose_object_count} loose objects"
+        return None
 
+    def maintain(self):
+        """
+        Packs loose objects (with a delta window suited to text revisions),
+        prunes unreachable ones and writes the commit-graph
+        :return: str, SHA of HEAD as of the maintenance
+        """
+        print(f"Running maintenance on {self._name} repository")
+        self._repo.git.execute([
+            self._repo.git.GIT_PYTHON_GIT_EXECUTABLE,
+            '-c', f'pack.window={MAINTENANCE_PACK_WINDOW}',
+            '-c', f'pack.depth={MAINTENANCE_PACK_DEPTH}',
+            '-c', 'gc.writeCommitGraph=false',
+            'gc', '--quiet'])
+        self._repo.git.commit_graph('write', '--reachable')
+        return self._repo.head.commit.hexsha
+
+    def push(self):
+        """
+        Queues a push of the current branch to each of the repository's remotes.
+        Every remote is pushed from a background thread of its own, retrying with
+        exponential backoff, so remotes are pushed in parallel and a slow one
+        doesn't hold up the others (or the caller). Pushes queued for a remote
+        while it's already being pushed are coalesced into a single push.
+        :return: none
+        """
         for remote in self._repo.remotes:
-            remote.push()
+            if remote.name not in self._pushers:
+                self._pushers[remote.name] = RemotePusher(remote.name, self._push_remote)
+            self._pushers[remote.name].request()
+        if self._pushers:
+            print(f"Queued push of {self._name} repository to {len(self._pushers)} remote(s)")
+
+    def close(self):
+        """
+        Waits for queued pushes to finish, and stops their background threads
+        :return: none
+        """
+        for pusher in self._pushers.values():
+            pusher.close()
+        self._pushers = {}
+
+    def _push_remote(self, remote_name):
+        env = {}
+        if os.path.exists(SSH_KEY_PATH):
+            env['GIT_SSH_COMMAND'] = f'ssh -o StrictHostKeyChecking=no -i {SSH_KEY_PATH}'
+        with self._metrics.phase("git_push", remote=remote_name):
+            for info in self._repo.remote(remote_name).push(self._repo.active_branch.name, env=env):
+                if info.flags & (info.ERROR | info.REJECTED | info.REMOTE_REJECTED):
+                    raise RuntimeError(info.summary.strip())
 
     def _add_gitignore(self):
         gitignore_path = os.path.join(self._repo.working_dir, ".gitignore")
         with open(gitignore_path, 'w') as file:
             print('*', file=file)
             print('!.gitignore', file=file)
+            if self._subdirs:
+                print(GITIGNORE_SUBDIRS_LINE, file=file)
             for ext in self._extensions:
                 print(f'!*{ext}', file=file)
-        self._repo.index.add('.gitignore')
-        self._repo.index.commit("Add .gitignore")
+        with _index_lock:
+            self._repo.index.add('.gitignore')
+            self._repo.index.commit("Add .gitignore")
+
+    def _ensure_gitignore_subdirs(self):
+        # Files in subdirectories are only picked up once the subdirectories are un-ignored too
+        gitignore_path = os.path.join(self._repo.working_dir, ".gitignore")
+        with open(gitignore_path, 'a+') as file:
+            file.seek(0)
+            if GITIGNORE_SUBDIRS_LINE in file.read().splitlines():
+                return
+            print(GITIGNORE_SUBDIRS_LINE, file=file)
+        self.add_file('.gitignore')
+
+
+class RemotePusher():
+    """
+    Background thread pushing to a single remote whenever requested. Requests
+    made while a push is under way are coalesced into one more push after it.
+    """
+
+    def __init__(self, remote_name, push):
+        self._remote_name = remote_name
+        self._push = push
+        self._sleep = time.sleep
+        self._condition = threading.Condition()
+        self._pending = False
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=f"push-{remote_name}", daemon=True)
+        self._thread.start()
+
+    def request(self):
+        with self._condition:
+            self._pending = True
+            self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending or self._closed)
+                if not self._pending:
+                    return
+            self._push_with_retries()
+
+    def _push_with_retries(self):
+        delay = PUSH_RETRY_DELAY
+        for attempt in range(1, PUSH_ATTEMPTS + 1):
+            with self._condition:
+                # This attempt pushes the latest commit, covering any requests made since
+                self._pending = False
+            try:
+                self._push(self._remote_name)
+                print(f"Pushed to remote '{self._remote_name}'")
+                return
+            except Exception as e:
+                if attempt == PUSH_ATTEMPTS:
+                    print(f"Failed to push to remote '{self._remote_name}' after {attempt} attempts: {e}",
+                          file=sys.stderr)
+                    return
+                print(f"Failed to push to remote '{self._remote_name}', retrying in {delay}s: {e}",
+                      file=sys.stderr)
+                self._sleep(delay)
+                delay *= 2
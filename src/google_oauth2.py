@@ -1,48 +1,215 @@
 import os
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
+import sys
+import threading
+from datetime import datetime, timedelta
 
 
 GOOGLE_AUTH_URI = "https://accounts.google.com/o/oauth2/auth"
 GOOGLE_TOKEN_URI = "https://oauth2.googleapis.com/token"
 GOOGLE_AUTH_CERTS_URI = "https://www.googleapis.com/oauth2/v1/certs"
 
+# Cached tokens are refreshed this long before they expire, ahead of google-auth
+# considering them invalid (and refreshing them in the middle of a request)
+TOKEN_REFRESH_MARGIN = timedelta(minutes=10)
+# How long the background refresher waits before retrying a failed refresh
+TOKEN_REFRESH_RETRY_DELAY = timedelta(minutes=1)
+# Upper bound on a single wait of the background refresher, so clock changes are noticed
+TOKEN_REFRESH_MAX_WAIT = timedelta(minutes=5)
+
 
 class GoogleOAuth2():
+    """
+    Obtains OAuth2 credentials for users, keeping them cached in memory (by
+    token file) so they're only read from disk once, and writing token files
+    only when their token actually changed. Once start_refreshing() is called,
+    a background thread refreshes cached tokens ahead of their expiry, so a
+    sync never has to wait for a refresh; close() stops it.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._credentials = {}
+        self._saved_tokens = {}
+        self._refresh_failed = set()
+        self._pending = set()  # token files being refreshed or authorized
+        self._refresher = None
+        self._closed = False
+        self._clock = datetime.utcnow  # google-auth expiries are naive UTC
 
     def get_credentials(self, token_file_path, client_id, client_secret, scopes, login_hint):
-        credentials = None
-        new_authorization = False
+        with self._condition:
+            while True:
+                credentials = self._credentials.get(token_file_path)
+                if credentials is not None and credentials.valid and \
+                        (not self._refresh_due(credentials) or token_file_path in self._pending):
+                    # Still valid, even if due for a refresh another thread is already doing
+                    return (credentials, False)
+                if token_file_path not in self._pending:
+                    break
+                self._condition.wait()
+            self._pending.add(token_file_path)
+        # Refreshed or authorized outside the lock, so other token files are still served meanwhile
+        try:
+            (credentials, saved_token, new_authorization, refresh_error) = self._obtain_credentials(
+                credentials, token_file_path, client_id, client_secret, scopes, login_hint)
+        except BaseException:
+            with self._condition:
+                self._pending.discard(token_file_path)
+                self._condition.notify_all()
+            raise
+        with self._condition:
+            self._pending.discard(token_file_path)
+            self._condition.notify_all()
+            if saved_token is not None:
+                self._saved_tokens[token_file_path] = saved_token
+            self._credentials[token_file_path] = credentials
+            if refresh_error is not None:
+                self._refresh_failed.add(token_file_path)
+            else:
+                self._refresh_failed.discard(token_file_path)
+                self._save_token(token_file_path, credentials)
+        if refresh_error is not None:
+            print(f"Failed to refresh token for {os.path.basename(token_file_path)}: {refresh_error}",
+                  file=sys.stderr)
+        return (credentials, new_authorization)
 
-        if os.path.exists(token_file_path):
+    def _obtain_credentials(self, credentials, token_file_path, client_id, client_secret, scopes, login_hint):
+        """
+        Loads, refreshes or authorizes the credentials of a token file, as needed
+        :return: (Credentials, str, bool, Exception) of the credentials, the token read
+                 from the token file (None if not read), whether the user newly authorized
+                 them, and the error of a failed early refresh the still valid credentials
+                 were kept through (None unless one failed)
+        """
+        from google.auth.transport.requests import Request
+        from google.oauth2.credentials import Credentials
+        (saved_token, new_authorization, refresh_error) = (None, False, None)
+        if credentials is None and os.path.exists(token_file_path):
+            with open(token_file_path, 'r') as token:
+                saved_token = token.read()
             credentials = Credentials.from_authorized_user_file(token_file_path, scopes)
 
-        if not credentials or not credentials.valid:
-
-            if credentials and credentials.expired and credentials.refresh_token:
+        if credentials and credentials.refresh_token and (not credentials.valid or self._refresh_due(credentials)):
+            try:
                 credentials.refresh(Request())
-            else:
-                flow = InstalledAppFlow.from_client_config(
-                    {
-                        "installed": {
-                            "auth_uri": GOOGLE_AUTH_URI,
-                            "token_uri": GOOGLE_TOKEN_URI,
-                            "auth_provider_x509_cert_url": GOOGLE_AUTH_CERTS_URI,
-                            "client_id": client_id,
-                            "client_secret": client_secret
-                        }
-                    },
-                    scopes=scopes)
-                credentials = flow.run_console(login_hint=login_hint)
-                new_authorization = True
-
-            with open(token_file_path, 'w') as token:
-                token.write(credentials.to_json())
+            except Exception as e:
+                if not credentials.valid:
+                    raise
+                # Only refreshed ahead of expiry, the current token still works meanwhile
+                refresh_error = e
+        elif not credentials or not credentials.valid:
+            from google_auth_oauthlib.flow import InstalledAppFlow
+            flow = InstalledAppFlow.from_client_config(
+                {
+                    "installed": {
+                        "auth_uri": GOOGLE_AUTH_URI,
+                        "token_uri": GOOGLE_TOKEN_URI,
+                        "auth_provider_x509_cert_url": GOOGLE_AUTH_CERTS_URI,
+                        "client_id": client_id,
+                        "client_secret": client_secret
+                    }
+                },
+                scopes=scopes)
+            credentials = flow.run_console(login_hint=login_hint)
+            new_authorization = True
+        return (credentials, saved_token, new_authorization, refresh_error)
 
-        return (credentials, new_authorization)
+    def forget_credentials(self, token_file_path):
+        """
+        Drops the cached credentials of a token file (e.g. one being removed)
+        :param token_file_path: Path of the token file
+        :return: none
+        """
+        with self._condition:
+            self._credentials.pop(token_file_path, None)
+            self._saved_tokens.pop(token_file_path, None)
+            self._refresh_failed.discard(token_file_path)
+
+    def start_refreshing(self):
+        """
+        Starts refreshing cached credentials in the background, ahead of their expiry
+        :return: none
+        """
+        with self._condition:
+            if self._refresher is not None:
+                return
+            self._closed = False
+            self._refresher = threading.Thread(target=self._run_refresher, name="token-refresher", daemon=True)
+            self._refresher.start()
+
+    def close(self):
+        """
+        Stops the background refresher, if started
+        :return: none
+        """
+        with self._condition:
+            refresher = self._refresher
+            self._refresher = None
+            self._closed = True
+            self._condition.notify_all()
+        if refresher is not None:
+            refresher.join()
 
     def request_user_info(self, credentials):
+        from googleapiclient.discovery import build
         with build('oauth2', 'v2', credentials=credentials) as service:
             return service.userinfo().get().execute()
+
+    def _run_refresher(self):
+        while True:
+            with self._condition:
+                if self._closed:
+                    return
+                due = [(token_file_path, credentials) for (token_file_path, credentials) in self._credentials.items()
+                       if credentials.refresh_token and self._refresh_due(credentials)]
+                # Skipping those a sync is refreshing (or authorizing) already
+                due = [(token_file_path, credentials) for (token_file_path, credentials) in due
+                       if token_file_path not in self._pending]
+                self._pending.update(token_file_path for (token_file_path, _) in due)
+            # Refreshed outside the lock, so cached credentials can still be handed out meanwhile
+            for (token_file_path, credentials) in due:
+                self._refresh_in_background(token_file_path, credentials)
+            with self._condition:
+                if self._closed:
+                    return
+                self._condition.wait(self._refresher_wait().total_seconds())
+
+    def _refresh_in_background(self, token_file_path, credentials):
+        from google.auth.transport.requests import Request
+        try:
+            credentials.refresh(Request())
+            error = None
+        except Exception as e:
+            error = e
+        with self._condition:
+            self._pending.discard(token_file_path)
+            self._condition.notify_all()
+            if self._credentials.get(token_file_path) is not credentials:
+                return  # forgotten meanwhile
+            if error is not None or self._refresh_due(credentials):
+                self._refresh_failed.add(token_file_path)
+            else:
+                self._refresh_failed.discard(token_file_path)
+                self._save_token(token_file_path, credentials)
+        if error is not None:
+            print(f"Failed to refresh token for {os.path.basename(token_file_path)}: {error}", file=sys.stderr)
+
+    def _refresher_wait(self):
+        wait = TOKEN_REFRESH_MAX_WAIT
+        if self._refresh_failed:
+            wait = min(wait, TOKEN_REFRESH_RETRY_DELAY)
+        for (token_file_path, credentials) in self._credentials.items():
+            if credentials.refresh_token and credentials.expiry and token_file_path not in self._refresh_failed:
+                wait = min(wait, credentials.expiry - TOKEN_REFRESH_MARGIN - self._clock())
+        return max(wait, timedelta(0))
+
+    def _refresh_due(self, credentials):
+        return credentials.expiry is not None and credentials.expiry - TOKEN_REFRESH_MARGIN <= self._clock()
+
+    def _save_token(self, token_file_path, credentials):
+        token = credentials.to_json()
+        if self._saved_tokens.get(token_file_path) == token:
+            return
+        with open(token_file_path, 'w') as file:
+            file.write(token)
+        self._saved_tokens[token_file_path] = token
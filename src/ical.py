@@ -0,0 +1,220 @@
+import os
+import re
+from .temp_file import temp_file
+
+# Properties Google rewrites on every export, regardless of whether the component changed
+VOLATILE_PROPERTIES = ["DTSTAMP"]
+# Properties a volatile property is pinned to instead, in order of preference
+PINNED_VALUE_PROPERTIES = ["LAST-MODIFIED", "CREATED"]
+PINNED_VALUE_DEFAULT = "19700101T000000Z"
+PROPERTY_NAME_PATTERN = re.compile(r"[^;:]*")
+TZID_PARAMETER_PATTERN = re.compile(r';TZID=("[^"]*"|[^;:]*)', re.IGNORECASE)
+# Maximum length of a content line in octets, excluding the line break (RFC 5545 3.1)
+FOLD_LENGTH = 75
+
+
+def iter_components(file):
+    """
+    Reads an iCalendar stream one line at a time, yielding (name, lines) for
+    each component nested directly within the VCALENDAR (e.g. VEVENT, VTIMEZONE),
+    and (None, [line]) for every other line. Lines are yielded as read (still
+    folded, line endings included), so writing them back out reproduces the input.
+    :param file: Text file object, opened with newline=''
+    :return: generator of (str, list<str>)
+    """
+    name = None
+    lines = []
+    depth = 0
+    for line in file:
+        content_line = line.rstrip("\r\n")
+        if name is None:
+            if content_line.upper().startswith("BEGIN:") and content_line[6:].upper() != "VCALENDAR":
+                name = content_line[6:].upper()
+                lines = [line]
+                depth = 1
+            else:
+                yield (None, [line])
+            continue
+        lines.append(line)
+        if content_line.upper().startswith("BEGIN:"):
+            depth += 1
+        elif content_line.upper().startswith("END:"):
+            depth -= 1
+            if depth == 0:
+                yield (name, lines)
+                (name, lines) = (None, [])
+    if lines:
+        yield (name, lines)
+
+
+def unfold(lines):
+    """
+    Joins folded lines back into content lines, without line endings
+    :param lines: list<str>
+    :return: list<str>
+    """
+    content_lines = []
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if line[:1] in (" ", "\t") and content_lines:
+            content_lines[-1] += line[1:]
+        else:
+            content_lines.append(line)
+    return content_lines
+
+
+def property_value(lines, prop_name):
+    """
+    Returns the value of the first property with the given name directly within
+    a component (properties of nested components, like VALARM, are skipped)
+    :param lines: list<str>, lines of the component
+    :param prop_name: str, e.g. "UID"
+    :return: str, or None if the property isn't present
+    """
+    depth = 0
+    for content_line in unfold(lines):
+        upper_line = content_line.upper()
+        if upper_line.startswith("BEGIN:"):
+            depth += 1
+        elif upper_line.startswith("END:"):
+            depth -= 1
+        elif depth == 1 and _property_name(content_line) == prop_name.upper():
+            return content_line.split(":", 1)[1] if ":" in content_line else ""
+    return None
+
+
+def remove_events(file_path, uids):
+    """
+    Removes the VEVENTs with the given UIDs (including any overridden
+    instances of them) from an .ics file, streaming through a temp file which
+    then atomically replaces it. Nothing is changed unless every UID was found.
+    :param file_path: Path of the .ics file
+    :param uids: iterable<str>
+    :return: True if the events were removed, False if some UIDs weren't found
+    """
+    uids = set(uids)
+    removed_uids = set()
+    with temp_file(file_path) as temp_file_path:
+        with open(file_path, 'r', encoding='utf-8', newline='') as file, \
+                open(temp_file_path, 'x', encoding='utf-8', newline='') as out_file:
+            for (name, lines) in iter_components(file):
+                if name == "VEVENT":
+                    uid = property_value(lines, "UID")
+                    if uid in uids:
+                        removed_uids.add(uid)
+                        continue
+                out_file.writelines(lines)
+        if removed_uids != uids:
+            return False
+        os.replace(temp_file_path, file_path)
+        return True
+
+
+def normalize(file):
+    """
+    Rewrites an iCalendar stream into a stable form, so exports of an unchanged
+    calendar are identical and exports of a changed one differ only where it
+    changed: components are grouped by type, with VEVENTs sorted by UID and
+    RECURRENCE-ID and VTIMEZONEs by TZID, volatile properties are pinned to
+    the component's LAST-MODIFIED (or CREATED) time, and every line is refolded
+    consistently with CRLF line endings. Components are held in memory to be
+    sorted.
+    :param file: Text file object, opened with newline=''
+    :return: generator of str, lines of the normalized calendar
+    """
+    (head, tail) = ([], [])
+    components = {}
+    for (name, lines) in iter_components(file):
+        if name is None:
+            (tail if tail or components or lines[0].upper().startswith("END:VCALENDAR") else head).extend(lines)
+        else:
+            components.setdefault(name, []).append(_normalize_component(name, unfold(lines)))
+    for content_line in unfold(head):
+        yield from _fold(content_line)
+    for normalized_components in components.values():
+        # sorted() is stable, so components without a sort key keep their order
+        for (_, content_lines) in sorted(normalized_components, key=lambda component: component[0]):
+            for content_line in content_lines:
+                yield from _fold(content_line)
+    for content_line in unfold(tail):
+        yield from _fold(content_line)
+
+
+def split_events(file):
+    """
+    Splits an iCalendar stream into one calendar per event UID, each holding the
+    calendar's properties, the VTIMEZONEs its events refer to, and its VEVENTs
+    (the event along with any overridden instances of it). Lines are kept as read.
+    Components other than VEVENT and VTIMEZONE aren't included. Events are held
+    in memory to be grouped by UID.
+    :param file: Text file object, opened with newline=''
+    :return: generator of (str, list<str>) of each UID and the lines of its calendar
+    """
+    (head, tail) = ([], [])
+    timezones = {}
+    events = {}
+    for (name, lines) in iter_components(file):
+        if name is None:
+            (tail if tail or events or lines[0].upper().startswith("END:VCALENDAR") else head).extend(lines)
+        elif name == "VTIMEZONE":
+            timezones[property_value(lines, "TZID")] = lines
+        elif name == "VEVENT":
+            events.setdefault(property_value(lines, "UID") or "", []).extend(lines)
+    for (uid, event_lines) in events.items():
+        tzids = {tzid.strip('"') for content_line in unfold(event_lines)
+                 for tzid in TZID_PARAMETER_PATTERN.findall(content_line)}
+        timezone_lines = [line for tzid in sorted(tzids) for line in timezones.get(tzid, [])]
+        yield (uid, head + timezone_lines + event_lines + tail)
+
+
+def _normalize_component(name, content_lines):
+    """
+    Pins a component's volatile properties
+    :return: (tuple, list<str>) of the component's sort key and its content lines
+    """
+    properties = {}
+    volatile_indexes = []
+    depth = 0
+    for (i, content_line) in enumerate(content_lines):
+        prop_name = _property_name(content_line)
+        if prop_name == "BEGIN":
+            depth += 1
+        elif prop_name == "END":
+            depth -= 1
+        elif depth == 1:
+            if prop_name in VOLATILE_PROPERTIES:
+                volatile_indexes.append(i)
+            properties.setdefault(prop_name, content_line.split(":", 1)[1] if ":" in content_line else "")
+    pinned_value = next((properties[prop_name] for prop_name in PINNED_VALUE_PROPERTIES if properties.get(prop_name)),
+                        PINNED_VALUE_DEFAULT)
+    for i in volatile_indexes:
+        content_lines[i] = f"{_property_name(content_lines[i])}:{pinned_value}"
+    if name == "VEVENT":
+        key = (properties.get("UID", ""), properties.get("RECURRENCE-ID", ""))
+    elif name == "VTIMEZONE":
+        key = (properties.get("TZID", ""), "")
+    else:
+        key = ("", "")
+    return (key, content_lines)
+
+
+def _fold(content_line):
+    """
+    Splits a content line into lines of at most FOLD_LENGTH octets, never
+    within a multi-byte UTF-8 character
+    """
+    if len(content_line.encode('utf-8')) <= FOLD_LENGTH:
+        yield content_line + "\r\n"
+        return
+    (start, prefix) = (0, "")
+    while start < len(content_line):
+        (end, length) = (start, len(prefix))
+        while end < len(content_line) and length + len(content_line[end].encode('utf-8')) <= FOLD_LENGTH:
+            length += len(content_line[end].encode('utf-8'))
+            end += 1
+        yield prefix + content_line[start:end] + "\r\n"
+        (start, prefix) = (end, " ")
+
+
+def _property_name(content_line):
+    return PROPERTY_NAME_PATTERN.match(content_line).group().upper()
@@ -0,0 +1,157 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from .temp_file import temp_file
+
+PROMETHEUS_METRIC_PREFIX = "gcalvault"
+
+
+class Metrics():
+    """
+    Records how long each phase of a sync takes, along with what it did, e.g.
+    the bytes and status of a download. Every phase is written as a line of
+    JSON to the JSON lines file as it ends, and aggregated per phase (and
+    labels, such as the user) into the Prometheus textfile written by
+    write_prometheus(), which node_exporter's textfile collector picks up and
+    which can be pushed to a Pushgateway as is. Without either file, phases
+    are only aggregated in memory. Views made by bind() share the same files.
+    """
+
+    def __init__(self, json_lines_path=None, prometheus_path=None):
+        self._sink = _MetricsSink(json_lines_path, prometheus_path)
+        self._labels = {}
+
+    def bind(self, **labels):
+        """
+        :return: Metrics recording into the same files, with the given labels added to everything it records
+        """
+        metrics = Metrics.__new__(Metrics)
+        metrics._sink = self._sink
+        metrics._labels = dict(self._labels, **labels)
+        return metrics
+
+    @contextmanager
+    def phase(self, name, **fields):
+        """
+        Times the enclosed block as a phase. The block gets a dict of the phase's
+        fields, to which it can add what it did; its 'status' is "ok" unless set
+        otherwise, or "error" if the block raises
+        :param name: Name of the phase
+        :param fields: Initial fields of the phase
+        """
+        (started_at, started) = (time.time(), time.perf_counter())
+        fields = dict(fields)
+        try:
+            yield fields
+        except BaseException:
+            fields['status'] = "error"
+            raise
+        finally:
+            self.record(name, time.perf_counter() - started, started_at, **fields)
+
+    def record(self, name, duration, started_at=None, **fields):
+        """
+        Records a phase timed by the caller
+        :param name: Name of the phase
+        :param duration: float, seconds the phase took
+        :param started_at: float, time the phase started (seconds since the epoch), defaults to now less duration
+        :param fields: What the phase did, with 'status' defaulting to "ok" and 'bytes' summed up when aggregating
+        """
+        started_at = time.time() - duration if started_at is None else started_at
+        fields.setdefault('status', "ok")
+        self._sink.record(name, duration, started_at, self._labels, fields)
+
+    def write_prometheus(self):
+        self._sink.write_prometheus()
+
+    def close(self):
+        """
+        Writes the Prometheus textfile one last time and closes the JSON lines file
+        """
+        self._sink.write_prometheus()
+        self._sink.close()
+
+
+class _MetricsSink():
+
+    def __init__(self, json_lines_path, prometheus_path):
+        self._json_lines_path = json_lines_path
+        self._prometheus_path = prometheus_path
+        self._json_lines_file = None
+        self._lock = threading.Lock()
+        self._phases = {}
+        self._syncs = {}
+
+    def record(self, name, duration, started_at, labels, fields):
+        line = dict(time=datetime.fromtimestamp(started_at, timezone.utc).isoformat(), phase=name,
+                    duration=round(duration, 6), **labels, **fields)
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            totals = self._phases.setdefault(key, {'count': 0, 'duration': 0.0, 'errors': 0, 'bytes': 0})
+            totals['count'] += 1
+            totals['duration'] += duration
+            totals['errors'] += fields['status'] == "error"
+            totals['bytes'] += fields.get('bytes') or 0
+            if name == "sync":
+                self._syncs[key[1]] = {'end': started_at + duration, 'duration': duration,
+                                       'success': int(fields['status'] == "ok")}
+            if self._json_lines_path:
+                if self._json_lines_file is None:
+                    self._json_lines_file = open(self._json_lines_path, 'a')
+                self._json_lines_file.write(json.dumps(line) + "\n")
+                self._json_lines_file.flush()
+
+    def write_prometheus(self):
+        if not self._prometheus_path:
+            return
+        with self._lock:
+            text = self._prometheus_text()
+        # Written to a temp file and moved in place, so collectors never read a partial file
+        with temp_file(self._prometheus_path) as temp_file_path:
+            with open(temp_file_path, 'w') as file:
+                file.write(text)
+            os.replace(temp_file_path, self._prometheus_path)
+
+    def close(self):
+        with self._lock:
+            if self._json_lines_file is not None:
+                self._json_lines_file.close()
+                self._json_lines_file = None
+
+    def _prometheus_text(self):
+        phases = sorted(self._phases.items())
+        syncs = sorted(self._syncs.items())
+        lines = []
+        self._prometheus_metric(lines, "phase_duration_seconds", "summary", "Time spent in each phase of syncs", [
+            (f"_{suffix}", dict(labels, phase=name), totals[total])
+            for ((name, labels), totals) in phases for (suffix, total) in [("sum", 'duration'), ("count", 'count')]])
+        self._prometheus_metric(lines, "phase_errors_total", "counter", "Phases of syncs which failed", [
+            ("", dict(labels, phase=name), totals['errors']) for ((name, labels), totals) in phases])
+        self._prometheus_metric(lines, "download_bytes_total", "counter", "Bytes of calendars downloaded", [
+            ("", dict(labels), totals['bytes']) for ((name, labels), totals) in phases if name == "download"])
+        self._prometheus_metric(lines, "last_sync_timestamp_seconds", "gauge", "Time the last sync ended", [
+            ("", dict(labels), sync['end']) for (labels, sync) in syncs])
+        self._prometheus_metric(lines, "last_sync_duration_seconds", "gauge", "Time the last sync took", [
+            ("", dict(labels), sync['duration']) for (labels, sync) in syncs])
+        self._prometheus_metric(lines, "last_sync_success", "gauge", "Whether the last sync succeeded", [
+            ("", dict(labels), sync['success']) for (labels, sync) in syncs])
+        return "".join(f"{line}\n" for line in lines)
+
+    @staticmethod
+    def _prometheus_metric(lines, name, metric_type, help_text, samples):
+        if not samples:
+            return
+        name = f"{PROMETHEUS_METRIC_PREFIX}_{name}"
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for (suffix, labels, value) in samples:
+            label_text = ",".join(f'{label}="{_escape_label_value(label_value)}"'
+                                  for (label, label_value) in sorted(labels.items()))
+            lines.append(f"{name}{suffix}{{{label_text}}} {value}" if label_text else f"{name}{suffix} {value}")
+
+
+def _escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
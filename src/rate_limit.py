@@ -0,0 +1,150 @@
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+# Responses retried as transient: rate limited or temporarily unavailable
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+# Reasons Google gives for rate limiting when answering with 403 Forbidden rather than 429
+RATE_LIMIT_REASONS = ["rateLimitExceeded", "userRateLimitExceeded"]
+
+# Retries made after the first attempt, waiting a random time up to RETRY_BASE_DELAY seconds
+# after the first failure, doubling the bound after each further one up to RETRY_MAX_DELAY
+MAX_RETRIES = 5
+RETRY_BASE_DELAY = 1
+RETRY_MAX_DELAY = 32
+# Upper bound on waiting for a Retry-After, so a bogus one can't stall a sync indefinitely
+RETRY_AFTER_MAX_DELAY = 300
+
+
+class RateLimiter():
+    """
+    Token bucket limiting requests to qps per second on average, allowing
+    bursts of up to a second's worth. Shared by all threads making requests;
+    each caller reserves its token up front and sleeps outside the lock, so
+    callers are served in the order they arrive.
+    """
+
+    def __init__(self, qps):
+        """
+        :param qps: float, requests per second, or 0 not to limit requests
+        """
+        self.qps = qps
+        self._clock = time.monotonic
+        self._sleep = time.sleep
+        self._lock = threading.Lock()
+        self._tokens = None
+        self._updated = None
+
+    def acquire(self):
+        """
+        Waits until a request may be made
+        :return: none
+        """
+        if not self.qps:
+            return
+        burst = max(1.0, self.qps)
+        with self._lock:
+            now = self._clock()
+            if self._tokens is None:
+                self._tokens = burst
+            else:
+                self._tokens = min(burst, self._tokens + (now - self._updated) * self.qps)
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.qps if self._tokens < 0 else 0
+        if wait > 0:
+            self._sleep(wait)
+
+
+class Backoff():
+    """
+    Decides whether a Google API call is retried and how long to wait first:
+    rate limited (429, or 403 with a rate limit reason) and unavailable (5xx)
+    responses are retried up to max_retries times, after the delay asked for by
+    their Retry-After header or else after a jittered exponential delay.
+    """
+
+    def __init__(self, max_retries=MAX_RETRIES, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._random = random.random
+        self._sleep = time.sleep
+        self._now = lambda: datetime.now(timezone.utc)
+
+    def delay(self, attempt, status, retry_after=None, body=None):
+        """
+        :param attempt: int, number of the attempt that got the response, starting at 1
+        :param status: int, HTTP status of the response
+        :param retry_after: str, the response's Retry-After header, if any
+        :param body: function returning the response's body (str or bytes), only called for 403s
+        :return: float, seconds to wait before retrying, or None if the call isn't to be retried
+        """
+        if attempt > self.max_retries or not self._retryable(status, body):
+            return None
+        retry_after_delay = self._parse_retry_after(retry_after)
+        if retry_after_delay is not None:
+            return min(retry_after_delay, RETRY_AFTER_MAX_DELAY)
+        return self._random() * min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+
+    def wait(self, delay, description):
+        print(f"{description}, retrying in {delay:.1f}s", file=sys.stderr)
+        self._sleep(delay)
+
+    @staticmethod
+    def _retryable(status, body):
+        if status in RETRY_STATUSES:
+            return True
+        if status == 403 and body is not None:
+            content = body()
+            if isinstance(content, bytes):
+                content = content.decode('utf-8', 'replace')
+            return any(reason in content for reason in RATE_LIMIT_REASONS)
+        return False
+
+    def _parse_retry_after(self, retry_after):
+        from email.utils import parsedate_to_datetime
+        if not retry_after:
+            return None
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+        try:
+            date = parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            return None
+        if date is None:
+            return None
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=timezone.utc)
+        return max(0.0, (date - self._now()).total_seconds())
+
+
+class RateLimitedHttp():
+    """
+    httplib2.Http wrapper (as used by googleapiclient) making each request
+    through a rate limiter and retrying it as its backoff decides. Anything
+    else is delegated to the wrapped object.
+    """
+
+    def __init__(self, http, rate_limiter, backoff):
+        self._http = http
+        self._rate_limiter = rate_limiter
+        self._backoff = backoff
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        attempt = 1
+        while True:
+            self._rate_limiter.acquire()
+            (response, content) = self._http.request(uri, method, body=body, headers=headers, **kwargs)
+            delay = self._backoff.delay(attempt, response.status, response.get('retry-after'), lambda: content)
+            if delay is None:
+                return (response, content)
+            self._backoff.wait(delay, f"Google API call got {response.status}")
+            attempt += 1
+
+    def __getattr__(self, name):
+        return getattr(self._http, name)
@@ -0,0 +1,233 @@
+import json
+import os
+import sqlite3
+import threading
+
+STATE_DB_FILE_NAME = ".state.db"
+
+# Schema migrations, applied in order to bring a database up to
+# len(SCHEMA_MIGRATIONS), tracked through SQLite's user_version
+SCHEMA_MIGRATIONS = [
+    """
+    CREATE TABLE calendars (
+        id TEXT PRIMARY KEY,
+        etag TEXT,
+        sync_token TEXT,
+        caldav_etag TEXT,
+        caldav_last_modified TEXT,
+        content_hash TEXT,
+        byte_size INTEGER,
+        last_fetched REAL,
+        last_duration REAL
+    )
+    """,
+    """
+    CREATE TABLE maintenance_runs (
+        id INTEGER PRIMARY KEY,
+        head TEXT,
+        reason TEXT,
+        started REAL,
+        duration REAL
+    )
+    """,
+    # Change history, from which --adaptive picks how often each calendar is checked
+    "ALTER TABLE calendars ADD COLUMN last_checked REAL",
+    "ALTER TABLE calendars ADD COLUMN last_changed REAL",
+    "ALTER TABLE calendars ADD COLUMN change_interval REAL",
+    # Calendar API watch channel notifying changes of each calendar to the daemon's webhook receiver
+    "ALTER TABLE calendars ADD COLUMN channel_id TEXT",
+    "ALTER TABLE calendars ADD COLUMN channel_resource_id TEXT",
+    "ALTER TABLE calendars ADD COLUMN channel_token TEXT",
+    "ALTER TABLE calendars ADD COLUMN channel_expiration REAL",
+    """
+    CREATE TABLE calendar_list (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        etag TEXT,
+        items TEXT
+    )
+    """,
+]
+
+# Watch channels stay open at Google whatever is cached, so clear() keeps them
+CHANNEL_FIELDS = ['channel_id', 'channel_resource_id', 'channel_token', 'channel_expiration']
+CALENDAR_FIELDS = [
+    'etag', 'sync_token', 'caldav_etag', 'caldav_last_modified',
+    'content_hash', 'byte_size', 'last_fetched', 'last_duration',
+    'last_checked', 'last_changed', 'change_interval',
+] + CHANNEL_FIELDS
+
+# Flat cache file used before the state store, imported once and then removed
+LEGACY_ETAGS_FILE_NAME = ".etags"
+
+
+class StateStore():
+    """
+    Per-calendar sync state (etags, sync tokens, download validators, content
+    hash and size, fetch times, change history, watch channels), the user's
+    calendar list and the vault's maintenance history, kept in a SQLite
+    database in the config dir.
+    Changes are kept in memory until flush() writes them in one transaction;
+    values describing a download can be staged, and are only committed once
+    the download has been saved. The database runs in WAL mode, so other
+    processes can read it while a sync is writing.
+    """
+
+    def __init__(self, conf_dir, file_name=STATE_DB_FILE_NAME):
+        self._conf_dir = conf_dir
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            os.path.join(conf_dir, file_name), timeout=30, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._migrate_schema()
+        self._staged = {}
+        self._pending = {}
+        if file_name == STATE_DB_FILE_NAME:
+            # Legacy cache files only ever held the state of a single account
+            self._import_legacy_cache_files()
+
+    def get(self, cal_id):
+        """
+        Returns the state of a calendar, including changes not yet flushed
+        :param cal_id: Calendar ID
+        :return: dict<str, object> of CALENDAR_FIELDS (None where unknown)
+        """
+        key = self._key(cal_id)
+        with self._lock:
+            row = self._connection.execute("SELECT * FROM calendars WHERE id = ?", (key,)).fetchone()
+            state = {field: row[field] if row else None for field in CALENDAR_FIELDS}
+            state.update(self._pending.get(key, {}))
+        return state
+
+    def stage(self, cal_id, **values):
+        """
+        Stages values for a calendar, to be committed once its download is saved
+        """
+        self._staged.setdefault(self._key(cal_id), {}).update(self._check_fields(values))
+
+    def commit(self, cal_id):
+        key = self._key(cal_id)
+        if key in self._staged:
+            self._pending.setdefault(key, {}).update(self._staged.pop(key))
+
+    def update(self, cal_id, **values):
+        self._pending.setdefault(self._key(cal_id), {}).update(self._check_fields(values))
+
+    def flush(self):
+        """
+        Writes committed changes to the database in a single transaction
+        """
+        with self._lock:
+            if not self._pending:
+                return
+            with self._connection:
+                for (key, values) in self._pending.items():
+                    # Not an upsert (ON CONFLICT), which needs SQLite 3.24+
+                    fields = list(values)
+                    self._connection.execute("INSERT OR IGNORE INTO calendars (id) VALUES (?)", (key,))
+                    self._connection.execute(
+                        f"UPDATE calendars SET {', '.join(f'{field} = ?' for field in fields)} WHERE id = ?",
+                        [values[field] for field in fields] + [key])
+            self._pending = {}
+
+    def record_maintenance_run(self, head, reason, started, duration):
+        """
+        Records a run of vault repository maintenance, written immediately
+        :param head: SHA of the vault's HEAD as of the run
+        :param reason: Why the run was due
+        :param started: float, time the run started (seconds since the epoch)
+        :param duration: float, seconds the run took
+        """
+        with self._lock:
+            with self._connection:
+                self._connection.execute(
+                    "INSERT INTO maintenance_runs (head, reason, started, duration) VALUES (?, ?, ?, ?)",
+                    (head, reason, started, duration))
+
+    def last_maintenance_run(self):
+        """
+        :return: dict<str, object> of the last maintenance run's head, reason, started and
+                 duration, or None if maintenance never ran
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT head, reason, started, duration FROM maintenance_runs ORDER BY id DESC LIMIT 1").fetchone()
+        return dict(row) if row else None
+
+    def record_calendar_list(self, etag, items):
+        """
+        Caches the user's calendar list, written immediately
+        :param etag: Etag of the listing
+        :param items: list<dict> of the calendars listed
+        """
+        with self._lock:
+            with self._connection:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO calendar_list (id, etag, items) VALUES (1, ?, ?)",
+                    (etag, json.dumps(items)))
+
+    def last_calendar_list(self):
+        """
+        :return: dict<str, object> of the cached calendar list's etag and items, or None if none is cached
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT etag, items FROM calendar_list WHERE id = 1").fetchone()
+        return {'etag': row['etag'], 'items': json.loads(row['items'])} if row else None
+
+    def clear(self):
+        """
+        Forgets the state of all calendars, other than their watch channels,
+        and the cached calendar list
+        """
+        cleared_fields = [field for field in CALENDAR_FIELDS if field not in CHANNEL_FIELDS]
+        with self._lock:
+            with self._connection:
+                self._connection.execute("DELETE FROM calendar_list")
+                self._connection.execute("DELETE FROM calendars WHERE channel_id IS NULL")
+                self._connection.execute(
+                    f"UPDATE calendars SET {', '.join(f'{field} = NULL' for field in cleared_fields)}")
+            self._staged = {}
+            pending = {key: {field: value for (field, value) in values.items() if field in CHANNEL_FIELDS}
+                       for (key, values) in self._pending.items()}
+            self._pending = {key: values for (key, values) in pending.items() if values}
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def _key(cal_id):
+        return cal_id.strip().lower()
+
+    @staticmethod
+    def _check_fields(values):
+        for field in values:
+            if field not in CALENDAR_FIELDS:
+                raise ValueError(f"Unknown calendar state field '{field}'")
+        return values
+
+    def _migrate_schema(self):
+        version = self._connection.execute("PRAGMA user_version").fetchone()[0]
+        for (i, statement) in enumerate(SCHEMA_MIGRATIONS[version:], start=version + 1):
+            with self._connection:
+                self._connection.execute(statement)
+                self._connection.execute(f"PRAGMA user_version = {i}")
+
+    def _import_legacy_cache_files(self):
+        etags_file_path = os.path.join(self._conf_dir, LEGACY_ETAGS_FILE_NAME)
+        if not os.path.exists(etags_file_path):
+            return
+        with open(etags_file_path, 'r') as file:
+            for line in file:
+                fields = line.split()
+                if len(fields) == 2:
+                    # Quotes were stripped from etags in the legacy cache
+                    self.update(fields[0], etag=f'"{fields[1]}"')
+        self.flush()
+        os.remove(etags_file_path)
@@ -0,0 +1,21 @@
+import os
+import uuid
+from contextlib import contextmanager
+
+
+@contextmanager
+def temp_file(file_path):
+    """
+    Provides a unique path for a temp file next to a file, on the same file
+    system so that os.replace() can atomically move it in place of the file.
+    The temp file is removed on exit unless it was moved in place.
+    :param file_path: Path of the file the temp file is written for
+    :return: str, path of the temp file (the file itself is not created)
+    """
+    temp_file_path = os.path.join(
+        os.path.dirname(os.path.abspath(file_path)), f".{os.path.basename(file_path)}.{uuid.uuid4().hex}.tmp")
+    try:
+        yield temp_file_path
+    finally:
+        if os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
@@ -0,0 +1,116 @@
+import hmac
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+# Resource state of the notification Google sends when a channel is opened, rather than for a change
+SYNC_RESOURCE_STATE = "sync"
+# How long notifications keep being collected after the first one, since Google tends to send
+# a burst of them for a single edit (and edits often come in bursts, too)
+NOTIFICATION_DELAY = 10
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer, which only exists as of Python 3.7
+    daemon_threads = True
+
+
+class WebhookReceiver():
+    """
+    HTTP server receiving Calendar API push notifications in a background
+    thread. Notifications are only accepted for channels registered with
+    register(), and only if they carry the channel's token; the key each
+    channel was registered with is then queued, for wait() to hand out.
+    """
+
+    def __init__(self, port, host=""):
+        self._condition = threading.Condition()
+        self._channels = {}
+        self._notified = set()
+        self._notified_at = None
+        self._server = _ThreadingHTTPServer((host, port), self._handler_class())
+        self._thread = threading.Thread(target=self._server.serve_forever, name="webhook-receiver", daemon=True)
+        self._thread.start()
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def register(self, channel_id, token, key):
+        """
+        Accepts notifications of a channel
+        :param channel_id: ID of the channel
+        :param token: Token the channel was opened with, which its notifications must carry
+        :param key: What wait() hands out when the channel is notified, e.g. the user and calendar ID watched
+        :return: none
+        """
+        with self._condition:
+            self._channels[channel_id] = (token, key)
+
+    def unregister(self, channel_id):
+        with self._condition:
+            self._channels.pop(channel_id, None)
+
+    def wait(self, timeout):
+        """
+        Waits for notifications, and once one arrives keeps collecting them for
+        up to NOTIFICATION_DELAY seconds more (but no longer than timeout)
+        :param timeout: float, seconds to wait at most
+        :return: set of the keys of the channels notified, empty if none were
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                if self._notified:
+                    wake_time = min(deadline, self._notified_at + NOTIFICATION_DELAY)
+                else:
+                    wake_time = deadline
+                if now >= wake_time:
+                    break
+                self._condition.wait(wake_time - now)
+            (notified, self._notified, self._notified_at) = (self._notified, set(), None)
+        return notified
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def _notify(self, channel_id, token, resource_state):
+        """
+        :return: int, HTTP status to answer the notification with
+        """
+        with self._condition:
+            channel = self._channels.get(channel_id)
+            if channel is None:
+                return 404
+            if not hmac.compare_digest(channel[0].encode('utf-8'), (token or "").encode('utf-8')):
+                return 403
+            if resource_state != SYNC_RESOURCE_STATE:
+                if not self._notified:
+                    self._notified_at = time.monotonic()
+                self._notified.add(channel[1])
+                self._condition.notify_all()
+            return 200
+
+    def _handler_class(self):
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                # Notifications have no body of interest, only headers
+                self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                status = receiver._notify(self.headers.get("X-Goog-Channel-ID"),
+                                          self.headers.get("X-Goog-Channel-Token"),
+                                          self.headers.get("X-Goog-Resource-State"))
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
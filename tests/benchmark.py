@@ -0,0 +1,242 @@
+"""
+Benchmarks gcalvault syncs end to end against a local stand-in for Google's
+Calendar v3 and CalDAV endpoints (see fake_google.FakeGoogleServer), serving
+synthetic accounts. Three syncs are run into the same vault: a cold one, one
+where nothing changed, and one where some events of some calendars changed.
+Each sync runs in a fresh interpreter, so its peak RSS and import costs are
+its own, and reports wall time, requests made (and failed), peak RSS and time
+spent in git.
+
+Usage:
+  python -m tests.benchmark [--users N] [--calendars N] [--events N]
+      [--description-size N] [--latency SECONDS] [--error-rate RATE]
+      [--changed-share RATE] [--json] [--verbose] [-- <gcalvault options>]
+
+Options after "--" are passed to gcalvault sync, e.g. "-- --layout event --normalize".
+"""
+
+import argparse
+import contextlib
+import json
+import math
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+from .fake_google import FakeGoogleServer
+
+GOOGLE_APIS_ROOT_URL = "https://www.googleapis.com/"
+SCOPES = [
+    "openid",
+    "https://www.googleapis.com/auth/userinfo.email",
+    "https://www.googleapis.com/auth/calendar.readonly",
+]
+EVENTS_START = datetime(2021, 6, 1, 9, 0)
+FILLER_TEXT = "Lorem ipsum dolor sit amet, consectetur adipiscing elit. "
+# Every this many events is modified in a changed calendar
+CHANGED_EVENT_INTERVAL = 10
+
+
+def run_benchmark(users=1, calendars=10, events=500, description_size=200, latency=0, error_rate=0,
+                  changed_share=0.1, gcalvault_args=(), verbose=False):
+    """
+    :return: list<dict<str, object>>, the results of each sync
+    """
+    accounts = {}
+    for i in range(users):
+        user = f"user{i}@example.com"
+        cal_ids = [user] + [f"cal{j}.user{i}@group.calendar.google.com" for j in range(1, calendars)]
+        accounts[user] = {cal_id: synthetic_ics(cal_id, events, description_size) for cal_id in cal_ids}
+    work_dir = tempfile.mkdtemp(prefix="gcalvault-benchmark-")
+    conf_dir = os.path.join(work_dir, "conf")
+    output_dir = os.path.join(work_dir, "output")
+    os.makedirs(conf_dir)
+    args = ["sync", "--all-users"] if users > 1 else ["sync", next(iter(accounts))]
+    args += ["-c", conf_dir, "-o", output_dir, *gcalvault_args]
+    results = []
+    try:
+        with FakeGoogleServer(accounts, latency=latency, error_rate=error_rate) as server:
+            _write_tokens(conf_dir, accounts)
+            results.append(_run("cold", server, args, verbose))
+            results.append(_run("unchanged", server, args, verbose))
+            for calendar_bodies in accounts.values():
+                changed_cal_ids = list(calendar_bodies)[:math.ceil(len(calendar_bodies) * changed_share)]
+                for cal_id in changed_cal_ids:
+                    server.update_calendar(cal_id, synthetic_ics(cal_id, events, description_size, revision=1))
+            results.append(_run("changed", server, args, verbose))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def synthetic_ics(cal_id, events, description_size, revision=0):
+    """
+    Generates a calendar export shaped like Google's, with events of a given
+    description size. Revisions after the first modify every
+    CHANGED_EVENT_INTERVAL-th event.
+    """
+    lines = [
+        "BEGIN:VCALENDAR",
+        "PRODID:-//Google Inc//Google Calendar 70.9054//EN",
+        "VERSION:2.0",
+        "CALSCALE:GREGORIAN",
+        "METHOD:PUBLISH",
+        f"X-WR-CALNAME:{cal_id}",
+        "X-WR-TIMEZONE:UTC",
+    ]
+    description = (FILLER_TEXT * (description_size // len(FILLER_TEXT) + 1))[:description_size]
+    for i in range(events):
+        start = EVENTS_START + timedelta(hours=i)
+        changed = revision and i % CHANGED_EVENT_INTERVAL == 0
+        modified = start - timedelta(days=30 if not changed else -1)
+        lines += [
+            "BEGIN:VEVENT",
+            f"DTSTART:{start:%Y%m%dT%H%M%SZ}",
+            f"DTEND:{start + timedelta(minutes=30):%Y%m%dT%H%M%SZ}",
+            "DTSTAMP:20210601T120000Z",
+            f"UID:{i:08d}.{cal_id}",
+            f"CREATED:{start - timedelta(days=30):%Y%m%dT%H%M%SZ}",
+            f"LAST-MODIFIED:{modified:%Y%m%dT%H%M%SZ}",
+            *_fold(f"DESCRIPTION:{description}"),
+            "SEQUENCE:0",
+            "STATUS:CONFIRMED",
+            f"SUMMARY:Event {i}{f' (revision {revision})' if changed else ''}",
+            "TRANSP:OPAQUE",
+            "END:VEVENT",
+        ]
+    lines.append("END:VCALENDAR")
+    return "\r\n".join(lines) + "\r\n"
+
+
+def _fold(line):
+    return [line[:75]] + [f" {line[i:i + 74]}" for i in range(75, len(line), 74)]
+
+
+def _write_tokens(conf_dir, accounts):
+    from google.oauth2.credentials import Credentials
+    for user in accounts:
+        credentials = Credentials(
+            FakeGoogleServer.token(user), refresh_token="refresh", token_uri="https://oauth2.googleapis.com/token",
+            client_id="client-id", client_secret="client-secret", scopes=SCOPES,
+            expiry=datetime.utcnow().replace(microsecond=0) + timedelta(days=1))
+        with open(os.path.join(conf_dir, f"{user}.token.json"), 'w') as file:
+            file.write(credentials.to_json())
+    with open(os.path.join(conf_dir, ".users"), 'w') as file:
+        file.writelines(f"{user}\n" for user in accounts)
+
+
+def _run(name, server, args, verbose):
+    (requests, errors) = (len(server.requests), server.errors)
+    # A fresh interpreter per sync, so peak RSS and imports are measured for the sync alone
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        result = pool.apply(_sync, (server.url, server.caldav_uri_format, args, verbose))
+    return dict(result, run=name, requests=len(server.requests) - requests, errors=server.errors - errors)
+
+
+def _sync(server_url, caldav_uri_format, args, verbose):
+    from gcalvault import Gcalvault
+    from gcalvault.gcalvault import GoogleApis
+    from gcalvault.git_vault_repo import GitVaultRepo
+
+    git_time = _time_methods(GitVaultRepo, ["__init__", "commit", "maintain"])
+    google_apis = GoogleApis()
+    google_apis.caldav_uri_format = caldav_uri_format
+    authorized_http = google_apis._authorized_http
+    google_apis._authorized_http = lambda credentials: RedirectingHttp(authorized_http(credentials), server_url)
+
+    output = contextlib.ExitStack()
+    if not verbose:
+        devnull = output.enter_context(open(os.devnull, 'w'))
+        output.enter_context(contextlib.redirect_stdout(devnull))
+        output.enter_context(contextlib.redirect_stderr(devnull))
+    with output:
+        started = time.perf_counter()
+        Gcalvault(google_apis=google_apis).run(args)
+        wall_time = time.perf_counter() - started
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        'wall_time': wall_time,
+        'peak_rss': peak_rss if sys.platform == "darwin" else peak_rss * 1024,
+        'git_time': git_time[0],
+    }
+
+
+def _time_methods(cls, method_names):
+    """
+    Wraps methods of a class so the time spent in them (summed across threads) is tallied
+    :return: list<float> holding the total, updated as the methods are called
+    """
+    total = [0.0]
+    lock = threading.Lock()
+
+    def timed(method):
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                with lock:
+                    total[0] += time.perf_counter() - started
+        return wrapper
+
+    for name in method_names:
+        setattr(cls, name, timed(getattr(cls, name)))
+    return total
+
+
+class RedirectingHttp():
+    """
+    httplib2.Http wrapper sending requests for Google's APIs to another root URL
+    """
+
+    def __init__(self, http, root_url):
+        self._http = http
+        self._root_url = root_url
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        if uri.startswith(GOOGLE_APIS_ROOT_URL):
+            uri = self._root_url + uri[len(GOOGLE_APIS_ROOT_URL):]
+        return self._http.request(uri, method, body=body, headers=headers, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._http, name)
+
+
+def _print_report(results):
+    print(f"{'run':<10} {'wall':>9} {'requests':>9} {'errors':>7} {'peak RSS':>10} {'git':>8}")
+    for result in results:
+        print(f"{result['run']:<10} {result['wall_time']:>8.2f}s {result['requests']:>9} {result['errors']:>7} "
+              f"{result['peak_rss'] / 1024 / 1024:>6.1f} MiB {result['git_time']:>7.2f}s")
+
+
+def main(argv):
+    (argv, gcalvault_args) = (argv[:argv.index("--")], argv[argv.index("--") + 1:]) if "--" in argv else (argv, [])
+    parser = argparse.ArgumentParser(prog="python -m tests.benchmark", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=1, help="accounts synced (with --all-users if more than 1)")
+    parser.add_argument("--calendars", type=int, default=10, help="calendars per account")
+    parser.add_argument("--events", type=int, default=500, help="events per calendar")
+    parser.add_argument("--description-size", type=int, default=200, help="characters of description per event")
+    parser.add_argument("--latency", type=float, default=0, help="seconds each request is delayed by")
+    parser.add_argument("--error-rate", type=float, default=0, help="share of requests failing with 503")
+    parser.add_argument("--changed-share", type=float, default=0.1, help="share of calendars changed for the last run")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    parser.add_argument("--verbose", action="store_true", help="show gcalvault's output")
+    options = parser.parse_args(argv)
+    results = run_benchmark(
+        users=options.users, calendars=options.calendars, events=options.events,
+        description_size=options.description_size, latency=options.latency, error_rate=options.error_rate,
+        changed_share=options.changed_share, gcalvault_args=gcalvault_args, verbose=options.verbose)
+    if options.json:
+        print(json.dumps(results, indent=2))
+    else:
+        _print_report(results)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,335 @@
+import gzip
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+from email.parser import FeedParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httplib2
+
+# Local stand-ins for Google's endpoints, so the real googleapiclient
+# request/batch machinery can be exercised without going over the network.
+
+BATCH_PATH = "/batch/calendar/v3"
+CALENDAR_LIST_PATH = "/calendar/v3/users/me/calendarList"
+# Calendar list page sizes, as documented for calendarList.list
+CALENDAR_LIST_DEFAULT_PAGE_SIZE = 100
+CALENDAR_LIST_MAX_PAGE_SIZE = 250
+EVENTS_PATH_RE = re.compile(r"^/calendar/v3/calendars/(?P<cal_id>[^/]+)/events$")
+WATCH_PATH_RE = re.compile(r"^/calendar/v3/calendars/(?P<cal_id>[^/]+)/events/watch$")
+CHANNELS_STOP_PATH = "/calendar/v3/channels/stop"
+CALDAV_PATH_RE = re.compile(r"^/caldav/v2/(?P<cal_id>[^/]+)/events$")
+
+
+def rate_limit_error(status):
+    return {'error': {'code': status, 'message': "Rate Limit Exceeded",
+                      'errors': [{'domain': "usageLimits", 'reason': "rateLimitExceeded"}]}}
+
+
+class FakeCalendarHttp():
+    """
+    httplib2.Http replacement answering Calendar v3 events.list requests, both
+    individually and through the batch endpoint. Listings without a sync token
+    are served in two pages, ending with the sync token "sync-<calendar ID>";
+    listings with a sync token return the given changes (or 410 Gone for an
+    expired token) and the sync token "<sync token>+1". The first requests are
+    answered with the given rate limiting statuses (429, or 403 with a
+    rateLimitExceeded reason), asking to be retried right away. When given a
+    calendar list, calendarList.list is answered too, paged like Google does
+    and with a content-based etag honoured through If-None-Match.
+    Channels opened through events.watch are kept in channels, and those
+    closed through channels.stop in stopped_channels.
+    """
+
+    def __init__(self, etags, failing_in_batch=(), changes={}, expired_sync_tokens=(), throttled=(),
+                 calendar_list=None):
+        self.etags = etags
+        self.calendar_list = calendar_list
+        self.failing_in_batch = failing_in_batch
+        self.changes = changes
+        self.expired_sync_tokens = expired_sync_tokens
+        self.throttled = list(throttled)
+        self.requests = []
+        self.channels = {}
+        self.stopped_channels = []
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        self.requests.append((method, uri))
+        if self.throttled:
+            status = self.throttled.pop(0)
+            return (httplib2.Response({'status': status, 'content-type': 'application/json', 'retry-after': "0"}),
+                    json.dumps(rate_limit_error(status)).encode('utf-8'))
+        path = urllib.parse.urlparse(uri).path
+        if path == BATCH_PATH:
+            return self._batch_response(body, headers)
+        if method == "POST" and (WATCH_PATH_RE.match(path) or path == CHANNELS_STOP_PATH):
+            return self._channel_response(path, json.loads(body))
+        if_none_match = next((value for (name, value) in (headers or {}).items()
+                              if name.lower() == "if-none-match"), None)
+        if path == CALENDAR_LIST_PATH and self.calendar_list is not None and \
+                if_none_match == self.calendar_list_etag:
+            return (httplib2.Response({'status': 304}), b"")
+        (status, payload) = self._dispatch(method, uri)
+        return (httplib2.Response({'status': status, 'content-type': 'application/json'}),
+                json.dumps(payload).encode('utf-8'))
+
+    def close(self):
+        pass
+
+    @property
+    def round_trips(self):
+        return len(self.requests)
+
+    @property
+    def calendar_list_etag(self):
+        return f'"{hashlib.md5(json.dumps(self.calendar_list).encode("utf-8")).hexdigest()}"'
+
+    def _dispatch(self, method, uri, in_batch=False):
+        if method == "GET" and self.calendar_list is not None and \
+                urllib.parse.urlparse(uri).path == CALENDAR_LIST_PATH:
+            return (200, self._calendar_list_page(urllib.parse.parse_qs(urllib.parse.urlparse(uri).query)))
+        match = EVENTS_PATH_RE.match(urllib.parse.urlparse(uri).path)
+        if method != "GET" or match is None:
+            return (404, {'error': {'code': 404, 'message': "Not Found"}})
+        cal_id = urllib.parse.unquote(match.group('cal_id'))
+        if cal_id not in self.etags:
+            return (404, {'error': {'code': 404, 'message': "Not Found"}})
+        if in_batch and cal_id in self.failing_in_batch:
+            return (500, {'error': {'code': 500, 'message': "Backend Error"}})
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(uri).query)
+        if 'syncToken' in query:
+            sync_token = query['syncToken'][0]
+            if sync_token in self.expired_sync_tokens:
+                return (410, {'error': {'code': 410, 'message': "Sync token is no longer valid"}})
+            return (200, {'items': self.changes.get(cal_id, []), 'nextSyncToken': f"{sync_token}+1"})
+        if query.get('maxResults') == ["1"]:
+            return (200, {'kind': "calendar#events", 'etag': self.etags[cal_id], 'items': []})
+        if 'pageToken' not in query:
+            return (200, {'nextPageToken': "page2"})
+        return (200, {'nextSyncToken': f"sync-{cal_id}"})
+
+    def _channel_response(self, path, channel):
+        if path == CHANNELS_STOP_PATH:
+            self.stopped_channels.append((channel['id'], channel['resourceId']))
+            return (httplib2.Response({'status': 204}), b"")
+        cal_id = urllib.parse.unquote(WATCH_PATH_RE.match(path).group('cal_id'))
+        expiration = int((time.time() + int(channel['params']['ttl'])) * 1000)
+        self.channels[channel['id']] = dict(channel, calendarId=cal_id)
+        payload = {'kind': "api#channel", 'id': channel['id'], 'resourceId': f"resource-{cal_id}",
+                   'token': channel['token'], 'expiration': str(expiration)}
+        return (httplib2.Response({'status': 200, 'content-type': 'application/json'}),
+                json.dumps(payload).encode('utf-8'))
+
+    def _calendar_list_page(self, query):
+        page_size = min(int(query.get('maxResults', [CALENDAR_LIST_DEFAULT_PAGE_SIZE])[0]), CALENDAR_LIST_MAX_PAGE_SIZE)
+        start = int(query.get('pageToken', ["0"])[0])
+        page = {'kind': "calendar#calendarList", 'etag': self.calendar_list_etag,
+                'items': self.calendar_list[start:start + page_size]}
+        if start + page_size < len(self.calendar_list):
+            page['nextPageToken'] = str(start + page_size)
+        return page
+
+    def _batch_response(self, body, headers):
+        parser = FeedParser()
+        parser.feed(f"content-type: {headers['content-type']}\r\n\r\n{body}")
+        boundary = "batch_fake_google_boundary"
+        parts = []
+        for part in parser.close().get_payload():
+            (method, path, _) = part.get_payload().splitlines()[0].split(" ", 2)
+            (status, payload) = self._dispatch(method, path, in_batch=True)
+            content_id = re.sub(r"\r?\n", "", part['Content-ID'])
+            parts.append(
+                f"--{boundary}\r\n"
+                f"Content-Type: application/http\r\n"
+                f"Content-ID: <response-{content_id[1:]}\r\n\r\n"
+                f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                f"Content-Type: application/json\r\n\r\n"
+                f"{json.dumps(payload)}\r\n")
+        content = "".join(parts) + f"--{boundary}--\r\n"
+        return (httplib2.Response({'status': 200, 'content-type': f"multipart/mixed; boundary={boundary}"}),
+                content.encode('utf-8'))
+
+
+class FakeCalDavServer():
+    """
+    Local HTTP server standing in for Google's CalDAV endpoint, serving
+    ICS bodies (gzip-compressed when the client accepts it, with a content-based
+    ETag honoured through If-None-Match) and recording each request along with
+    the connection it arrived on. The first requests are answered with the
+    given throttling statuses, with a Retry-After of 0 for 429s
+    """
+
+    def __init__(self, ics_bodies, throttled=()):
+        self.ics_bodies = {cal_id: body.encode('utf-8') for (cal_id, body) in ics_bodies.items()}
+        self._gzipped_bodies = {cal_id: gzip.compress(body) for (cal_id, body) in self.ics_bodies.items()}
+        self.throttled = list(throttled)
+        self.requests = []
+        self.connections = set()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+    @property
+    def caldav_uri_format(self):
+        (host, port) = self._server.server_address
+        return f"http://{host}:{port}/caldav/v2/{{cal_id}}/events"
+
+    def etag(self, cal_id):
+        return f'"{hashlib.md5(self.ics_bodies[cal_id]).hexdigest()}"'
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                server.requests.append((self.path, dict(self.headers)))
+                server.connections.add(self.client_address)
+                if server.throttled:
+                    status = server.throttled.pop(0)
+                    self._respond(status, json.dumps(rate_limit_error(status)).encode('utf-8'), "application/json",
+                                  retry_after="0" if status == 429 else None)
+                    return
+                match = CALDAV_PATH_RE.match(urllib.parse.urlparse(self.path).path)
+                cal_id = urllib.parse.unquote(match.group('cal_id')) if match else None
+                if cal_id not in server.ics_bodies:
+                    self._respond(404, b"Not Found")
+                    return
+                if self.headers.get("If-None-Match") == server.etag(cal_id):
+                    self.send_response(304)
+                    self.send_header("ETag", server.etag(cal_id))
+                    self.end_headers()
+                    return
+                if "gzip" in self.headers.get("Accept-Encoding", ""):
+                    self._respond(200, server._gzipped_bodies[cal_id], "text/calendar", "gzip", server.etag(cal_id))
+                else:
+                    self._respond(200, server.ics_bodies[cal_id], "text/calendar", None, server.etag(cal_id))
+
+            def _respond(self, status, body, content_type="text/plain", content_encoding=None, etag=None,
+                         retry_after=None):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                if retry_after is not None:
+                    self.send_header("Retry-After", retry_after)
+                if etag:
+                    self.send_header("ETag", etag)
+                    self.send_header("Last-Modified", "Wed, 02 Jun 2021 09:00:00 GMT")
+                if content_encoding:
+                    self.send_header("Content-Encoding", content_encoding)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+class FakeGoogleServer(FakeCalDavServer):
+    """
+    Local HTTP server standing in for both the Calendar v3 API and the CalDAV
+    endpoint, for any number of accounts, told apart by their bearer tokens
+    ("token-<user>", see token()). Requests can be delayed by a fixed latency,
+    and a random share of them (seeded, so runs are repeatable) answered with
+    503 Service Unavailable instead.
+    """
+
+    def __init__(self, accounts, latency=0, error_rate=0, seed=0):
+        """
+        :param accounts: dict<str, dict<str, str>> of user to calendar ID to ICS body
+        :param latency: float, seconds each request is delayed by
+        :param error_rate: float, share of requests answered with 503
+        """
+        super().__init__({cal_id: body for calendars in accounts.values() for (cal_id, body) in calendars.items()})
+        self.latency = latency
+        self.error_rate = error_rate
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self._calendar_https = {
+            self.token(user): FakeCalendarHttp(
+                {cal_id: self.etag(cal_id) for cal_id in calendars},
+                calendar_list=[
+                    {'kind': "calendar#calendarListEntry", 'id': cal_id, 'etag': self.etag(cal_id),
+                     'summary': cal_id, 'accessRole': "owner" if cal_id == user else "reader"}
+                    for cal_id in calendars])
+            for (user, calendars) in accounts.items()}
+
+    @staticmethod
+    def token(user):
+        return f"token-{user}"
+
+    def update_calendar(self, cal_id, body):
+        """
+        Replaces the ICS body of a calendar, changing its etags accordingly
+        """
+        self.ics_bodies[cal_id] = body.encode('utf-8')
+        self._gzipped_bodies[cal_id] = gzip.compress(self.ics_bodies[cal_id])
+        for calendar_http in self._calendar_https.values():
+            if cal_id in calendar_http.etags:
+                calendar_http.etags[cal_id] = self.etag(cal_id)
+                for item in calendar_http.calendar_list:
+                    if item['id'] == cal_id:
+                        item['etag'] = self.etag(cal_id)
+
+    @property
+    def url(self):
+        (host, port) = self._server.server_address
+        return f"http://{host}:{port}/"
+
+    def _handler_class(self):
+        server = self
+        caldav_handler_class = super()._handler_class()
+
+        class Handler(caldav_handler_class):
+
+            def do_GET(self):
+                if not self._pass_faults():
+                    return
+                if CALDAV_PATH_RE.match(urllib.parse.urlparse(self.path).path):
+                    super().do_GET()
+                else:
+                    self._calendar_api("GET", None)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self._pass_faults():
+                    self._calendar_api("POST", body.decode('utf-8'))
+
+            def _pass_faults(self):
+                if server.latency:
+                    time.sleep(server.latency)
+                with server._random_lock:
+                    failing = server._random.random() < server.error_rate
+                    server.errors += failing
+                if failing:
+                    server.requests.append((self.path, dict(self.headers)))
+                    self._respond(503, b'{"error": {"code": 503, "message": "Backend Error"}}', "application/json")
+                return not failing
+
+            def _calendar_api(self, method, body):
+                server.requests.append((self.path, dict(self.headers)))
+                token = self.headers.get("Authorization", "").replace("Bearer ", "", 1)
+                calendar_http = server._calendar_https.get(token)
+                if calendar_http is None:
+                    self._respond(401, b'{"error": {"code": 401, "message": "Invalid Credentials"}}',
+                                  "application/json")
+                    return
+                (response, content) = calendar_http.request(
+                    self.path, method, body, {name.lower(): value for (name, value) in self.headers.items()})
+                self._respond(response.status, content, response.get('content-type', "application/json"))
+
+        return Handler
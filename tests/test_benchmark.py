@@ -0,0 +1,15 @@
+from .benchmark import run_benchmark
+
+
+def test_benchmark_runs_end_to_end():
+    results = run_benchmark(users=2, calendars=3, events=20, gcalvault_args=["--qps", "0"])
+
+    assert [result['run'] for result in results] == ["cold", "unchanged", "changed"]
+    for result in results:
+        assert result['wall_time'] > 0
+        assert result['peak_rss'] > 0
+        assert result['git_time'] > 0
+        assert result['errors'] == 0
+    assert results[0]['requests'] == 2 * (1 + 1 + 3)  # per user: calendar list, batched etags, 3 downloads
+    assert results[1]['requests'] == 2 * (1 + 1)  # unchanged calendars aren't downloaded again
+    assert results[2]['requests'] == 2 * (1 + 1 + 1)  # one changed calendar per user
@@ -0,0 +1,45 @@
+from datetime import datetime
+import pytest
+from gcalvault.cron import CronSchedule
+
+
+@pytest.mark.parametrize(
+    "expression, after, expected", [
+        ("0 3 * * *", datetime(2021, 6, 1, 2, 59, 30), datetime(2021, 6, 1, 3, 0)),
+        ("0 3 * * *", datetime(2021, 6, 1, 3, 0), datetime(2021, 6, 2, 3, 0)),  # strictly after
+        ("*/15 * * * *", datetime(2021, 6, 1, 10, 7), datetime(2021, 6, 1, 10, 15)),
+        ("*/15 * * * *", datetime(2021, 6, 1, 10, 45), datetime(2021, 6, 1, 11, 0)),
+        ("30 8-18/2 * * *", datetime(2021, 6, 1, 18, 31), datetime(2021, 6, 2, 8, 30)),
+        ("0 0 1,15 * *", datetime(2021, 6, 2, 0, 0), datetime(2021, 6, 15, 0, 0)),
+        ("0 0 31 * *", datetime(2021, 6, 1, 0, 0), datetime(2021, 7, 31, 0, 0)),  # skips June
+        ("0 12 * * mon-fri", datetime(2021, 6, 4, 12, 0), datetime(2021, 6, 7, 12, 0)),  # Fri -> Mon
+        ("0 12 * * 0", datetime(2021, 6, 1, 0, 0), datetime(2021, 6, 6, 12, 0)),  # Sunday
+        ("0 12 * * 7", datetime(2021, 6, 1, 0, 0), datetime(2021, 6, 6, 12, 0)),  # Sunday, too
+        ("0 0 13 * fri", datetime(2021, 6, 1, 0, 0), datetime(2021, 6, 4, 0, 0)),  # day OR weekday
+        ("0 0 1 jan *", datetime(2021, 6, 1, 0, 0), datetime(2022, 1, 1, 0, 0)),
+        ("0 0 29 feb *", datetime(2021, 3, 1, 0, 0), datetime(2024, 2, 29, 0, 0)),
+    ])
+def test_next_run(expression, after, expected):
+    assert CronSchedule(expression).next_run(after) == expected
+
+
+@pytest.mark.parametrize(
+    "expression", [
+        "0 3 * *",
+        "60 * * * *",
+        "* 24 * * *",
+        "* * 0 * *",
+        "* * * 13 *",
+        "* * * * 8",
+        "5-1 * * * *",
+        "*/0 * * * *",
+        "* * * * funday",
+    ])
+def test_invalid_expression(expression):
+    with pytest.raises(ValueError):
+        CronSchedule(expression)
+
+
+def test_never_matches():
+    with pytest.raises(ValueError):
+        CronSchedule("0 0 30 feb *").next_run(datetime(2021, 1, 1))
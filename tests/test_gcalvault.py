@@ -1,14 +1,26 @@
 import os
 import re
 import json
+import urllib.parse
+import socket
+from datetime import datetime, timedelta
 from pathlib import Path
 import shutil
 import glob
+import hashlib
+import threading
+import time
+import tracemalloc
 import pytest
-from unittest.mock import MagicMock
+import requests
+from unittest.mock import MagicMock, patch
 from git import Repo
-from gcalvault import Gcalvault, GcalvaultError
-from gcalvault.gcalvault import GoogleOAuth2, GoogleApis
+from git.index.base import IndexFile
+from gcalvault import Gcalvault, GcalvaultError, ical, webhook
+from gcalvault.gcalvault import GoogleOAuth2, GoogleApis, GitVaultRepo
+from gcalvault.git_vault_repo import RemotePusher
+from gcalvault.state_store import StateStore, STATE_DB_FILE_NAME
+from .fake_google import FakeCalendarHttp, FakeCalDavServer
 
 # Note: Tests are meant to run in a container (see `make test`), so
 # tests here are written against the actual file system, including
@@ -28,6 +40,17 @@ data_dir_path = os.path.join(dirname, "data")
         ["--export-only"],  # valid option with no command
         ["noop"],  # valid command with no user
         ["noop", "foo.bar@gmail.com", "--ignore-role"],  # opt requiring value not provided
+        ["noop", "foo.bar@gmail.com", "--jobs", "0"],  # jobs must be positive
+        ["noop", "foo.bar@gmail.com", "--jobs", "many"],  # jobs must be numeric
+        ["noop", "foo.bar@gmail.com", "--timeout", "0"],  # timeout must be positive
+        ["noop", "foo.bar@gmail.com", "--qps", "-1"],  # qps can't be negative
+        ["noop", "foo.bar@gmail.com", "--schedule", "0 3 * *"],  # invalid cron expression
+        ["noop", "foo.bar@gmail.com", "--layout", "folders"],  # unknown layout
+        ["noop", "foo.bar@gmail.com", "--webhook-url", "http://example.com/notify"],  # webhooks need https
+        ["noop", "foo.bar@gmail.com", "--webhook-port", "65536"],  # port out of range
+        ["noop", "foo.bar@gmail.com", "--maintenance-commits", "-1"],  # threshold can't be negative
+        ["noop", "foo.bar@gmail.com", "--all-users"],  # user given along with --all-users
+        ["noop", "--all-users", "--account-jobs", "0"],  # account jobs must be positive
     ])
 def test_invalid_args(args):
     gc = Gcalvault()
@@ -81,6 +104,30 @@ def test_version(capsys, args):
             {'ignore_roles': ["reader"]}),
         (["noop", "foo.bar@gmail.com", "-i", "reader", "-i", "writer"],
             {'ignore_roles': ["reader", "writer"]}),
+        (["noop", "foo.bar@gmail.com", "--normalize"],
+            {'normalize': True}),
+        (["noop", "foo.bar@gmail.com", "--layout", "event"],
+            {'layout': "event"}),
+        (["noop", "foo.bar@gmail.com", "--adaptive"],
+            {'adaptive': True}),
+        (["noop", "foo.bar@gmail.com", "--webhook-url", "https://example.com/notify", "--webhook-port", "8443"],
+            {'webhook_url': "https://example.com/notify", 'webhook_port': 8443}),
+        (["noop", "foo.bar@gmail.com", "--maintenance-commits", "10", "--maintenance-loose-objects", "0"],
+            {'maintenance_commits': 10, 'maintenance_loose_objects': 0}),
+        (["noop", "--all-users", "--account-jobs", "2"],
+            {'all_users': True, 'account_jobs': 2}),
+        (["noop", "foo.bar@gmail.com", "-j", "8"],
+            {'jobs': 8}),
+        (["noop", "foo.bar@gmail.com", "--jobs", "1"],
+            {'jobs': 1}),
+        (["noop", "foo.bar@gmail.com", "--timeout", "7.5"],
+            {'timeout': 7.5}),
+        (["noop", "foo.bar@gmail.com", "--qps", "2.5"],
+            {'qps': 2.5}),
+        (["noop", "foo.bar@gmail.com", "--schedule", "*/30 * * * *"],
+            {'schedule': "*/30 * * * *"}),
+        (["noop", "foo.bar@gmail.com", "--metrics-file", "/tmp/metrics.jsonl", "--prometheus-file", "/tmp/g.prom"],
+            {'metrics_file': "/tmp/metrics.jsonl", 'prometheus_file': "/tmp/g.prom"}),
         (["noop", "foo.bar@gmail.com", "-c", "/tmp/conf"],
             {'conf_dir': "/tmp/conf"}),
         (["noop", "foo.bar@gmail.com", "--conf-dir", "/tmp/conf"],
@@ -375,6 +422,728 @@ def test_etags_some_added():
     _assert_ics_files_match(output_dir, expected_files_after)
 
 
+def test_ignore_roles_from_env(monkeypatch):
+    monkeypatch.setenv("IGNORE_ROLES", "Reader, writer")
+
+    gc = Gcalvault()
+    gc.run(["noop", "foo.bar@gmail.com", "-i", "owner"])
+
+    assert sorted(gc.ignore_roles) == ["owner", "reader", "writer"]
+
+
+def test_incremental_first_sync():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    google_apis = _get_google_apis_mock(cal_list="less")
+    gc = Gcalvault(google_oauth2=_get_google_oauth2_mock(), google_apis=google_apis)
+    gc.run(["sync", "foo.bar@gmail.com", "--incremental", "-c", conf_dir, "-o", output_dir])
+
+    expected_files = [
+        "foo.bar@gmail.com.ics",
+        "family123456789@group.calendar.google.com.ics",
+    ]
+    _assert_ics_files_match(output_dir, expected_files)
+    assert google_apis.requested_details == []  # sync tokens replace etag lookups
+    with StateStore(conf_dir) as state:
+        assert state.get("foo.bar@gmail.com")['sync_token'] == "sync-foo.bar@gmail.com"
+        assert state.get("family123456789@group.calendar.google.com")['sync_token'] == \
+            "sync-family123456789@group.calendar.google.com"
+
+
+def test_incremental_sync_tokens_taken_in_parallel():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(latency=0.5))
+    started = time.monotonic()
+    gc.run(["sync", "foo.bar@gmail.com", "--incremental", "--jobs", "4", "-c", conf_dir, "-o", output_dir])
+    elapsed = time.monotonic() - started
+
+    assert elapsed < 2  # 4 sync tokens @ 0.5s each would take 2s+ serially, before the downloads
+    _assert_ics_files_match(output_dir, [
+        "foo.bar@gmail.com.ics",
+        "foo.baz@gmail.com.ics",
+        "family123456789@group.calendar.google.com.ics",
+        "en.usa#holiday@group.v.calendar.google.com.ics",
+    ])
+
+
+def test_incremental_sync_changes():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock())
+    gc.run(["sync", "foo.bar@gmail.com", "--incremental", "-c", conf_dir, "-o", output_dir])
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(
+            cal_files={
+                "foo.bar@gmail.com": "foo.bar@gmail.com_alt.ics",
+                "en.usa#holiday@group.v.calendar.google.com": None,
+            },
+            cal_files_as_allowlist=True,
+            changes={
+                "foo.bar@gmail.com": [{'id': "1a2b3c4d5e6f", 'status': "confirmed"}],
+                "family123456789@group.calendar.google.com": [
+                    {'id': "2y3z4a5b6c7d", 'iCalUID': "2y3z4a5b6c7d@google.com", 'status': "cancelled"}],
+                "en.usa#holiday@group.v.calendar.google.com": None,  # sync token expired
+            }))
+    gc.run(["sync", "foo.bar@gmail.com", "--incremental", "-c", conf_dir, "-o", output_dir])
+
+    _assert_ics_file_content_match(output_dir, "foo.bar@gmail.com.ics", "foo.bar@gmail.com_alt.ics")
+    _assert_ics_file_content_match(output_dir, "foo.baz@gmail.com.ics")
+    _assert_ics_file_content_match(output_dir, "en.usa#holiday@group.v.calendar.google.com.ics")
+    family = _read_file(output_dir, "family123456789@group.calendar.google.com.ics")
+    assert "Soccer practice" not in family
+    assert "Grandma's birthday dinner" in family
+    _assert_git_repo_state(output_dir, commit_count=3, last_commit_file_count=2)  # holiday calendar is unchanged
+    with StateStore(conf_dir) as state:
+        assert state.get("foo.baz@gmail.com")['sync_token'] == "sync-foo.baz@gmail.com+1"
+        assert state.get("family123456789@group.calendar.google.com")['sync_token'] == \
+            "sync-family123456789@group.calendar.google.com+1"
+
+
+def test_cal_changes_batched():
+    cal_ids = ["foo.bar@gmail.com", "foo.baz@gmail.com", "en.usa#holiday@group.v.calendar.google.com"]
+    http = FakeCalendarHttp(
+        {cal_id: '"etag"' for cal_id in cal_ids},
+        changes={"foo.bar@gmail.com": [{'id': "abc", 'status': "cancelled"}]},
+        expired_sync_tokens=["expired"])
+    google_apis = _get_google_apis_with_http(http)
+    credentials = MagicMock(token="phony")
+
+    changes = google_apis.request_cal_changes_batch(
+        credentials, {"foo.bar@gmail.com": "t1", "foo.baz@gmail.com": "t2", cal_ids[2]: "expired"})
+
+    assert http.round_trips == 1
+    assert changes == {
+        "foo.bar@gmail.com": ([{'id': "abc", 'status': "cancelled"}], "t1+1"),
+        "foo.baz@gmail.com": ([], "t2+1"),
+        cal_ids[2]: None,
+    }
+    assert google_apis.request_cal_changes(credentials, "foo.baz@gmail.com", "expired") is None
+    assert google_apis.request_cal_sync_token(credentials, "foo.baz@gmail.com") == "sync-foo.baz@gmail.com"
+    assert http.round_trips == 4  # 1 batch, 1 changes, 2 pages for the sync token
+
+
+def test_conditional_sync():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    google_apis = _get_google_apis_mock()
+    gc = Gcalvault(google_oauth2=_get_google_oauth2_mock(), google_apis=google_apis)
+    gc.run(["sync", "foo.bar@gmail.com", "--conditional", "-c", conf_dir, "-o", output_dir])
+
+    google_apis = _get_google_apis_mock(cal_files={"foo.bar@gmail.com": "foo.bar@gmail.com_alt.ics"})
+    gc = Gcalvault(google_oauth2=_get_google_oauth2_mock(), google_apis=google_apis)
+    gc.run(["sync", "foo.bar@gmail.com", "--conditional", "-c", conf_dir, "-o", output_dir])
+
+    assert google_apis.requested_details == []  # conditional downloads replace etag lookups
+    _assert_ics_file_content_match(output_dir, "foo.bar@gmail.com.ics", "foo.bar@gmail.com_alt.ics")
+    _assert_ics_file_content_match(output_dir, "foo.baz@gmail.com.ics")
+    _assert_git_repo_state(output_dir, commit_count=3, last_commit_file_count=1)
+
+
+def test_caldav_download_conditional():
+    (conf_dir, output_dir) = _setup_dirs()
+    output_dir.mkdir(parents=True)
+    cal_file_path = os.path.join(output_dir, "foo.bar@gmail.com.ics")
+    ics_body = _read_data_file("foo.bar@gmail.com.ics")
+    google_apis = GoogleApis()
+    credentials = MagicMock(token="phony")
+
+    with FakeCalDavServer({"foo.bar@gmail.com": ics_body}) as server:
+        google_apis.caldav_uri_format = server.caldav_uri_format
+        (size, validators, _) = google_apis.save_cal_as_ical("foo.bar@gmail.com", credentials, cal_file_path)
+        assert validators == {
+            'etag': server.etag("foo.bar@gmail.com"),
+            'last_modified': "Wed, 02 Jun 2021 09:00:00 GMT",
+        }
+        os.utime(cal_file_path, (0, 0))
+        assert google_apis.save_cal_as_ical("foo.bar@gmail.com", credentials, cal_file_path, validators) is None
+        google_apis.close()
+
+    assert server.requests[1][1]['If-None-Match'] == validators['etag']
+    assert server.requests[1][1]['If-Modified-Since'] == validators['last_modified']
+    assert os.path.getmtime(cal_file_path) == 0  # file untouched on 304
+    assert os.listdir(output_dir) == ["foo.bar@gmail.com.ics"]
+
+
+def test_daemon_syncs_on_schedule_with_warm_state():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    google_oauth2 = _get_google_oauth2_mock()
+    google_apis = _get_google_apis_mock(cal_list="less")
+    google_apis.request_cal_list = MagicMock(wraps=google_apis.request_cal_list)
+    gc = Gcalvault(google_oauth2=google_oauth2, google_apis=google_apis)
+    (sync_times, repos) = _run_daemon(gc, ["daemon", "foo.bar@gmail.com", "--schedule", "*/20 * * * *",
+                                           "-c", conf_dir, "-o", output_dir], syncs=4)
+
+    assert sync_times == [
+        datetime(2021, 6, 1, 8, 55),  # startup
+        datetime(2021, 6, 1, 9, 0),
+        datetime(2021, 6, 1, 9, 20),
+        datetime(2021, 6, 1, 9, 40),
+    ]
+    assert len(set(map(id, repos))) == 1  # vault repository opened once
+    assert google_oauth2.get_credentials.call_count == 1
+    assert google_apis.request_cal_list.call_count == 1  # calendar list reused within CALENDAR_LIST_MAX_AGE
+    _assert_ics_files_match(output_dir, ["foo.bar@gmail.com.ics", "family123456789@group.calendar.google.com.ics"])
+    _assert_git_repo_state(output_dir, commit_count=2)
+
+
+def test_daemon_survives_failed_sync(capsys):
+    (conf_dir, output_dir) = _setup_dirs()
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(failing_cal_ids=["foo.baz@gmail.com"]))
+    (sync_times, _) = _run_daemon(gc, ["daemon", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir], syncs=3)
+
+    assert sync_times == [datetime(2021, 6, 1, 8, 55), datetime(2021, 6, 2, 3, 0), datetime(2021, 6, 3, 3, 0)]
+    assert capsys.readouterr().err.count("Sync failed") == 2  # last sync is interrupted by the test
+
+
+def test_adaptive_sync_skips_calendars_not_due(capsys):
+    (conf_dir, output_dir) = _setup_dirs()
+    args = ["sync", "foo.bar@gmail.com", "--adaptive", "-c", conf_dir, "-o", output_dir]
+    gc = Gcalvault(google_oauth2=_get_google_oauth2_mock(), google_apis=_get_google_apis_mock(cal_list="less"))
+    gc._clock = lambda: datetime(2021, 6, 1, 9, 0)
+    gc.run(args)
+
+    # Recently edited every 20 minutes, and untouched for 10 days, respectively
+    state = StateStore(conf_dir)
+    checked = datetime(2021, 6, 1, 9, 0).timestamp()
+    state.update("foo.bar@gmail.com", last_changed=checked - 20 * 60, change_interval=20 * 60.0)
+    state.update("family123456789@group.calendar.google.com", last_changed=checked - 10 * 24 * 3600)
+    state.flush()
+    state.close()
+
+    google_apis = _get_google_apis_mock(
+        cal_list="less_alt_etag", cal_files={"foo.bar@gmail.com": "foo.bar@gmail.com_alt.ics"})
+    gc = Gcalvault(google_oauth2=_get_google_oauth2_mock(), google_apis=google_apis)
+    gc._clock = lambda: datetime(2021, 6, 1, 9, 5)
+    gc.run(args)
+    assert google_apis.requested_details == []
+    assert "Skipping 2 calendar(s) not yet due to be checked" in capsys.readouterr().out
+
+    gc = Gcalvault(google_oauth2=_get_google_oauth2_mock(), google_apis=google_apis)
+    gc._clock = lambda: datetime(2021, 6, 1, 9, 10)
+    gc.run(args)
+    assert google_apis.requested_details == ["foo.bar@gmail.com"]  # hot calendar due after 10 minutes
+    _assert_ics_file_content_match(output_dir, "foo.bar@gmail.com.ics", "foo.bar@gmail.com_alt.ics")
+    with StateStore(conf_dir) as state_store:
+        state = state_store.get("foo.bar@gmail.com")
+    assert state['last_changed'] == datetime(2021, 6, 1, 9, 10).timestamp()
+    assert state['change_interval'] == pytest.approx(0.3 * 30 * 60 + 0.7 * 20 * 60)
+
+    gc = Gcalvault(google_oauth2=_get_google_oauth2_mock(), google_apis=google_apis)
+    gc._clock = lambda: datetime(2021, 6, 2, 9, 0)
+    gc.run(args)
+    assert google_apis.requested_details == [
+        "foo.bar@gmail.com", "foo.bar@gmail.com", "family123456789@group.calendar.google.com"]  # cold after a day
+
+
+def test_daemon_adaptive_checks_backed_off_while_unchanged():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    google_apis = _get_google_apis_mock(cal_list="less")
+    gc = Gcalvault(google_oauth2=_get_google_oauth2_mock(), google_apis=google_apis)
+    (sync_times, _) = _run_daemon(gc, ["daemon", "foo.bar@gmail.com", "--adaptive",
+                                       "-c", conf_dir, "-o", output_dir], syncs=5)
+
+    assert sync_times == [
+        datetime(2021, 6, 1, 8, 55),  # startup
+        datetime(2021, 6, 1, 9, 0),  # minimum interval
+        datetime(2021, 6, 1, 9, 5),
+        datetime(2021, 6, 1, 9, 10),
+        datetime(2021, 6, 1, 9, 17, 30),  # half the 15 minutes since the last change
+    ]
+    assert len(google_apis.requested_details) == 2 * 5
+    _assert_git_repo_state(output_dir, commit_count=2)
+
+
+def test_daemon_all_users_adaptive():
+    (conf_dir, output_dir) = _setup_dirs()
+    conf_dir.mkdir(parents=True)
+    Path(conf_dir, ".users").write_text("foo.bar@gmail.com\nfoo.baz@gmail.com\n")
+
+    google_apis = _get_google_apis_mock(cal_list="less")
+    gc = Gcalvault(google_oauth2=_get_google_oauth2_mock(), google_apis=google_apis)
+    (sync_times, _) = _run_daemon(gc, ["daemon", "--all-users", "--adaptive",
+                                       "-c", conf_dir, "-o", output_dir], syncs=3)
+
+    assert sync_times == [
+        datetime(2021, 6, 1, 8, 55),  # startup
+        datetime(2021, 6, 1, 9, 0),  # minimum interval, from each account's own change history
+        datetime(2021, 6, 1, 9, 5),
+    ]
+    assert len(google_apis.requested_details) == 2 * 2 * 3
+    for user in ["foo.bar@gmail.com", "foo.baz@gmail.com"]:
+        _assert_git_repo_state(os.path.join(output_dir, user), commit_count=2)
+
+
+def test_daemon_syncs_calendars_notified_by_webhook(monkeypatch):
+    (conf_dir, output_dir) = _setup_dirs()
+    port = _free_port()
+    monkeypatch.setattr(webhook, "NOTIFICATION_DELAY", 0)
+    # Waiting for notifications on the simulated clock: none pending means the whole timeout passes
+    wait = webhook.WebhookReceiver.wait
+    monkeypatch.setattr(webhook.WebhookReceiver, "wait",
+                        lambda receiver, timeout: wait(receiver, 0) or gc._sleep(timeout) or set())
+
+    google_apis = _get_google_apis_mock(cal_list="less")
+    (channels, stopped_channels) = ([], [])
+
+    def watch_calendar(credentials, cal_id, channel_id, address, token, ttl):
+        assert (address, ttl) == ("https://example.com/notify", timedelta(days=7))
+        channels.append((cal_id, channel_id, token))
+        # The first channels only last 2 hours, as if Google capped their lifetime
+        expiration = datetime(2021, 6, 1, 10, 55) if len(channels) <= 2 else datetime(2021, 6, 8, 9, 55)
+        return {'id': channel_id, 'resourceId': f"resource-{cal_id}",
+                'expiration': f"{expiration.timestamp() * 1000:.0f}"}
+    google_apis.watch_calendar = watch_calendar
+    google_apis.stop_channel = lambda credentials, channel_id, resource_id: \
+        stopped_channels.append((channel_id, resource_id))
+
+    def on_sync(syncs):
+        if syncs == 1:
+            (_, channel_id, token) = next(channel for channel in channels if channel[0] == "foo.bar@gmail.com")
+            for (resource_state, token) in [("sync", token), ("exists", "forged"), ("exists", token)]:
+                requests.post(f"http://127.0.0.1:{port}/", timeout=5, headers={
+                    "X-Goog-Channel-ID": channel_id, "X-Goog-Channel-Token": token,
+                    "X-Goog-Resource-State": resource_state})
+
+    gc = Gcalvault(google_oauth2=_get_google_oauth2_mock(), google_apis=google_apis)
+    (sync_times, _) = _run_daemon(gc, ["daemon", "foo.bar@gmail.com", "--webhook-url", "https://example.com/notify",
+                                       "--webhook-port", str(port), "-c", conf_dir, "-o", output_dir],
+                                  syncs=3, on_sync=on_sync)
+
+    assert sync_times == [
+        datetime(2021, 6, 1, 8, 55),  # startup
+        datetime(2021, 6, 1, 8, 55),  # notified
+        datetime(2021, 6, 1, 9, 55),  # channels renewed an hour before they expire
+    ]
+    assert google_apis.requested_details == [
+        "foo.bar@gmail.com", "family123456789@group.calendar.google.com",
+        "foo.bar@gmail.com",
+        "foo.bar@gmail.com", "family123456789@group.calendar.google.com",
+    ]
+    assert len(channels) == 4
+    assert sorted(stopped_channels) == sorted((channel_id, f"resource-{cal_id}")
+                                              for (cal_id, channel_id, _) in channels[:2])
+    with StateStore(conf_dir) as state_store:
+        state = state_store.get("foo.bar@gmail.com")
+    (_, channel_id, token) = [channel for channel in channels if channel[0] == "foo.bar@gmail.com"][-1]
+    assert (state['channel_id'], state['channel_token']) == (channel_id, token)
+    assert state['channel_expiration'] == datetime(2021, 6, 8, 9, 55).timestamp()
+
+
+def test_daemon_all_users_renews_webhook_channels(monkeypatch):
+    (conf_dir, output_dir) = _setup_dirs()
+    conf_dir.mkdir(parents=True)
+    Path(conf_dir, ".users").write_text("foo.bar@gmail.com\nfoo.baz@gmail.com\n")
+    port = _free_port()
+    wait = webhook.WebhookReceiver.wait
+    monkeypatch.setattr(webhook.WebhookReceiver, "wait",
+                        lambda receiver, timeout: wait(receiver, 0) or gc._sleep(timeout) or set())
+
+    google_apis = _get_google_apis_mock(cal_list="less")
+    channels = []
+
+    def watch_calendar(credentials, cal_id, channel_id, address, token, ttl):
+        channels.append((cal_id, channel_id, token))
+        # The first channels (2 per user) only last 2 hours
+        expiration = datetime(2021, 6, 1, 10, 55) if len(channels) <= 4 else datetime(2021, 6, 8, 9, 55)
+        return {'id': channel_id, 'resourceId': f"resource-{cal_id}",
+                'expiration': f"{expiration.timestamp() * 1000:.0f}"}
+    google_apis.watch_calendar = watch_calendar
+    google_apis.stop_channel = lambda credentials, channel_id, resource_id: None
+
+    gc = Gcalvault(google_oauth2=_get_google_oauth2_mock(), google_apis=google_apis)
+    (sync_times, _) = _run_daemon(gc, ["daemon", "--all-users", "--webhook-url", "https://example.com/notify",
+                                       "--webhook-port", str(port), "-c", conf_dir, "-o", output_dir], syncs=2)
+
+    assert sync_times == [
+        datetime(2021, 6, 1, 8, 55),  # startup
+        datetime(2021, 6, 1, 9, 55),  # each account's channels renewed an hour before they expire
+    ]
+    assert len(channels) == 2 * 2 * 2
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _run_daemon(gc, args, syncs, on_sync=None):
+    """
+    Runs the daemon command against a simulated clock, starting at
+    2021-06-01 08:55, until it has synced the given number of times,
+    calling on_sync (if given) with the number of syncs after each one
+    """
+    clock = [datetime(2021, 6, 1, 8, 55)]
+    sync_times = []
+    repos = []
+    sync = gc.sync
+
+    class StopDaemon(BaseException):
+        pass
+
+    def sleep(seconds):
+        assert 0 < seconds <= 60
+        clock[0] += timedelta(seconds=seconds)
+
+    def tracked_sync():
+        sync_times.append(clock[0])
+        try:
+            sync()
+        finally:
+            repos.append(gc._repo)
+            if len(sync_times) == syncs:
+                raise StopDaemon()
+            if on_sync:
+                on_sync(len(sync_times))
+
+    gc._clock = lambda: clock[0]
+    gc._sleep = sleep
+    gc.sync = tracked_sync
+    with pytest.raises(StopDaemon):
+        gc.run(args)
+    return (sync_times, repos)
+
+
+def test_etags_not_saved_for_failed_download():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(cal_list="less"))
+    gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(cal_list="less_alt_etag", failing_cal_ids=["foo.bar@gmail.com"]))
+    with pytest.raises(RuntimeError):
+        gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(
+            cal_list="less_alt_etag",
+            cal_files={"foo.bar@gmail.com": "foo.bar@gmail.com_alt.ics"},
+            cal_files_as_allowlist=True))
+    gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+    _assert_ics_file_content_match(output_dir, "foo.bar@gmail.com.ics", "foo.bar@gmail.com_alt.ics")
+
+
+def test_sync_records_calendar_state():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(cal_list="less"))
+    started = time.time()
+    gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+
+    with StateStore(conf_dir) as state_store:
+        state = state_store.get("foo.bar@gmail.com")
+    assert state['etag'] == '"abc123"'
+    assert state['caldav_etag'] == '"foo.bar@gmail.com.ics"'
+    assert state['byte_size'] == len(_read_data_file("foo.bar@gmail.com.ics"))
+    assert started <= state['last_fetched'] <= time.time()
+    assert state['last_duration'] >= 0
+
+
+def test_sync_closes_state_store():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(cal_list="less"))
+    gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+
+    assert not os.path.exists(os.path.join(conf_dir, STATE_DB_FILE_NAME + "-wal"))  # removed on last close
+
+
+def test_sync_no_cache():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(cal_list="less"))
+    gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(
+            cal_list="less",
+            cal_files={"foo.bar@gmail.com": None, "family123456789@group.calendar.google.com": None},
+            cal_files_as_allowlist=True))
+    gc.run(["sync", "foo.bar@gmail.com", "--no-cache", "-c", conf_dir, "-o", output_dir])
+    with StateStore(conf_dir) as state_store:
+        assert state_store.get("foo.bar@gmail.com")['etag'] == '"abc123"'
+
+
+def test_sync_unchanged_content_skips_write_and_staging():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(cal_list="less"))
+    gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+
+    # Calendar etags change without the exported content changing
+    with StateStore(conf_dir) as state:
+        for cal_id in ["foo.bar@gmail.com", "family123456789@group.calendar.google.com"]:
+            state.update(cal_id, etag='"stale"', caldav_etag=None)
+        state.flush()
+    os.utime(os.path.join(output_dir, "foo.bar@gmail.com.ics"), (0, 0))
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(cal_list="less"))
+    with patch.object(GitVaultRepo, 'add_file') as add_file:
+        gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+
+    add_file.assert_not_called()
+    assert os.path.getmtime(os.path.join(output_dir, "foo.bar@gmail.com.ics")) == 0
+    with StateStore(conf_dir) as state:
+        assert state.get("foo.bar@gmail.com")['etag'] == '"abc123"'
+    _assert_git_repo_state(output_dir, commit_count=2)  # no commit for the second sync
+
+
+def test_sync_normalized():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(cal_list="less"))
+    gc.run(["sync", "foo.bar@gmail.com", "--normalize", "-c", conf_dir, "-o", output_dir])
+
+    with open(os.path.join(data_dir_path, "foo.bar@gmail.com.ics"), newline='') as file:
+        expected_content = "".join(ical.normalize(file))
+    with open(os.path.join(output_dir, "foo.bar@gmail.com.ics"), newline='') as file:
+        assert file.read() == expected_content
+
+
+def test_sync_event_layout():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(cal_list="less"))
+    gc.run(["sync", "foo.bar@gmail.com", "--layout", "event", "-c", conf_dir, "-o", output_dir])
+
+    assert sorted(_glob_relative(output_dir, "*/*.ics")) == [
+        "family123456789@group.calendar.google.com/2y3z4a5b6c7d@google.com.ics",
+        "family123456789@group.calendar.google.com/8e9f0g1h2i3j@google.com.ics",
+        "foo.bar@gmail.com/1a2b3c4d5e6f@google.com.ics",
+        "foo.bar@gmail.com/7g8h9i0j1k2l@google.com.ics",
+    ]
+    assert _glob_relative(output_dir, "*.ics") == []
+    event = _read_file(output_dir, "foo.bar@gmail.com/1a2b3c4d5e6f@google.com.ics")
+    assert event.startswith("BEGIN:VCALENDAR\n") and event.endswith("END:VCALENDAR\n")
+    assert event.count("BEGIN:VTIMEZONE") == 1 and event.count("BEGIN:VEVENT") == 1
+    assert "SUMMARY:Dentist" in event
+    _assert_git_repo_state(output_dir, commit_count=2, last_commit_file_count=4)
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(
+            cal_list="less_alt_etag",
+            cal_files={"foo.bar@gmail.com": "foo.bar@gmail.com_alt.ics"}))
+    gc.run(["sync", "foo.bar@gmail.com", "--layout", "event", "-c", conf_dir, "-o", output_dir])
+
+    assert "SUMMARY:Dentist (moved)" in _read_file(output_dir, "foo.bar@gmail.com/1a2b3c4d5e6f@google.com.ics")
+    assert len(_glob_relative(output_dir, "foo.bar@gmail.com/*.ics")) == 3
+    assert os.listdir(os.path.join(output_dir, "foo.bar@gmail.com")).count(".calendar.download") == 0
+    _assert_git_repo_state(output_dir, commit_count=3, last_commit_file_count=2)  # moved and added events only
+
+
+def test_sync_event_layout_incremental_and_clean():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock())
+    gc.run(["sync", "foo.bar@gmail.com", "--layout", "event", "--incremental", "-c", conf_dir, "-o", output_dir])
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(
+            cal_list="less",
+            changes={
+                "family123456789@group.calendar.google.com": [
+                    {'id': "2y3z4a5b6c7d", 'iCalUID': "2y3z4a5b6c7d@google.com", 'status': "cancelled"}],
+            }))
+    gc.run(["sync", "foo.bar@gmail.com", "--layout", "event", "--incremental", "--clean",
+            "-c", conf_dir, "-o", output_dir])
+
+    assert sorted(os.listdir(output_dir)) == [
+        ".git", ".gitignore", "family123456789@group.calendar.google.com", "foo.bar@gmail.com"]
+    assert os.listdir(os.path.join(output_dir, "family123456789@group.calendar.google.com")) == [
+        "8e9f0g1h2i3j@google.com.ics"]
+    # 2 calendars' worth of event files removed by --clean, 1 deleted event
+    _assert_git_repo_state(output_dir, commit_count=3, last_commit_file_count=4)
+
+
+def test_sync_event_layout_in_existing_vault():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(cal_list="less"))
+    gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(cal_list="less"))
+    gc.run(["sync", "foo.bar@gmail.com", "--layout", "event", "--clean", "-c", conf_dir, "-o", output_dir])
+
+    assert Path(output_dir, ".gitignore").read_text().splitlines()[-1] == "!*/"
+    assert sorted(Repo(output_dir).git.ls_files().splitlines()) == [
+        ".gitignore",
+        "family123456789@group.calendar.google.com/2y3z4a5b6c7d@google.com.ics",
+        "family123456789@group.calendar.google.com/8e9f0g1h2i3j@google.com.ics",
+        "foo.bar@gmail.com/1a2b3c4d5e6f@google.com.ics",
+        "foo.bar@gmail.com/7g8h9i0j1k2l@google.com.ics",
+    ]
+
+
+def test_sync_all_users():
+    (conf_dir, output_dir) = _setup_dirs()
+    conf_dir.mkdir(parents=True)
+    Path(conf_dir, ".users").write_text("# Accounts to back up\nfoo.bar@gmail.com\n\nFoo.Baz@gmail.com\nfoo.bar@gmail.com\n")
+
+    google_oauth2 = _get_google_oauth2_mock()
+    gc = Gcalvault(google_oauth2=google_oauth2, google_apis=_get_google_apis_mock(cal_list="less"))
+    gc.run(["sync", "--all-users", "--account-jobs", "2", "-c", conf_dir, "-o", output_dir])
+
+    for user in ["foo.bar@gmail.com", "foo.baz@gmail.com"]:
+        user_output_dir = os.path.join(output_dir, user)
+        _assert_ics_files_match(user_output_dir, [
+            "foo.bar@gmail.com.ics", "family123456789@group.calendar.google.com.ics"])
+        _assert_git_repo_state(user_output_dir, commit_count=2, last_commit_file_count=2)
+        with StateStore(conf_dir, f".{user}.state.db") as state:
+            assert state.get("foo.bar@gmail.com")['etag'] == '"abc123"'
+        assert gc._accounts[user]._google_apis is gc._google_apis  # connection pools shared
+        assert not os.path.exists(os.path.join(conf_dir, f".{user}.state.db-wal"))  # closed when the run ended
+    assert sorted(call.args[0] for call in google_oauth2.get_credentials.call_args_list) == [
+        os.path.join(conf_dir, "foo.bar@gmail.com.token.json"),
+        os.path.join(conf_dir, "foo.baz@gmail.com.token.json"),
+    ]
+    assert not os.path.exists(os.path.join(conf_dir, ".state.db"))
+    assert gc._google_apis.pool_size == 2 * 4
+
+
+def test_sync_all_users_relative_dirs(monkeypatch):
+    (conf_dir, output_dir) = _setup_dirs()
+    conf_dir.mkdir(parents=True)
+    Path(conf_dir, ".users").write_text("foo.bar@gmail.com\nfoo.baz@gmail.com\nfamily@gmail.com\n")
+    monkeypatch.chdir(conf_dir.parent)
+
+    gc = Gcalvault(google_oauth2=_get_google_oauth2_mock(), google_apis=_get_google_apis_mock(latency=0.05))
+    gc.run(["sync", "--all-users", "--account-jobs", "3", "-c", conf_dir.name, "-o", output_dir.name])
+
+    assert gc.conf_dir == str(conf_dir) and gc.output_dir == str(output_dir)
+    for user in ["foo.bar@gmail.com", "foo.baz@gmail.com", "family@gmail.com"]:
+        _assert_git_repo_state(os.path.join(output_dir, user), commit_count=2, last_commit_file_count=4)
+
+
+def test_sync_all_users_failure_isolated(capsys):
+    (conf_dir, output_dir) = _setup_dirs()
+    conf_dir.mkdir(parents=True)
+    Path(conf_dir, ".users").write_text("foo.bar@gmail.com\nfoo.baz@gmail.com\n")
+
+    google_oauth2 = _get_google_oauth2_mock()
+    credentials = google_oauth2.get_credentials.return_value
+
+    def get_credentials(token_file_path, client_id, client_secret, scopes, login_hint):
+        if login_hint == "foo.baz@gmail.com":
+            raise RuntimeError("Token has been expired or revoked")
+        return credentials
+    google_oauth2.get_credentials.side_effect = get_credentials
+
+    gc = Gcalvault(google_oauth2=google_oauth2, google_apis=_get_google_apis_mock(cal_list="less"))
+    with pytest.raises(GcalvaultError, match=r"1 of 2 user\(s\): foo.baz@gmail.com"):
+        gc.run(["sync", "--all-users", "-c", conf_dir, "-o", output_dir])
+
+    _assert_ics_files_match(os.path.join(output_dir, "foo.bar@gmail.com"), [
+        "foo.bar@gmail.com.ics", "family123456789@group.calendar.google.com.ics"])
+    assert "Sync failed for user 'foo.baz@gmail.com': Token has been expired or revoked" in capsys.readouterr().err
+
+
+def test_sync_all_users_requires_users_file():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    gc = Gcalvault(google_oauth2=_get_google_oauth2_mock(), google_apis=_get_google_apis_mock())
+    with pytest.raises(GcalvaultError, match=r"\.users"):
+        gc.run(["sync", "--all-users", "-c", conf_dir, "-o", output_dir])
+
+
+def test_sync_records_metrics():
+    (conf_dir, output_dir) = _setup_dirs()
+    metrics_file = os.path.join(output_dir, "metrics.jsonl")
+    prometheus_file = os.path.join(output_dir, "gcalvault.prom")
+
+    gc = Gcalvault(google_oauth2=_get_google_oauth2_mock(), google_apis=_get_google_apis_mock())
+    gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir,
+            "--metrics-file", metrics_file, "--prometheus-file", prometheus_file])
+
+    phases = [json.loads(line) for line in Path(metrics_file).read_text().splitlines()]
+    assert all(phase['user'] == "foo.bar@gmail.com" and phase['status'] == "ok" for phase in phases)
+    assert {"sync", "list_calendars", "details", "download", "git_add", "git_commit"} <= \
+        {phase['phase'] for phase in phases}
+    assert phases[-1]['phase'] == "sync"
+    assert [phase for phase in phases if phase['phase'] == "list_calendars"][0]['calendars'] == 4
+    downloads = [phase for phase in phases if phase['phase'] == "download"]
+    assert sorted(phase['calendar'] for phase in downloads) == [
+        "en.usa#holiday@group.v.calendar.google.com",
+        "family123456789@group.calendar.google.com",
+        "foo.bar@gmail.com",
+        "foo.baz@gmail.com",
+    ]
+    assert all(phase['bytes'] > 0 for phase in downloads)
+
+    prometheus = Path(prometheus_file).read_text().splitlines()
+    assert 'gcalvault_last_sync_success{user="foo.bar@gmail.com"} 1' in prometheus
+    assert f'gcalvault_download_bytes_total{{user="foo.bar@gmail.com"}} {sum(p["bytes"] for p in downloads)}' \
+        in prometheus
+    assert 'gcalvault_phase_duration_seconds_count{phase="download",user="foo.bar@gmail.com"} 4' in prometheus
+
+
+def test_sync_metrics_files_relative_paths(monkeypatch):
+    (conf_dir, output_dir) = _setup_dirs()
+    conf_dir.mkdir(parents=True)
+    monkeypatch.chdir(conf_dir)
+    monkeypatch.setenv("METRICS_FILE", "metrics.jsonl")
+
+    gc = Gcalvault(google_oauth2=_get_google_oauth2_mock(), google_apis=_get_google_apis_mock())
+    gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir, "--prometheus-file", "gcalvault.prom"])
+
+    assert gc.metrics_file == os.path.join(conf_dir, "metrics.jsonl")
+    assert gc.prometheus_file == os.path.join(conf_dir, "gcalvault.prom")
+    assert os.path.exists(gc.metrics_file) and os.path.exists(gc.prometheus_file)
+
+
+def test_sync_all_users_records_metrics_per_user():
+    (conf_dir, output_dir) = _setup_dirs()
+    conf_dir.mkdir(parents=True)
+    Path(conf_dir, ".users").write_text("foo.bar@gmail.com\nfoo.baz@gmail.com\n")
+    prometheus_file = os.path.join(conf_dir, "gcalvault.prom")
+
+    gc = Gcalvault(google_oauth2=_get_google_oauth2_mock(), google_apis=_get_google_apis_mock(cal_list="less"))
+    gc.run(["sync", "--all-users", "-c", conf_dir, "-o", output_dir, "--prometheus-file", prometheus_file])
+
+    prometheus = Path(prometheus_file).read_text().splitlines()
+    for user in ["foo.bar@gmail.com", "foo.baz@gmail.com"]:
+        assert f'gcalvault_last_sync_success{{user="{user}"}} 1' in prometheus
+        assert f'gcalvault_phase_duration_seconds_count{{phase="git_commit",user="{user}"}} 1' in prometheus
+
+
 def test_sync_export_only():
     (conf_dir, output_dir) = _setup_dirs()
 
@@ -409,6 +1178,528 @@ def test_git_commits():
     _assert_git_repo_state(output_dir, commit_count=2, last_commit_file_count=4)  # initial commit + 1, 4 ics files
 
 
+def test_git_index_written_once_per_sync():
+    (conf_dir, output_dir) = _setup_dirs()
+    output_dir.mkdir(parents=True)
+    GitVaultRepo("gcalvault", output_dir, [".ics"])
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock())
+    with patch.object(IndexFile, 'write', autospec=True, side_effect=IndexFile.write) as write:
+        gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+
+    assert write.call_count == 1
+    _assert_git_repo_state(output_dir, commit_count=2, last_commit_file_count=4)
+
+
+def test_git_commit_skipped_when_staged_files_unchanged(capsys):
+    (conf_dir, output_dir) = _setup_dirs()
+    output_dir.mkdir(parents=True)
+    repo = GitVaultRepo("gcalvault", output_dir, [".ics"])
+    Path(output_dir, "foo.ics").write_text("foo")
+    Path(output_dir, "bar.ics").write_text("bar")
+    repo.add_file("foo.ics")
+    repo.add_file("bar.ics")
+    repo.commit("first")
+
+    repo.add_file("foo.ics")  # content unchanged
+    repo.commit("second")
+
+    assert capsys.readouterr().out.splitlines()[-1] == "No revisions to commit to gcalvault repository"
+    _assert_git_repo_state(output_dir, commit_count=2)
+
+    repo.remove_file("bar.ics")
+    repo.commit("third")
+
+    assert not os.path.exists(os.path.join(output_dir, "bar.ics"))
+    assert Repo(output_dir).git.ls_files().splitlines() == [".gitignore", "foo.ics"]
+    _assert_git_repo_state(output_dir, commit_count=3, last_commit_file_count=1)
+
+
+def test_git_index_only_diffed_after_interrupted_sync():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock())
+    gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+    with patch.object(IndexFile, 'diff', autospec=True, side_effect=IndexFile.diff) as diff:
+        gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+
+    assert diff.call_count == 0  # nothing left staged by an earlier sync
+    _assert_git_repo_state(output_dir, commit_count=2)
+
+
+def test_git_maintenance_every_n_commits():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(cal_list="less"))
+    gc.run(["sync", "foo.bar@gmail.com", "--maintenance-commits", "2", "-c", conf_dir, "-o", output_dir])
+
+    repo = Repo(output_dir)
+    assert _loose_object_count(repo) == 0
+    assert os.path.exists(os.path.join(output_dir, ".git", "objects", "info", "commit-graph"))
+    last_run = StateStore(conf_dir).last_maintenance_run()
+    assert last_run['head'] == repo.head.commit.hexsha
+    assert last_run['reason'] == "2 commits since last maintenance"
+    assert last_run['duration'] >= 0
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(
+            cal_list="less_alt_etag", cal_files={"foo.bar@gmail.com": "foo.bar@gmail.com_alt.ics"}))
+    gc.run(["sync", "foo.bar@gmail.com", "--maintenance-commits", "2", "-c", conf_dir, "-o", output_dir])
+
+    assert _loose_object_count(repo) > 0  # 1 commit since, not due yet
+    assert StateStore(conf_dir).last_maintenance_run() == last_run
+
+
+def test_git_maintenance_on_loose_objects():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(cal_list="less"))
+    gc.run(["sync", "foo.bar@gmail.com", "--maintenance-commits", "0", "--maintenance-loose-objects", "1",
+            "-c", conf_dir, "-o", output_dir])
+
+    assert _loose_object_count(Repo(output_dir)) == 0
+    assert StateStore(conf_dir).last_maintenance_run()['reason'].endswith(" loose objects")
+
+
+def test_git_push_to_remotes():
+    (conf_dir, output_dir) = _setup_dirs()
+    remotes = _setup_remotes(output_dir, ["origin", "backup"])
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(cal_list="less"))
+    gc.run(["sync", "foo.bar@gmail.com", "--push", "-c", conf_dir, "-o", output_dir])
+
+    head = Repo(output_dir).head.commit.hexsha
+    for remote in remotes.values():
+        assert remote.heads.master.commit.hexsha == head
+
+
+def test_git_push_retries_and_isolates_failing_remote(capsys):
+    (conf_dir, output_dir) = _setup_dirs()
+    remotes = _setup_remotes(output_dir, ["origin", "flaky", "broken"])
+    shutil.rmtree(remotes["broken"].git_dir)
+    push = GitVaultRepo._push_remote
+    attempts = {"flaky": 0}
+
+    def push_remote(repo, remote_name):
+        if remote_name == "flaky":
+            attempts["flaky"] += 1
+            if attempts["flaky"] < 3:
+                raise RuntimeError("remote hung up")
+        push(repo, remote_name)
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(cal_list="less"))
+    with patch("gcalvault.git_vault_repo.PUSH_RETRY_DELAY", 0), \
+            patch.object(GitVaultRepo, '_push_remote', autospec=True, side_effect=push_remote):
+        gc.run(["sync", "foo.bar@gmail.com", "--push", "-c", conf_dir, "-o", output_dir])
+
+    head = Repo(output_dir).head.commit.hexsha
+    assert remotes["origin"].heads.master.commit.hexsha == head
+    assert remotes["flaky"].heads.master.commit.hexsha == head
+    assert attempts["flaky"] == 3
+    assert "Failed to push to remote 'broken' after 5 attempts" in capsys.readouterr().err
+
+
+def test_git_pushes_coalesced_and_parallel():
+    started = {"origin": threading.Event(), "backup": threading.Event()}
+    release = threading.Event()
+    pushes = []
+
+    def push(remote_name):
+        pushes.append(remote_name)
+        started[remote_name].set()
+        if remote_name == "origin":
+            # Held until the other remote is being pushed, which would deadlock if pushed in turn
+            assert started["backup"].wait(5)
+            assert release.wait(5)
+
+    pushers = [RemotePusher("origin", push), RemotePusher("backup", push)]
+    for pusher in pushers:
+        pusher.request()
+    assert started["origin"].wait(5)
+    for _ in range(3):
+        pushers[0].request()  # while the first push is under way
+    release.set()
+    for pusher in pushers:
+        pusher.close()
+
+    assert sorted(pushes) == ["backup", "origin", "origin"]
+
+
+def test_sync_downloads_in_parallel():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(latency=0.5))
+    started = time.monotonic()
+    gc.run(["sync", "foo.bar@gmail.com", "--jobs", "4", "-c", conf_dir, "-o", output_dir])
+    elapsed = time.monotonic() - started
+
+    assert elapsed < 1.5  # 4 calendars @ 0.5s each would take 2s+ serially
+    expected_files = [
+        "foo.bar@gmail.com.ics",
+        "foo.baz@gmail.com.ics",
+        "family123456789@group.calendar.google.com.ics",
+        "en.usa#holiday@group.v.calendar.google.com.ics",
+    ]
+    _assert_ics_files_match(output_dir, expected_files)
+    _assert_git_repo_state(output_dir, commit_count=2, last_commit_file_count=4)  # still a single sync commit
+
+
+def test_sync_download_failure_in_parallel():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(latency=0.1, failing_cal_ids=["foo.baz@gmail.com"]))
+    with pytest.raises(RuntimeError):
+        gc.run(["sync", "foo.bar@gmail.com", "--jobs", "4", "-c", conf_dir, "-o", output_dir])
+
+    _assert_git_repo_state(output_dir, commit_count=1)  # nothing committed beyond initial commit
+
+
+def test_sync_commits_calendars_saved_before_failure():
+    (conf_dir, output_dir) = _setup_dirs()
+
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock(failing_cal_ids=["foo.baz@gmail.com"]))
+    with pytest.raises(RuntimeError):
+        gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+    _assert_git_repo_state(output_dir, commit_count=1)
+
+    # Nothing to download for the included calendar, which is already up to date
+    gc = Gcalvault(
+        google_oauth2=_get_google_oauth2_mock(),
+        google_apis=_get_google_apis_mock())
+    gc.run(["sync", "foo.bar@gmail.com", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+
+    _assert_git_repo_state(output_dir, commit_count=2, last_commit_file_count=3)
+
+
+def test_calendar_service_reused_per_credentials():
+    google_apis = GoogleApis()
+    credentials = MagicMock(token="phony")
+    other_credentials = MagicMock(token="other")
+
+    with patch("googleapiclient.discovery.build") as build:
+        build.return_value.calendarList.return_value.list.return_value.execute.return_value = {'items': []}
+        google_apis.request_cal_list(credentials)
+        for cal_id in ["foo.bar@gmail.com", "foo.baz@gmail.com", "family123456789@group.calendar.google.com"]:
+            google_apis.request_cal_details(credentials, cal_id)
+        assert build.call_count == 1
+        assert build.call_args.kwargs['static_discovery'] is True
+
+        google_apis.request_cal_details(other_credentials, "foo.bar@gmail.com")
+        assert build.call_count == 2
+
+        google_apis.close()
+        google_apis.request_cal_list(credentials)
+        assert build.call_count == 3
+
+
+def test_cal_details_batched():
+    cal_ids = [f"cal{i}@group.calendar.google.com" for i in range(60)]
+    http = FakeCalendarHttp({cal_id: f'"etag-{cal_id}"' for cal_id in cal_ids})
+    google_apis = _get_google_apis_with_http(http)
+
+    cal_details = google_apis.request_cal_details_batch(MagicMock(token="phony"), cal_ids)
+
+    assert http.round_trips == 2  # batches of 50 + 10
+    assert len(cal_details) == 60
+    for cal_id in cal_ids:
+        assert cal_details[cal_id]['etag'] == f'"etag-{cal_id}"'
+
+
+def test_cal_details_batch_falls_back_for_failed_calls():
+    cal_ids = ["foo.bar@gmail.com", "foo.baz@gmail.com", "en.usa#holiday@group.v.calendar.google.com"]
+    http = FakeCalendarHttp(
+        {cal_id: f'"etag-{cal_id}"' for cal_id in cal_ids},
+        failing_in_batch=["foo.baz@gmail.com"])
+    google_apis = _get_google_apis_with_http(http)
+
+    cal_details = google_apis.request_cal_details_batch(MagicMock(token="phony"), cal_ids)
+
+    assert http.round_trips == 2  # 1 batch + 1 individual retry
+    assert "/calendar/v3/calendars/foo.baz%40gmail.com/events" in http.requests[1][1]
+    for cal_id in cal_ids:
+        assert cal_details[cal_id]['etag'] == f'"etag-{cal_id}"'
+
+
+def test_caldav_downloads_share_compressed_keep_alive_session():
+    cal_ids = ["foo.bar@gmail.com", "foo.baz@gmail.com", "en.usa#holiday@group.v.calendar.google.com"]
+    ics_bodies = {cal_id: _read_data_file(f"{cal_id}.ics") for cal_id in cal_ids}
+    (conf_dir, output_dir) = _setup_dirs()
+    output_dir.mkdir(parents=True)
+    google_apis = GoogleApis(pool_size=2, timeout=5)
+
+    with FakeCalDavServer(ics_bodies) as server:
+        google_apis.caldav_uri_format = server.caldav_uri_format
+        for cal_id in cal_ids:
+            google_apis.save_cal_as_ical(cal_id, MagicMock(token="phony"), os.path.join(output_dir, f"{cal_id}.ics"))
+            _assert_ics_file_content_match(output_dir, f"{cal_id}.ics")
+        google_apis.close()
+
+    assert len(server.requests) == 3
+    assert len(server.connections) == 1  # one keep-alive connection for all downloads
+    for (path, headers) in server.requests:
+        assert "gzip" in headers['Accept-Encoding']
+        assert headers['Authorization'] == "Bearer phony"
+
+
+def test_caldav_download_streams_to_disk():
+    (conf_dir, output_dir) = _setup_dirs()
+    output_dir.mkdir(parents=True)
+    event = "BEGIN:VEVENT\r\nUID:{i}@google.com\r\nSUMMARY:Event {i}\r\nEND:VEVENT\r\n"
+    ics_body = "BEGIN:VCALENDAR\r\n" + "".join(event.format(i=i) for i in range(300000)) + "END:VCALENDAR\r\n"
+    cal_file_path = os.path.join(output_dir, "foo.bar@gmail.com.ics")
+    google_apis = GoogleApis()
+
+    with FakeCalDavServer({"foo.bar@gmail.com": ics_body}) as server:
+        google_apis.caldav_uri_format = server.caldav_uri_format
+        tracemalloc.start()
+        (size, _, content_hash) = google_apis.save_cal_as_ical(
+            "foo.bar@gmail.com", MagicMock(token="phony"), cal_file_path)
+        (_, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        google_apis.close()
+
+    assert size == len(ics_body) > 16 * 1024 * 1024
+    assert peak < 4 * 1024 * 1024  # far less than the calendar size
+    assert content_hash == hashlib.sha256(ics_body.encode('utf-8')).hexdigest()
+    assert Path(cal_file_path).read_bytes() == ics_body.encode('utf-8')
+    assert os.listdir(output_dir) == ["foo.bar@gmail.com.ics"]  # no temp files left behind
+
+
+def test_caldav_download_unchanged_content_keeps_existing_file():
+    (conf_dir, output_dir) = _setup_dirs()
+    output_dir.mkdir(parents=True)
+    cal_file_path = os.path.join(output_dir, "foo.bar@gmail.com.ics")
+    google_apis = GoogleApis()
+    credentials = MagicMock(token="phony")
+
+    with FakeCalDavServer({"foo.bar@gmail.com": _read_data_file("foo.bar@gmail.com.ics")}) as server:
+        google_apis.caldav_uri_format = server.caldav_uri_format
+        (_, _, content_hash) = google_apis.save_cal_as_ical("foo.bar@gmail.com", credentials, cal_file_path)
+        os.utime(cal_file_path, (0, 0))
+        (_, _, new_content_hash) = google_apis.save_cal_as_ical(
+            "foo.bar@gmail.com", credentials, cal_file_path, content_hash=content_hash)
+        google_apis.close()
+
+    assert new_content_hash == content_hash
+    assert os.path.getmtime(cal_file_path) == 0  # not rewritten
+    assert os.listdir(output_dir) == ["foo.bar@gmail.com.ics"]
+
+
+def test_caldav_download_normalized():
+    (conf_dir, output_dir) = _setup_dirs()
+    output_dir.mkdir(parents=True)
+    cal_file_path = os.path.join(output_dir, "foo.bar@gmail.com.ics")
+    ics_body = Path(data_dir_path, "foo.bar@gmail.com.ics").read_bytes().decode('utf-8')
+    events = re.findall(r"BEGIN:VEVENT\r\n.*?END:VEVENT\r\n", ics_body, re.DOTALL)
+    reexported_body = ics_body.replace("".join(events), "".join(reversed(events))) \
+        .replace("DTSTAMP:20210601T120000Z", "DTSTAMP:20210602T120000Z")
+    google_apis = GoogleApis()
+    credentials = MagicMock(token="phony")
+
+    with FakeCalDavServer({"foo.bar@gmail.com": ics_body}) as server:
+        google_apis.caldav_uri_format = server.caldav_uri_format
+        (size, _, content_hash) = google_apis.save_cal_as_ical(
+            "foo.bar@gmail.com", credentials, cal_file_path, normalize=True)
+    normalized_body = Path(cal_file_path).read_bytes()
+    os.utime(cal_file_path, (0, 0))
+    with FakeCalDavServer({"foo.bar@gmail.com": reexported_body}) as server:
+        google_apis.caldav_uri_format = server.caldav_uri_format
+        (_, _, new_content_hash) = google_apis.save_cal_as_ical(
+            "foo.bar@gmail.com", credentials, cal_file_path, content_hash=content_hash, normalize=True)
+        google_apis.close()
+
+    assert len(events) > 1
+    assert size == len(ics_body.encode('utf-8'))
+    assert content_hash == hashlib.sha256(normalized_body).hexdigest()
+    assert normalized_body.decode('utf-8') == "".join(ical.normalize(ics_body.splitlines(keepends=True)))
+    assert new_content_hash == content_hash  # reordered events and new DTSTAMPs normalize away
+    assert os.path.getmtime(cal_file_path) == 0
+    assert os.listdir(output_dir) == ["foo.bar@gmail.com.ics"]  # no temp files left behind
+
+
+def test_caldav_download_failure_keeps_existing_file():
+    (conf_dir, output_dir) = _setup_dirs()
+    output_dir.mkdir(parents=True)
+    cal_file_path = os.path.join(output_dir, "foo.baz@gmail.com.ics")
+    Path(cal_file_path).write_text("previous")
+    google_apis = GoogleApis()
+
+    with FakeCalDavServer({}) as server:
+        google_apis.caldav_uri_format = server.caldav_uri_format
+        with pytest.raises(requests.HTTPError):
+            google_apis.save_cal_as_ical("foo.baz@gmail.com", MagicMock(token="phony"), cal_file_path)
+        google_apis.close()
+
+    assert Path(cal_file_path).read_text() == "previous"
+    assert os.listdir(output_dir) == ["foo.baz@gmail.com.ics"]
+
+
+def test_caldav_download_retries_when_rate_limited(capsys):
+    (conf_dir, output_dir) = _setup_dirs()
+    output_dir.mkdir(parents=True)
+    cal_file_path = os.path.join(output_dir, "foo.bar@gmail.com.ics")
+    ics_body = _read_data_file("foo.bar@gmail.com.ics")
+    google_apis = GoogleApis()
+    delays = []
+    google_apis.backoff._random = lambda: 0.5
+    google_apis.backoff._sleep = delays.append
+
+    with FakeCalDavServer({"foo.bar@gmail.com": ics_body}, throttled=[429, 403, 503]) as server:
+        google_apis.caldav_uri_format = server.caldav_uri_format
+        google_apis.save_cal_as_ical("foo.bar@gmail.com", MagicMock(token="phony"), cal_file_path)
+        google_apis.close()
+
+    assert len(server.requests) == 4
+    assert delays == [0, 1, 2]  # Retry-After honoured, then jittered exponential backoff
+    assert Path(cal_file_path).read_text() == ics_body
+    assert "CalDAV request got 429, retrying" in capsys.readouterr().err
+
+
+def test_caldav_download_gives_up_when_still_rate_limited():
+    (conf_dir, output_dir) = _setup_dirs()
+    output_dir.mkdir(parents=True)
+    cal_file_path = os.path.join(output_dir, "foo.bar@gmail.com.ics")
+    Path(cal_file_path).write_text("previous")
+    google_apis = GoogleApis()
+    google_apis.backoff._sleep = lambda delay: None
+
+    with FakeCalDavServer({"foo.bar@gmail.com": "unused"}, throttled=[429] * 10) as server:
+        google_apis.caldav_uri_format = server.caldav_uri_format
+        with pytest.raises(requests.HTTPError):
+            google_apis.save_cal_as_ical("foo.bar@gmail.com", MagicMock(token="phony"), cal_file_path)
+        google_apis.close()
+
+    assert len(server.requests) == google_apis.backoff.max_retries + 1
+    assert Path(cal_file_path).read_text() == "previous"
+
+
+def test_calendar_api_retries_when_rate_limited():
+    cal_ids = ["foo.bar@gmail.com", "foo.baz@gmail.com"]
+    http = FakeCalendarHttp({cal_id: f'"etag-{cal_id}"' for cal_id in cal_ids}, throttled=[429, 403])
+    google_apis = _get_google_apis_with_http(http)
+    google_apis.backoff._sleep = lambda delay: None
+
+    cal_details = google_apis.request_cal_details_batch(MagicMock(token="phony"), cal_ids)
+
+    assert http.round_trips == 3  # batch retried twice
+    for cal_id in cal_ids:
+        assert cal_details[cal_id]['etag'] == f'"etag-{cal_id}"'
+
+
+def test_google_calls_share_rate_limiter():
+    (_, output_dir) = _setup_dirs()
+    output_dir.mkdir(parents=True)
+    http = FakeCalendarHttp({"foo.bar@gmail.com": '"etag"'})
+    google_apis = _get_google_apis_with_http(http)
+    google_apis.rate_limiter.acquire = MagicMock()
+
+    with FakeCalDavServer({"foo.bar@gmail.com": "body"}) as server:
+        google_apis.caldav_uri_format = server.caldav_uri_format
+        google_apis.request_cal_details(MagicMock(token="phony"), "foo.bar@gmail.com")
+        google_apis.save_cal_as_ical(
+            "foo.bar@gmail.com", MagicMock(token="phony"), os.path.join(output_dir, "foo.bar@gmail.com.ics"))
+        google_apis.close()
+
+    assert google_apis.rate_limiter.acquire.call_count == 2
+
+
+def test_cal_list_paged_and_conditional():
+    calendar_list = [{'id': f"cal{i}@group.calendar.google.com", 'summary': f"Calendar {i}", 'accessRole': "reader"}
+                     for i in range(300)]
+    http = FakeCalendarHttp({}, calendar_list=calendar_list)
+    google_apis = _get_google_apis_with_http(http)
+    credentials = MagicMock(token="phony")
+
+    listed = google_apis.request_cal_list(credentials)
+    assert listed == {'etag': http.calendar_list_etag, 'items': calendar_list}
+    assert http.round_trips == 2  # 250 calendars per page
+    for (_, uri) in http.requests:
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(uri).query)
+        assert query['maxResults'] == ["250"]
+        assert query['fields'] == ["etag,nextPageToken,items(id,summary,accessRole)"]
+
+    assert google_apis.request_cal_list(credentials, listed['etag']) is None
+    assert http.round_trips == 3  # unchanged list costs a single request
+
+    calendar_list.append({'id': "new@group.calendar.google.com", 'summary': "New", 'accessRole': "owner"})
+    assert len(google_apis.request_cal_list(credentials, listed['etag'])['items']) == 301
+    assert http.round_trips == 5  # later pages not made conditional on the first page's etag
+
+
+def test_sync_cal_list_cached():
+    (conf_dir, output_dir) = _setup_dirs()
+    etags = []
+
+    def sync(cal_list_etag):
+        google_apis = _get_google_apis_mock()
+        request_cal_list = google_apis.request_cal_list
+
+        def conditional_request_cal_list(credentials, etag=None):
+            etags.append(etag)
+            return None if etag == cal_list_etag else dict(request_cal_list(credentials), etag=cal_list_etag)
+        google_apis.request_cal_list = conditional_request_cal_list
+        gc = Gcalvault(google_oauth2=_get_google_oauth2_mock(), google_apis=google_apis)
+        gc.run(["sync", "foo.bar@gmail.com", "-c", conf_dir, "-o", output_dir])
+        return gc
+
+    sync('"list1"')
+    gc = sync('"list1"')
+    sync('"list2"')
+
+    assert etags == [None, '"list1"', '"list1"']
+    assert [cal.id for cal in gc.calendars] == [item['id'] for item in _read_data_file_json("cal_list.json")['items']]
+    assert StateStore(conf_dir).last_calendar_list()['etag'] == '"list2"'
+    _assert_ics_files_match(output_dir, [
+        "foo.bar@gmail.com.ics",
+        "foo.baz@gmail.com.ics",
+        "family123456789@group.calendar.google.com.ics",
+        "en.usa#holiday@group.v.calendar.google.com.ics",
+    ])
+
+
+def test_calendar_api_watch_and_stop_channel():
+    http = FakeCalendarHttp({"foo.bar@gmail.com": '"etag"'})
+    google_apis = _get_google_apis_with_http(http)
+    credentials = MagicMock(token="phony")
+
+    started = time.time()
+    channel = google_apis.watch_calendar(credentials, "foo.bar@gmail.com", "channel1",
+                                         "https://example.com/notify", "secret", timedelta(days=7))
+    google_apis.stop_channel(credentials, "channel1", channel['resourceId'])
+
+    assert http.channels["channel1"] == {
+        'id': "channel1", 'type': "web_hook", 'address': "https://example.com/notify", 'token': "secret",
+        'params': {'ttl': "604800"}, 'calendarId': "foo.bar@gmail.com"}
+    assert channel['resourceId'] == "resource-foo.bar@gmail.com"
+    assert started + 604800 <= int(channel['expiration']) / 1000 <= time.time() + 604800
+    assert http.stopped_channels == [("channel1", "resource-foo.bar@gmail.com")]
+
+
+def _get_google_apis_with_http(http):
+    google_apis = GoogleApis()
+    google_apis._authorized_http = lambda credentials: http
+    return google_apis
+
+
 def _get_google_oauth2_mock(new_authorization=False, email="foo.bar@gmail.com"):
     google_oauth2 = GoogleOAuth2()
 
@@ -421,21 +1712,61 @@ def _get_google_oauth2_mock(new_authorization=False, email="foo.bar@gmail.com"):
     return google_oauth2
 
 
-def _get_google_apis_mock(cal_list=None, cal_files={}, cal_files_as_allowlist=False):
+def _get_google_apis_mock(cal_list=None, cal_files={}, cal_files_as_allowlist=False,
+                          latency=0, failing_cal_ids=[], changes={}):
     google_apis = GoogleApis()
+    google_apis.requested_details = []
 
-    def request_cal_list(credentials):
+    def request_cal_list(credentials, etag=None):
+        # Calendar list files share an etag, so lists are always returned in full
         cal_list_file = f"cal_list_{cal_list}.json" if cal_list else "cal_list.json"
         return _read_data_file_json(cal_list_file)
     google_apis.request_cal_list = request_cal_list
 
-    def request_cal_as_ical(cal_id, credentials):
+    def request_cal_details(credentials, cal_id):
+        items = request_cal_list(credentials)['items']
+        return {'etag': next(item['etag'] for item in items if item['id'] == cal_id)}
+    google_apis.request_cal_details = request_cal_details
+
+    def request_cal_details_batch(credentials, cal_ids):
+        google_apis.requested_details.extend(cal_ids)
+        return {cal_id: request_cal_details(credentials, cal_id) for cal_id in cal_ids}
+    google_apis.request_cal_details_batch = request_cal_details_batch
+
+    def request_cal_changes_batch(credentials, sync_tokens):
+        cal_changes = {}
+        for (cal_id, sync_token) in sync_tokens.items():
+            if cal_id in changes and changes[cal_id] is None:
+                cal_changes[cal_id] = None
+            else:
+                cal_changes[cal_id] = (changes.get(cal_id, []), f"{sync_token}+1")
+        return cal_changes
+    google_apis.request_cal_changes_batch = request_cal_changes_batch
+
+    def request_cal_sync_token(credentials, cal_id):
+        time.sleep(latency)
+        return f"sync-{cal_id}"
+    google_apis.request_cal_sync_token = request_cal_sync_token
+
+    def save_cal_as_ical(cal_id, credentials, file_path, validators=None, content_hash=None, normalize=False):
+        time.sleep(latency)
+        if cal_id in failing_cal_ids:
+            raise RuntimeError(f"Failed to download {cal_id}")
         if cal_files_as_allowlist:
             assert cal_id in cal_files
         cal_file = cal_files[cal_id] if cal_id in cal_files else None
         cal_file = cal_id + ".ics" if cal_file is None else cal_file
-        return _read_data_file(cal_file)
-    google_apis.request_cal_as_ical = request_cal_as_ical
+        etag = f'"{cal_file}"'
+        if validators and validators.get('etag') == etag:
+            return None
+        content = _read_data_file(cal_file)
+        if normalize:
+            content = "".join(ical.normalize(content.splitlines(keepends=True)))
+        new_content_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+        if new_content_hash != content_hash:
+            Path(file_path).write_text(content)
+        return (len(content), {'etag': etag}, new_content_hash)
+    google_apis.save_cal_as_ical = save_cal_as_ical
 
     return google_apis
 
@@ -465,6 +1796,27 @@ def _setup_dirs():
     return (conf_dir.resolve(), output_dir.resolve())
 
 
+def _setup_remotes(output_dir, names):
+    output_dir.mkdir(parents=True)
+    repo = GitVaultRepo("gcalvault", output_dir, [".ics"])._repo
+    remotes = {}
+    for name in names:
+        remote_dir = Path(f"{output_dir}.{name}.git")
+        if remote_dir.exists():
+            shutil.rmtree(remote_dir)
+        remotes[name] = Repo.init(remote_dir, bare=True)
+        repo.create_remote(name, str(remote_dir))
+    return remotes
+
+
+def _loose_object_count(repo):
+    return int(dict(line.split(": ", 1) for line in repo.git.count_objects('-v').splitlines())['count'])
+
+
+def _glob_relative(dir_path, pattern):
+    return [os.path.relpath(path, dir_path) for path in glob.glob(os.path.join(dir_path, pattern))]
+
+
 def _read_data_file(file_name):
     return _read_file(data_dir_path, file_name)
 
@@ -0,0 +1,167 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+import shutil
+from unittest.mock import patch
+from google.oauth2.credentials import Credentials
+from gcalvault.google_oauth2 import GoogleOAuth2, TOKEN_REFRESH_MARGIN
+
+SCOPES = ["https://www.googleapis.com/auth/calendar.readonly"]
+
+
+def test_credentials_cached_in_memory():
+    token_file_path = _setup_token_file_path()
+    _write_token(token_file_path, "token1", expires_in=timedelta(hours=1))
+    google_oauth2 = GoogleOAuth2()
+
+    with patch.object(Credentials, 'refresh', autospec=True) as refresh:
+        (credentials, new_authorization) = _get_credentials(google_oauth2, token_file_path)
+        os.remove(token_file_path)
+        (cached_credentials, _) = _get_credentials(google_oauth2, token_file_path)
+
+    assert credentials.token == "token1"
+    assert new_authorization is False
+    assert cached_credentials is credentials
+    assert refresh.call_count == 0
+    assert not os.path.exists(token_file_path)  # unchanged token not written back
+
+
+def test_token_file_only_written_when_token_changed():
+    token_file_path = _setup_token_file_path()
+    _write_token(token_file_path, "token1", expires_in=timedelta(hours=1))
+    os.utime(token_file_path, (0, 0))
+
+    _get_credentials(GoogleOAuth2(), token_file_path)
+    assert os.path.getmtime(token_file_path) == 0
+
+    _write_token(token_file_path, "token1", expires_in=timedelta(minutes=-5))
+    with patch.object(Credentials, 'refresh', autospec=True, side_effect=_fake_refresh("token2")) as refresh:
+        (credentials, _) = _get_credentials(GoogleOAuth2(), token_file_path)
+
+    assert refresh.call_count == 1
+    assert credentials.token == "token2"
+    assert Credentials.from_authorized_user_file(token_file_path, SCOPES).token == "token2"
+
+
+def test_token_refreshed_ahead_of_expiry():
+    token_file_path = _setup_token_file_path()
+    _write_token(token_file_path, "token1", expires_in=TOKEN_REFRESH_MARGIN / 2)
+
+    with patch.object(Credentials, 'refresh', autospec=True, side_effect=_fake_refresh("token2")) as refresh:
+        (credentials, _) = _get_credentials(GoogleOAuth2(), token_file_path)
+
+    assert refresh.call_count == 1  # still valid, but due for a refresh
+    assert credentials.token == "token2"
+
+
+def test_failed_early_refresh_keeps_valid_token(capsys):
+    token_file_path = _setup_token_file_path()
+    _write_token(token_file_path, "token1", expires_in=TOKEN_REFRESH_MARGIN / 2)
+
+    with patch.object(Credentials, 'refresh', autospec=True, side_effect=RuntimeError("offline")) as refresh:
+        (credentials, _) = _get_credentials(GoogleOAuth2(), token_file_path)
+
+    assert refresh.call_count == 1
+    assert credentials.token == "token1"  # still valid for a few minutes
+    assert "Failed to refresh token for foo.bar@gmail.com.token.json: offline" in capsys.readouterr().err
+
+
+def test_refresh_does_not_block_other_token_files():
+    token_file_path = _setup_token_file_path()
+    other_token_file_path = os.path.join(os.path.dirname(token_file_path), "foo.baz@gmail.com.token.json")
+    _write_token(token_file_path, "token1", expires_in=timedelta(minutes=-5))
+    _write_token(other_token_file_path, "other-token", expires_in=timedelta(hours=1))
+    google_oauth2 = GoogleOAuth2()
+    _get_credentials(google_oauth2, other_token_file_path)
+    (refreshing, release) = (threading.Event(), threading.Event())
+
+    def refresh(credentials, request):
+        refreshing.set()
+        release.wait(5)
+        _fake_refresh("token2")(credentials, request)
+
+    with patch.object(Credentials, 'refresh', autospec=True, side_effect=refresh) as refresh_mock:
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            futures = [executor.submit(_get_credentials, google_oauth2, token_file_path) for _ in range(2)]
+            assert refreshing.wait(5)
+            other_future = executor.submit(_get_credentials, google_oauth2, other_token_file_path)
+            try:
+                (other_credentials, _) = other_future.result(timeout=1)  # not held up by the refresh
+            finally:
+                release.set()
+            results = [future.result() for future in futures]
+
+    assert other_credentials.token == "other-token"
+    assert refresh_mock.call_count == 1  # the second caller waited for the first one's refresh
+    assert [credentials.token for (credentials, _) in results] == ["token2", "token2"]
+
+
+def test_token_refreshed_in_background():
+    token_file_path = _setup_token_file_path()
+    _write_token(token_file_path, "token1", expires_in=TOKEN_REFRESH_MARGIN + timedelta(minutes=1))
+    google_oauth2 = GoogleOAuth2()
+
+    with patch.object(Credentials, 'refresh', autospec=True, side_effect=_fake_refresh("token2")) as refresh:
+        (credentials, _) = _get_credentials(google_oauth2, token_file_path)
+        assert refresh.call_count == 0
+        google_oauth2._clock = lambda: datetime.utcnow() + timedelta(minutes=2)
+        google_oauth2.start_refreshing()
+        deadline = time.monotonic() + 5
+        while credentials.token != "token2" and time.monotonic() < deadline:
+            time.sleep(0.01)
+        google_oauth2.close()
+        (cached_credentials, _) = _get_credentials(google_oauth2, token_file_path)
+
+    assert refresh.call_count == 1
+    assert cached_credentials is credentials
+    assert cached_credentials.token == "token2"
+    assert Credentials.from_authorized_user_file(token_file_path, SCOPES).token == "token2"
+
+
+def test_failed_background_refresh_keeps_credentials(capsys):
+    token_file_path = _setup_token_file_path()
+    _write_token(token_file_path, "token1", expires_in=TOKEN_REFRESH_MARGIN + timedelta(minutes=1))
+    google_oauth2 = GoogleOAuth2()
+    (credentials, _) = _get_credentials(google_oauth2, token_file_path)
+
+    with patch.object(Credentials, 'refresh', autospec=True, side_effect=RuntimeError("offline")) as refresh:
+        google_oauth2._clock = lambda: datetime.utcnow() + timedelta(minutes=2)
+        google_oauth2.start_refreshing()
+        deadline = time.monotonic() + 5
+        while refresh.call_count == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        google_oauth2.close()
+
+    assert refresh.call_count == 1  # retried after TOKEN_REFRESH_RETRY_DELAY, not right away
+    assert credentials.token == "token1"
+    assert "Failed to refresh token for foo.bar@gmail.com.token.json: offline" in capsys.readouterr().err
+
+
+def _get_credentials(google_oauth2, token_file_path):
+    return google_oauth2.get_credentials(token_file_path, "client-id", "client-secret", SCOPES, "foo.bar@gmail.com")
+
+
+def _write_token(token_file_path, token, expires_in):
+    credentials = Credentials(
+        token, refresh_token="refresh", token_uri="https://oauth2.googleapis.com/token",
+        client_id="client-id", client_secret="client-secret", scopes=SCOPES,
+        expiry=datetime.utcnow().replace(microsecond=0) + expires_in)
+    Path(token_file_path).write_text(credentials.to_json())
+
+
+def _fake_refresh(token):
+    def refresh(credentials, request):
+        credentials.token = token
+        credentials.expiry = datetime.utcnow().replace(microsecond=0) + timedelta(hours=1)
+    return refresh
+
+
+def _setup_token_file_path():
+    conf_dir = Path("/tmp/conf")
+    if conf_dir.exists():
+        shutil.rmtree(conf_dir)
+    conf_dir.mkdir(parents=True)
+    return os.path.join(conf_dir, "foo.bar@gmail.com.token.json")
@@ -0,0 +1,166 @@
+import os
+from pathlib import Path
+import shutil
+from gcalvault import ical
+
+ICS = (
+    "BEGIN:VCALENDAR\r\n"
+    "PRODID:-//Google Inc//Google Calendar 70.9054//EN\r\n"
+    "X-WR-CALDESC:A calendar description long enough that Google folds it onto\r\n"
+    "  a second line\r\n"
+    "BEGIN:VEVENT\r\n"
+    "UID:one@google.com\r\n"
+    "SUMMARY:One\r\n"
+    "BEGIN:VALARM\r\n"
+    "ACTION:DISPLAY\r\n"
+    "UID:alarm@google.com\r\n"
+    "END:VALARM\r\n"
+    "END:VEVENT\r\n"
+    "BEGIN:VEVENT\r\n"
+    "UID:two-with-a-very-long-identifier-that-gets-folded-by-the-exporter@goo\r\n"
+    " gle.com\r\n"
+    "SUMMARY;LANGUAGE=en:Two\r\n"
+    "END:VEVENT\r\n"
+    "BEGIN:VEVENT\r\n"
+    "UID:one@google.com\r\n"
+    "RECURRENCE-ID:20210601T093000Z\r\n"
+    "SUMMARY:One (moved)\r\n"
+    "END:VEVENT\r\n"
+    "END:VCALENDAR\r\n"
+)
+
+
+def test_iter_components_round_trips():
+    components = list(ical.iter_components(ICS.splitlines(keepends=True)))
+
+    assert [name for (name, _) in components] == [None, None, None, None, "VEVENT", "VEVENT", "VEVENT", None]
+    assert "".join("".join(lines) for (_, lines) in components) == ICS
+
+
+def test_property_value():
+    events = [lines for (name, lines) in ical.iter_components(ICS.splitlines(keepends=True)) if name == "VEVENT"]
+
+    assert ical.property_value(events[0], "UID") == "one@google.com"  # not the VALARM's UID
+    assert ical.property_value(events[1], "uid") == \
+        "two-with-a-very-long-identifier-that-gets-folded-by-the-exporter@google.com"
+    assert ical.property_value(events[1], "SUMMARY") == "Two"
+    assert ical.property_value(events[1], "LOCATION") is None
+
+
+def test_remove_events():
+    file_path = _write_ics(ICS)
+
+    assert ical.remove_events(file_path, ["one@google.com"])
+
+    content = Path(file_path).read_bytes().decode('utf-8')
+    assert "one@google.com" not in content
+    assert "One (moved)" not in content
+    assert content.startswith("BEGIN:VCALENDAR\r\n") and content.endswith("END:VCALENDAR\r\n")
+    assert "SUMMARY;LANGUAGE=en:Two\r\n" in content
+    assert os.listdir(os.path.dirname(file_path)) == ["cal.ics"]
+
+
+def test_remove_events_unknown_uid_leaves_file_unchanged():
+    file_path = _write_ics(ICS)
+
+    assert not ical.remove_events(file_path, ["one@google.com", "unknown@google.com"])
+
+    assert Path(file_path).read_bytes().decode('utf-8') == ICS
+    assert os.listdir(os.path.dirname(file_path)) == ["cal.ics"]
+
+
+def test_normalize_is_stable_across_exports():
+    export = (
+        "BEGIN:VCALENDAR\r\n"
+        "PRODID:-//Google Inc//Google Calendar 70.9054//EN\r\n"
+        "BEGIN:VEVENT\r\n"
+        "DTSTAMP:20210601T120000Z\r\n"
+        "UID:b@google.com\r\n"
+        "LAST-MODIFIED:20210102T090000Z\r\n"
+        "END:VEVENT\r\n"
+        "BEGIN:VEVENT\r\n"
+        "DTSTAMP:20210601T120000Z\r\n"
+        "UID:a@google.com\r\n"
+        "CREATED:20210101T080000Z\r\n"
+        "END:VEVENT\r\n"
+        "END:VCALENDAR\r\n"
+    )
+    # Same calendar exported later: events reordered, DTSTAMP rewritten, lines refolded
+    reexport = (
+        export.replace("20210601T120000Z", "20210602T120000Z")
+        .replace("PRODID:-//Google Inc//", "PRODID:-//Google Inc\r\n //")
+    )
+    reexport = reexport[:reexport.index("BEGIN:VEVENT")] + \
+        reexport[reexport.index("BEGIN:VEVENT", reexport.index("END:VEVENT")):reexport.index("END:VCALENDAR")] + \
+        reexport[reexport.index("BEGIN:VEVENT"):reexport.index("BEGIN:VEVENT", reexport.index("END:VEVENT"))] + \
+        "END:VCALENDAR\r\n"
+
+    normalized = "".join(ical.normalize(export.splitlines(keepends=True)))
+
+    assert normalized == "".join(ical.normalize(reexport.splitlines(keepends=True)))
+    assert normalized == (
+        "BEGIN:VCALENDAR\r\n"
+        "PRODID:-//Google Inc//Google Calendar 70.9054//EN\r\n"
+        "BEGIN:VEVENT\r\n"
+        "DTSTAMP:20210101T080000Z\r\n"
+        "UID:a@google.com\r\n"
+        "CREATED:20210101T080000Z\r\n"
+        "END:VEVENT\r\n"
+        "BEGIN:VEVENT\r\n"
+        "DTSTAMP:20210102T090000Z\r\n"
+        "UID:b@google.com\r\n"
+        "LAST-MODIFIED:20210102T090000Z\r\n"
+        "END:VEVENT\r\n"
+        "END:VCALENDAR\r\n"
+    )
+
+
+def test_normalize_sorts_recurrence_instances_and_refolds():
+    normalized = "".join(ical.normalize(ICS.splitlines(keepends=True)))
+    lines = normalized.split("\r\n")[:-1]
+
+    events = [lines for (name, lines) in ical.iter_components(normalized.splitlines(keepends=True))
+              if name == "VEVENT"]
+    assert [(ical.property_value(event, "UID")[:3], ical.property_value(event, "RECURRENCE-ID"))
+            for event in events] == [("one", None), ("one", "20210601T093000Z"), ("two", None)]
+    assert "BEGIN:VALARM" in "".join(events[0])  # nested components stay with their event
+    assert all(len(line.encode('utf-8')) <= 75 for line in lines)
+    assert sorted(ical.unfold(lines)) == sorted(ical.unfold(ICS.splitlines()))  # nothing lost
+
+
+def test_normalize_folds_without_splitting_characters():
+    summary = "SUMMARY:" + "\u00e9" * 100
+    lines = list(ical.normalize([summary + "\r\n"]))
+
+    assert len(lines) == 3
+    assert all(len(line.rstrip("\r\n").encode('utf-8')) <= 75 for line in lines)
+    assert ical.unfold(lines) == [summary]
+
+
+def test_split_events():
+    ics = ICS.replace(
+        "BEGIN:VEVENT\r\nUID:one@google.com\r\nRECURRENCE-ID",
+        "BEGIN:VTIMEZONE\r\nTZID:Europe/Berlin\r\nEND:VTIMEZONE\r\n"
+        "BEGIN:VEVENT\r\nUID:one@google.com\r\nRECURRENCE-ID;TZID=Europe/Berlin")
+
+    calendars = dict(ical.split_events(ics.splitlines(keepends=True)))
+
+    assert list(calendars) == [
+        "one@google.com", "two-with-a-very-long-identifier-that-gets-folded-by-the-exporter@google.com"]
+    one = "".join(calendars["one@google.com"])
+    assert one.startswith(ICS[:ICS.index("BEGIN:VEVENT")]) and one.endswith("END:VCALENDAR\r\n")
+    assert one.count("BEGIN:VEVENT") == 2  # overridden instance kept with its event
+    assert "TZID:Europe/Berlin" in one  # timezone it refers to
+    two = "".join(calendars["two-with-a-very-long-identifier-that-gets-folded-by-the-exporter@google.com"])
+    assert two.count("BEGIN:VEVENT") == 1 and "VTIMEZONE" not in two
+    assert "UID:two-with-a-very-long-identifier-that-gets-folded-by-the-exporter@goo\r\n gle.com\r\n" in two
+
+
+def _write_ics(content):
+    dir_path = Path("/tmp/ical")
+    if dir_path.exists():
+        shutil.rmtree(dir_path)
+    dir_path.mkdir(parents=True)
+    file_path = dir_path / "cal.ics"
+    file_path.write_bytes(content.encode('utf-8'))
+    return str(file_path)
@@ -0,0 +1,72 @@
+import json
+import os
+from pathlib import Path
+import shutil
+import pytest
+from gcalvault.metrics import Metrics
+
+
+def test_phases_written_as_json_lines():
+    (json_lines_path, _) = _setup_paths()
+    metrics = Metrics(json_lines_path).bind(user="foo.bar@gmail.com")
+
+    with metrics.phase("download", calendar="foo.bar@gmail.com") as phase:
+        phase['bytes'] = 1234
+    with pytest.raises(RuntimeError):
+        with metrics.phase("git_commit"):
+            raise RuntimeError("failed")
+    metrics.record("list_calendars", 0.5, calendars=3)
+    metrics.close()
+
+    lines = [json.loads(line) for line in Path(json_lines_path).read_text().splitlines()]
+    assert [line['phase'] for line in lines] == ["download", "git_commit", "list_calendars"]
+    assert lines[0]['user'] == "foo.bar@gmail.com"
+    assert lines[0]['calendar'] == "foo.bar@gmail.com"
+    assert lines[0]['bytes'] == 1234
+    assert lines[0]['status'] == "ok"
+    assert lines[0]['duration'] >= 0
+    assert lines[0]['time'].endswith("+00:00")
+    assert lines[1]['status'] == "error"
+    assert lines[2] == dict(lines[2], duration=0.5, calendars=3, status="ok")
+
+
+def test_phases_aggregated_in_prometheus_textfile():
+    (_, prometheus_path) = _setup_paths()
+    metrics = Metrics(prometheus_path=prometheus_path)
+    foo = metrics.bind(user="foo.bar@gmail.com")
+    baz = metrics.bind(user='foo.baz"\\@gmail.com')
+
+    foo.record("download", 1.5, bytes=100)
+    foo.record("download", 0.5, bytes=50)
+    foo.record("download", 0.25, status="error")
+    foo.record("sync", 3.0, started_at=1622538000.0)
+    baz.record("sync", 1.0, started_at=1622538000.0, status="error")
+    metrics.write_prometheus()
+
+    lines = Path(prometheus_path).read_text().splitlines()
+    assert "# TYPE gcalvault_phase_duration_seconds summary" in lines
+    assert 'gcalvault_phase_duration_seconds_sum{phase="download",user="foo.bar@gmail.com"} 2.25' in lines
+    assert 'gcalvault_phase_duration_seconds_count{phase="download",user="foo.bar@gmail.com"} 3' in lines
+    assert 'gcalvault_phase_errors_total{phase="download",user="foo.bar@gmail.com"} 1' in lines
+    assert 'gcalvault_download_bytes_total{user="foo.bar@gmail.com"} 150' in lines
+    assert 'gcalvault_last_sync_timestamp_seconds{user="foo.bar@gmail.com"} 1622538003.0' in lines
+    assert 'gcalvault_last_sync_duration_seconds{user="foo.bar@gmail.com"} 3.0' in lines
+    assert 'gcalvault_last_sync_success{user="foo.bar@gmail.com"} 1' in lines
+    assert 'gcalvault_last_sync_success{user="foo.baz\\"\\\\@gmail.com"} 0' in lines
+    assert os.listdir(os.path.dirname(prometheus_path)) == ["gcalvault.prom"]  # no temp files left behind
+
+
+def test_metrics_without_files():
+    metrics = Metrics()
+
+    with metrics.phase("sync"):
+        pass
+    metrics.close()
+
+
+def _setup_paths():
+    metrics_dir = Path("/tmp/metrics")
+    if metrics_dir.exists():
+        shutil.rmtree(metrics_dir)
+    metrics_dir.mkdir(parents=True)
+    return (os.path.join(metrics_dir, "gcalvault.jsonl"), os.path.join(metrics_dir, "gcalvault.prom"))
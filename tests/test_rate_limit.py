@@ -0,0 +1,110 @@
+from datetime import datetime, timezone
+import pytest
+from gcalvault.rate_limit import Backoff, RateLimiter
+
+
+class FakeClock():
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+
+
+def _rate_limiter(qps):
+    clock = FakeClock()
+    rate_limiter = RateLimiter(qps)
+    rate_limiter._clock = clock
+    rate_limiter._sleep = clock.sleep
+    return (rate_limiter, clock)
+
+
+def test_rate_limiter_allows_burst_then_paces():
+    (rate_limiter, clock) = _rate_limiter(2)
+
+    for _ in range(4):
+        rate_limiter.acquire()
+
+    assert clock.sleeps == [0.5, 1.0]  # burst of 2, then one every half second
+
+
+def test_rate_limiter_refills_over_time():
+    (rate_limiter, clock) = _rate_limiter(2)
+    rate_limiter.acquire()
+    rate_limiter.acquire()
+
+    clock.now = 10.0
+    rate_limiter.acquire()
+    rate_limiter.acquire()
+    rate_limiter.acquire()
+
+    assert clock.sleeps == [0.5]  # refilled up to the burst size only
+
+
+def test_rate_limiter_unlimited():
+    (rate_limiter, clock) = _rate_limiter(0)
+
+    for _ in range(100):
+        rate_limiter.acquire()
+
+    assert clock.sleeps == []
+
+
+def test_rate_limiter_below_one_qps():
+    (rate_limiter, clock) = _rate_limiter(0.5)
+
+    rate_limiter.acquire()
+    rate_limiter.acquire()
+
+    assert clock.sleeps == [2.0]
+
+
+@pytest.mark.parametrize(
+    "status, body, expected", [
+        (429, None, True),
+        (500, None, True),
+        (503, None, True),
+        (403, '{"error": {"errors": [{"reason": "rateLimitExceeded"}]}}', True),
+        (403, b'{"error": {"errors": [{"reason": "userRateLimitExceeded"}]}}', True),
+        (403, '{"error": {"errors": [{"reason": "forbidden"}]}}', False),
+        (404, None, False),
+        (410, None, False),
+        (200, None, False),
+    ])
+def test_backoff_retries_rate_limited_and_unavailable(status, body, expected):
+    backoff = Backoff()
+
+    assert (backoff.delay(1, status, body=lambda: body) is not None) == expected
+
+
+def test_backoff_jittered_exponential_delays():
+    backoff = Backoff(max_retries=7, base_delay=1, max_delay=16)
+    backoff._random = lambda: 1.0
+
+    assert [backoff.delay(attempt, 503) for attempt in range(1, 8)] == [1, 2, 4, 8, 16, 16, 16]
+    assert backoff.delay(8, 503) is None
+
+    backoff._random = lambda: 0.25
+    assert backoff.delay(3, 503) == 1
+
+
+def test_backoff_honours_retry_after():
+    backoff = Backoff()
+    backoff._random = lambda: 1.0
+
+    assert backoff.delay(1, 429, "7") == 7
+    assert backoff.delay(1, 429, "100000") == 300  # capped
+    assert backoff.delay(1, 429, "soon") == 1  # unparseable, falls back to backoff
+
+
+def test_backoff_honours_retry_after_date():
+    backoff = Backoff()
+    backoff._now = lambda: datetime(2021, 6, 2, 9, 0, 0, tzinfo=timezone.utc)
+
+    assert backoff.delay(1, 503, "Wed, 02 Jun 2021 09:00:30 GMT") == 30
+    assert backoff.delay(1, 503, "Wed, 02 Jun 2021 08:00:00 GMT") == 0
@@ -0,0 +1,50 @@
+import re
+import subprocess
+import sys
+import pytest
+
+# Dependencies which are slow to import, and only needed once syncing
+HEAVY_MODULES = [
+    "git", "google", "google_auth_httplib2", "google_auth_oauthlib", "googleapiclient",
+    "httplib2", "requests", "urllib3",
+]
+
+IMPORT_TIME_LINE_RE = re.compile(r"^import time:\s+(?P<self>\d+) \|\s+(?P<cumulative>\d+) \|(?P<indent>\s+)(?P<module>\S+)$")
+
+
+@pytest.mark.parametrize(
+    "args", [
+        ["--help"],
+        ["--version"],
+        ["noop", "foo.bar@gmail.com", "-c", "/tmp/conf", "-o", "/tmp/output"],
+    ])
+def test_startup_doesnt_import_heavy_dependencies(args):
+    import_times = _import_times("from gcalvault import Gcalvault; Gcalvault().run(sys.argv[1:])", args)
+
+    assert "gcalvault.gcalvault" in import_times
+    assert sorted({module.split(".")[0] for module in import_times} & set(HEAVY_MODULES)) == []
+
+
+def test_startup_import_time():
+    heavy_imports = ["git", "googleapiclient.discovery", "google_auth_oauthlib.flow", "requests"]
+    heavy_import_times = _import_times("; ".join(f"import {module}" for module in heavy_imports))
+    import_times = _import_times("import gcalvault")
+
+    # Measured against the heavy dependencies on the same machine, so the check holds on slow boards too
+    assert import_times["gcalvault"] < sum(heavy_import_times[module] for module in heavy_imports) / 2
+
+
+def _import_times(script, args=()):
+    """
+    Runs a script in a fresh interpreter with -X importtime
+    :return: dict<str, int> of each module imported to its cumulative import time in microseconds
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import sys; {script}", *args],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    import_times = {}
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_LINE_RE.match(line)
+        if match:
+            import_times[match.group('module')] = int(match.group('cumulative'))
+    return import_times
@@ -0,0 +1,193 @@
+import os
+import sqlite3
+from pathlib import Path
+import shutil
+import pytest
+from gcalvault.state_store import StateStore, STATE_DB_FILE_NAME, SCHEMA_MIGRATIONS
+
+
+def test_staged_values_only_persist_once_committed_and_flushed():
+    conf_dir = _setup_conf_dir()
+
+    state = StateStore(conf_dir)
+    state.stage("foo.bar@gmail.com", etag='"abc123"')
+    state.stage("foo.baz@gmail.com", etag='"abc123"')
+    state.commit("foo.bar@gmail.com")
+    assert state.get("foo.bar@gmail.com")['etag'] == '"abc123"'
+    assert state.get("foo.baz@gmail.com")['etag'] is None
+    assert _read_rows(conf_dir) == []  # nothing written before flush
+    state.flush()
+    state.close()
+
+    state = StateStore(conf_dir)
+    assert state.get("foo.bar@gmail.com")['etag'] == '"abc123"'
+    assert state.get("foo.baz@gmail.com")['etag'] is None  # never committed
+    state.close()
+
+
+def test_updates_merge_per_calendar():
+    conf_dir = _setup_conf_dir()
+
+    state = StateStore(conf_dir)
+    state.update("Foo.Bar@gmail.com", sync_token="token1", byte_size=1024)
+    state.flush()
+    state.update("foo.bar@gmail.com", sync_token="token2", last_fetched=1622624400.0)
+    state.flush()
+
+    assert state.get("foo.bar@gmail.com") == {
+        'etag': None,
+        'sync_token': "token2",
+        'caldav_etag': None,
+        'caldav_last_modified': None,
+        'content_hash': None,
+        'byte_size': 1024,
+        'last_fetched': 1622624400.0,
+        'last_duration': None,
+        'last_checked': None,
+        'last_changed': None,
+        'change_interval': None,
+        'channel_id': None,
+        'channel_resource_id': None,
+        'channel_token': None,
+        'channel_expiration': None,
+    }
+    with pytest.raises(ValueError):
+        state.update("foo.bar@gmail.com", color="blue")
+    state.close()
+
+
+def test_readable_while_writing():
+    conf_dir = _setup_conf_dir()
+    state = StateStore(conf_dir)
+    state.update("foo.bar@gmail.com", sync_token="token1")
+    state.flush()
+
+    writer = sqlite3.connect(os.path.join(conf_dir, STATE_DB_FILE_NAME))
+    writer.execute("BEGIN IMMEDIATE")
+    writer.execute("UPDATE calendars SET sync_token = 'token2'")
+    assert state.get("foo.bar@gmail.com")['sync_token'] == "token1"  # reader not blocked by open write
+    writer.commit()
+    assert state.get("foo.bar@gmail.com")['sync_token'] == "token2"
+    writer.close()
+    state.close()
+
+
+def test_clear():
+    conf_dir = _setup_conf_dir()
+    state = StateStore(conf_dir)
+    state.update("foo.bar@gmail.com", etag='"abc123"')
+    state.flush()
+    state.update("foo.baz@gmail.com", etag='"abc123"')
+
+    state.clear()
+    state.flush()
+    state.close()
+
+    assert _read_rows(conf_dir) == []
+
+
+def test_clear_keeps_watch_channels():
+    conf_dir = _setup_conf_dir()
+    state = StateStore(conf_dir)
+    state.update("foo.bar@gmail.com", etag='"abc123"', channel_id="channel1", channel_resource_id="resource1",
+                 channel_token="secret", channel_expiration=1622624400.0)
+    state.update("foo.baz@gmail.com", etag='"abc123"')
+    state.flush()
+
+    state.clear()
+    state.flush()
+
+    assert state.get("foo.bar@gmail.com")['etag'] is None
+    assert state.get("foo.bar@gmail.com")['channel_id'] == "channel1"
+    assert state.get("foo.bar@gmail.com")['channel_expiration'] == 1622624400.0
+    assert len(_read_rows(conf_dir)) == 1
+
+
+def test_calendar_list():
+    conf_dir = _setup_conf_dir()
+    items = [{'id': "foo.bar@gmail.com", 'summary': "foo.bar@gmail.com", 'accessRole': "owner"}]
+
+    state = StateStore(conf_dir)
+    assert state.last_calendar_list() is None
+    state.record_calendar_list('"list1"', [])
+    state.record_calendar_list('"list2"', items)
+    state.close()
+
+    state = StateStore(conf_dir)
+    assert state.last_calendar_list() == {'etag': '"list2"', 'items': items}
+    state.clear()
+    assert state.last_calendar_list() is None
+
+
+def test_imports_legacy_etags_file():
+    conf_dir = _setup_conf_dir()
+    Path(conf_dir, ".etags").write_text("foo.bar@gmail.com\tabc123\nmalformed line here\n")
+
+    state = StateStore(conf_dir)
+
+    assert state.get("foo.bar@gmail.com")['etag'] == '"abc123"'
+    assert state.get("foo.bar@gmail.com")['sync_token'] is None
+    assert not os.path.exists(os.path.join(conf_dir, ".etags"))
+    state.close()
+
+
+def test_maintenance_runs():
+    conf_dir = _setup_conf_dir()
+    # Database as created before maintenance runs were recorded
+    connection = sqlite3.connect(os.path.join(conf_dir, STATE_DB_FILE_NAME))
+    connection.execute(SCHEMA_MIGRATIONS[0])
+    connection.execute("INSERT INTO calendars (id, etag) VALUES ('foo.bar@gmail.com', '\"abc123\"')")
+    connection.execute("PRAGMA user_version = 1")
+    connection.commit()
+    connection.close()
+
+    state = StateStore(conf_dir)
+    assert state.get("foo.bar@gmail.com")['etag'] == '"abc123"'
+    assert state.last_maintenance_run() is None
+    state.record_maintenance_run("a1b2c3", "100 commits since last maintenance", 1622624400.0, 1.5)
+    state.record_maintenance_run("d4e5f6", "7000 loose objects", 1622710800.0, 2.5)
+    state.clear()
+    state.close()
+
+    with StateStore(conf_dir) as state:
+        assert state.last_maintenance_run() == {
+            'head': "d4e5f6", 'reason': "7000 loose objects", 'started': 1622710800.0, 'duration': 2.5}
+
+
+def test_migrates_calendars_to_change_history():
+    conf_dir = _setup_conf_dir()
+    # Database as created before change history was recorded
+    connection = sqlite3.connect(os.path.join(conf_dir, STATE_DB_FILE_NAME))
+    for statement in SCHEMA_MIGRATIONS[:2]:
+        connection.execute(statement)
+    connection.execute("INSERT INTO calendars (id, etag, last_fetched) VALUES ('foo.bar@gmail.com', '\"abc123\"', 1.5)")
+    connection.execute("PRAGMA user_version = 2")
+    connection.commit()
+    connection.close()
+
+    state = StateStore(conf_dir)
+    assert state.get("foo.bar@gmail.com")['etag'] == '"abc123"'
+    assert state.get("foo.bar@gmail.com")['last_changed'] is None
+    state.update("foo.bar@gmail.com", last_checked=1622624400.0, last_changed=1622624400.0, change_interval=600.0)
+    state.flush()
+    state.close()
+
+    with StateStore(conf_dir) as state:
+        calendar = state.get("foo.bar@gmail.com")
+    assert {field: calendar[field] for field in ['last_fetched', 'last_checked', 'last_changed', 'change_interval']} == {
+        'last_fetched': 1.5, 'last_checked': 1622624400.0, 'last_changed': 1622624400.0, 'change_interval': 600.0}
+
+
+def _read_rows(conf_dir):
+    connection = sqlite3.connect(os.path.join(conf_dir, STATE_DB_FILE_NAME))
+    rows = connection.execute("SELECT * FROM calendars").fetchall()
+    connection.close()
+    return rows
+
+
+def _setup_conf_dir():
+    conf_dir = Path("/tmp/conf")
+    if conf_dir.exists():
+        shutil.rmtree(conf_dir)
+    conf_dir.mkdir(parents=True)
+    return str(conf_dir)
@@ -0,0 +1,41 @@
+import os
+from pathlib import Path
+import shutil
+import pytest
+from gcalvault.temp_file import temp_file
+
+
+def test_temp_file_replaces_file():
+    file_path = os.path.join(_setup_dir(), "foo.bar@gmail.com.ics")
+    Path(file_path).write_text("old")
+
+    with temp_file(file_path) as temp_file_path:
+        assert os.path.dirname(temp_file_path) == os.path.dirname(file_path)
+        assert os.path.basename(temp_file_path).startswith(".foo.bar@gmail.com.ics.")
+        Path(temp_file_path).write_text("new")
+        os.replace(temp_file_path, file_path)
+
+    assert Path(file_path).read_text() == "new"
+    assert os.listdir(os.path.dirname(file_path)) == ["foo.bar@gmail.com.ics"]
+
+
+def test_temp_file_removed_unless_replaced():
+    dir_path = _setup_dir()
+    file_path = os.path.join(dir_path, "foo.bar@gmail.com.ics")
+
+    with temp_file(file_path) as temp_file_path:
+        Path(temp_file_path).write_text("abandoned")
+    with pytest.raises(RuntimeError):
+        with temp_file(file_path) as temp_file_path:
+            Path(temp_file_path).write_text("failed")
+            raise RuntimeError("Download failed")
+
+    assert os.listdir(dir_path) == []
+
+
+def _setup_dir():
+    dir_path = Path("/tmp/temp_file")
+    if dir_path.exists():
+        shutil.rmtree(dir_path)
+    dir_path.mkdir(parents=True)
+    return str(dir_path)
@@ -0,0 +1,80 @@
+import socket
+import threading
+import time
+import pytest
+import requests
+from gcalvault import webhook
+from gcalvault.webhook import WebhookReceiver
+
+
+@pytest.fixture
+def receiver(monkeypatch):
+    monkeypatch.setattr(webhook, "NOTIFICATION_DELAY", 0.2)
+    receiver = WebhookReceiver(_free_port(), host="127.0.0.1")
+    yield receiver
+    receiver.close()
+
+
+def test_notifications_queued_by_channel_key(receiver):
+    receiver.register("channel1", "secret1", ("foo.bar@gmail.com", "foo.bar@gmail.com"))
+    receiver.register("channel2", "secret2", ("foo.bar@gmail.com", "family123456789@group.calendar.google.com"))
+
+    assert _notify(receiver, "channel1", "secret1", "sync") == 200  # channel opened, nothing changed
+    assert receiver.wait(0) == set()
+    assert _notify(receiver, "channel1", "secret1") == 200
+    assert _notify(receiver, "channel1", "secret1") == 200
+    assert _notify(receiver, "channel2", "secret2", "not_exists") == 200
+
+    assert receiver.wait(5) == {
+        ("foo.bar@gmail.com", "foo.bar@gmail.com"),
+        ("foo.bar@gmail.com", "family123456789@group.calendar.google.com"),
+    }
+    assert receiver.wait(0) == set()
+
+
+def test_notifications_of_unknown_channels_or_with_wrong_token_refused(receiver):
+    receiver.register("channel1", "secret1", "key1")
+    receiver.register("channel2", "secret2", "key2")
+    receiver.unregister("channel2")
+
+    assert _notify(receiver, "channel1", "secret2") == 403
+    assert _notify(receiver, "channel1", None) == 403
+    assert _notify(receiver, "channel2", "secret2") == 404
+    assert _notify(receiver, None, None) == 404
+    assert receiver.wait(0) == set()
+
+
+def test_wait_collects_burst_of_notifications(receiver):
+    receiver.register("channel1", "secret1", "key1")
+    receiver.register("channel2", "secret2", "key2")
+    later = threading.Timer(0.05, lambda: _notify(receiver, "channel2", "secret2"))
+
+    started = time.monotonic()
+    _notify(receiver, "channel1", "secret1")
+    later.start()
+    notified = receiver.wait(5)
+    later.join()
+
+    assert notified == {"key1", "key2"}
+    assert 0.1 <= time.monotonic() - started < 5
+
+
+def test_wait_times_out(receiver):
+    started = time.monotonic()
+    assert receiver.wait(0.1) == set()
+    assert time.monotonic() - started >= 0.1
+
+
+def _notify(receiver, channel_id, token, resource_state="exists"):
+    headers = {"X-Goog-Resource-State": resource_state, "X-Goog-Message-Number": "1"}
+    if channel_id is not None:
+        headers["X-Goog-Channel-ID"] = channel_id
+    if token is not None:
+        headers["X-Goog-Channel-Token"] = token
+    return requests.post(f"http://127.0.0.1:{receiver.port}/notify", headers=headers, timeout=5).status_code
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]